@@ -16,6 +16,14 @@ from logging.handlers import TimedRotatingFileHandler
 import os
 import time
 import sys
+
+# Subcommands that do not start the workers.
+# （ワーカーを起動しないサブコマンド）
+#   query: 記録したデータの読み出し（keilib/reader.py を参照）
+if len(sys.argv) > 1 and sys.argv[1] == 'query':
+    from keilib.reader import main
+    sys.exit(main(sys.argv[2:]))
+
 import keiconf
 
 # import configuretion file.
@@ -79,6 +87,15 @@ signal.signal( signal.SIGTERM, exit_handler )
 signal.signal( signal.SIGUSR1, change_loglevel )
 # atexit.register( goodbye )
 
+# With --asyncio, run all workers on one asyncio event loop.
+# Thread workers are run in a thread pool (see keilib/aioworker.py).
+# （--asyncio を指定した場合は1つのイベントループですべてのワーカーを動かす）
+if '--asyncio' in sys.argv[1:]:
+    from keilib.aioworker import AsyncRuntime
+    logger.info('start ' + fname[0] + ' (asyncio)')
+    AsyncRuntime(worker_def).run()
+    sys.exit(0)
+
 # Launch each worker instance（各ワーカーインスタンスの起動）
 for wdef in worker_def:
     wdef['instance'] = wdef['class']( **wdef['args'] )
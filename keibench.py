@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib の処理速度を測定するマイクロベンチマーク
+
+使い方:
+    $ python3 keibench.py            # すべてのベンチマークを実行
+    $ python3 keibench.py codec      # 指定したベンチマークだけを実行
+    $ python3 keibench.py codec -n 100000
+    $ python3 keibench.py validator -c serial.log     # 記録したシリアル入力で測る
+    $ python3 keibench.py replay -c capture.jsonl   # 記録したシリアル通信を再生
+    $ python3 keibench.py sim -t 30 -l 0.1 -p 0.2   # 30秒間、遅延 0.1秒、損失 20%
+
+ベンチマーク:
+    codec   Bルートの ERXUDP 電文のデコードと値の取り出し
+            （16進文字列を解析する従来の方法と、バイト列と struct による方法の比較）
+    parser  WiSunRL7023 が受信した ERXUDP / EVENT 行の検査と項目の取り出し
+            （単語に分けて1項目ずつ検査する従来の方法と、正規表現による方法の比較）
+            Raspberry Pi Zero などの遅い CPU で実行すると、1行あたりの時間の差が大きくなる
+    validator
+            SerialReader などが受信した1行の検査（LineValidator）
+            （以前の split と10件のリストによる方法と、正規表現と集合による方法の比較）
+            -c に記録したシリアル入力（テキスト、または CaptureSerial の JSON Lines）を指定できる
+    frame   シリアル入力の1件の受信と検査（テキストの1行とバイナリフレームの比較）
+    checker 外れ値のチェック（OutlierChecker）を 100件のバッチ（FileRecorder の batch_max）で測り、
+            1件あたりの時間を表示
+            （以前の文字列のキーと dict による方法と、配列による check()、check_batch() の比較、
+            robust は MAD と z スコアの規則で、numpy があれば check_batch() は numpy で評価する）
+
+シナリオ（keilib/simulator.py を使い、ドングルとスマートメーターなしで動かす）:
+    replay  記録したシリアル通信（-c、省略時は -n 個の ERXUDP を生成）を待たずに再生し、
+            WiSunRL7023 の受信スレッドと receive() の処理速度を測る
+    sim     シミュレーターの RL7023 に BrouteReader を -t 秒間接続し、接続までの時間、
+            要求と応答の数、途中で起こした通信断からの回復時間を測る
+            （-l 応答の遅延（秒）、-p 応答の損失率）
+"""
+
+import os
+import re
+import sys
+import time
+import queue
+import random
+import itertools
+import timeit
+import logging
+import tempfile
+
+# 測定に使う電文（E7, E8, E0 を含むプロパティ値読み出し応答）
+SAMPLE_FRAME = '1081000102880105FF017203E704000004A5E80400320014E00400012345'
+
+def _legacy_decode( length, encoded_data ):
+    """以前の DataFrame.decode と同じ方法（16進文字列の切り出し）で電文を解析する"""
+    if len(encoded_data) != int(length, 16) * 2:
+        return None
+    for ch in encoded_data:
+        if not ch in '0123456789ABCDEF':
+            return None
+    frame = {'ESV': encoded_data[20:22], 'SEOJ': encoded_data[8:14], 'TID': encoded_data[4:8]}
+    properties = {}
+    base = 24
+    for pc in range(int(encoded_data[22:24], 16)):
+        epc = encoded_data[base : base + 2]
+        int_pdc = int(encoded_data[base + 2 : base + 4], 16)
+        properties[epc] = encoded_data[base + 4 : base + 4 + int_pdc * 2]
+        base += 4 + int_pdc * 2
+    frame['PROPERTIES'] = properties
+    return frame
+
+def _legacy_signed_int( value ):
+    """以前の hex_to_signed_int と同じ方法（2進文字列を経由）で変換する"""
+    digit2 = len(value) * 4
+    bits = ('{:0' + str(digit2) + 'b}').format(int(value, 16))
+    return -int(bits[0]) << digit2 | int(bits, 2)
+
+# 測定に使う受信行（D/DSS の ERXUDP と EVENT）
+SAMPLE_ERXUDP = ('ERXUDP FE80:0000:0000:0000:021D:1290:1234:5678 FE80:0000:0000:0000:021D:1290:0000:0001 '
+                 '0E1A 0E1A 001D129012345678 1 0 {:04X} '.format(len(SAMPLE_FRAME) // 2) + SAMPLE_FRAME).encode('ascii')
+SAMPLE_EVENT = b'EVENT 21 FE80:0000:0000:0000:021D:1290:1234:5678 0 00'
+
+def _legacy_parse_event( line ):
+    """以前の WiSunRL7023._parse_event（D/DSS）と同じ方法で1行を解析する"""
+    from keilib.broute import is_hex, is_ipv6_address
+    for b in line:
+        if b >= 0x80:
+            return {'NAME': 'INVALID_EVENT'}
+    list = line.decode('ascii').strip().split()
+    if len(list) == 0:
+        return {}
+    if list[0] == 'ERXUDP':
+        if len(list) != 10:
+            return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
+        for i in [1, 2]:
+            if not is_ipv6_address(list[i]):
+                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
+        for i in [3, 4]:
+            if not is_hex(list[i], length=4):
+                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
+        if not is_hex(list[5], length=16) or not is_hex(list[6], length=1) \
+                or not is_hex(list[7], length=1) or not is_hex(list[8], length=4) \
+                or not is_hex(list[9]):
+            return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
+        return {'NAME': list[0], 'SENDER': list[1], 'DEST': list[2], 'RPORT': list[3],
+                'LPORT': list[4], 'SENDERLLA': list[5], 'SECURED': list[6],
+                'DATALEN': list[8], 'DATA': list[9]}
+    elif list[0] == 'EVENT':
+        if len(list) < 3:
+            return {}
+        return {'NAME': list[0], 'NUM': list[1], 'SENDER': list[2]}
+    return {'NAME': 'OTHER_EVENT', 'LIST': list}
+
+def bench_parser( options ):
+    """SK コマンドの受信行（ERXUDP, EVENT）の解析"""
+    from keilib.broute import WiSunRL7023
+
+    wisundev = WiSunRL7023(None, 0, type=WiSunRL7023.DSS)
+    for line in [SAMPLE_ERXUDP, SAMPLE_EVENT]:
+        assert _legacy_parse_event(line) == wisundev._parse_event(line), line
+
+    return [('legacy ERXUDP (split)', lambda: _legacy_parse_event(SAMPLE_ERXUDP)),
+            ('regex ERXUDP', lambda: wisundev._parse_event(SAMPLE_ERXUDP)),
+            ('legacy EVENT (split)', lambda: _legacy_parse_event(SAMPLE_EVENT)),
+            ('regex EVENT', lambda: wisundev._parse_event(SAMPLE_EVENT))]
+
+class _LegacyValidator ( ):
+    """以前の LineValidator と同じ方法（split、pop(0)、10件のリスト）で1行を検査する"""
+
+    def __init__( self ):
+        self.recent = []
+        self.rechkline = re.compile(r'^[a-zA-Z0-9_;:., -]*$')
+        self.rechkid = re.compile(r'^[a-zA-Z0-9-_]+$')
+        self.dataID = 0
+
+    def validate( self, line ):
+        line = line.strip()
+        if line == '' or not self.rechkline.match(line):
+            return None
+        line_list = line.split(',')
+        if len(line_list) < 3:
+            return None
+        unit = line_list.pop(0).strip()
+        sensor = line_list.pop(0).strip()
+        valueStr = line_list.pop(0).strip()
+        if len(line_list) > 0:
+            dataID = line_list.pop(0).strip()
+        else:
+            dataID = str(self.dataID)
+            self.dataID += 1
+            if self.dataID > 100:
+                self.dataID = 0
+        if not self.rechkid.match(unit) or not self.rechkid.match(sensor):
+            return None
+        try:
+            value = float(valueStr)
+        except:
+            return None
+        line = unit + ',' + sensor + ',' + valueStr + ',' + dataID
+        if line in self.recent:
+            return None
+        self.recent.insert(0, line)
+        if len(self.recent) > 10:
+            self.recent.pop()
+        return [unit, sensor, value, dataID]
+
+class _LegacyChecker ( ):
+    """以前の OutlierChecker と同じ方法（sensor + '_' + unit のキーと dict）でチェックする"""
+
+    def __init__( self ):
+        self.check_list = {}
+
+    def check( self, unit, sensor, value ):
+        checkid = sensor + '_' + unit
+        if checkid in self.check_list.keys():
+            sensorData = self.check_list[checkid]
+            if not(sensorData['min'] <= value <= sensorData['max']):
+                return False
+            if 'prev' in sensorData.keys():
+                if abs(value - sensorData['prev']) > sensorData['variation']:
+                    sensorData['count'] += 1
+                    if sensorData['count'] < 3:
+                        return False
+            sensorData['prev'] = value
+            sensorData['count'] = 0
+            return True
+        else:
+            return True
+
+    def add( self, unit, sensor, min, max, variation ):
+        self.check_list[sensor + '_' + unit] = {'min': min, 'max': max, 'variation': variation}
+
+def _serial_lines( options ):
+    """検査に使う行のリスト（-c の記録、省略時は生成した行）"""
+    fname = options.get('capture')
+    if fname:
+        if fname.endswith('.jsonl'):
+            from keilib.simulator import load_capture
+            data = b''.join(d for t, direction, d in load_capture(fname) if direction == 'rx')
+            return data.decode('ascii', errors='replace').splitlines()
+        with open(fname, 'r', errors='replace') as f:
+            return f.read().splitlines()
+
+    # 8ユニット x 4センサー、DATAID あり。再送による重複と不正な行を少し含む
+    lines = []
+    for i in range(1000):
+        unit, sensor = 'U{:02}'.format(i % 8), 'S{}'.format(i // 8 % 4)
+        line = '{},{},{:.2f},{}'.format(unit, sensor, 20 + (i % 37) * 0.25, i % 100)
+        lines.append(line)
+        if i % 10 == 0:
+            lines.append(line)
+        if i % 50 == 0:
+            lines.append(unit + ',' + sensor + ',#')
+    return lines
+
+def bench_validator( options ):
+    """シリアル入力の1行の検査（LineValidator）"""
+    from keilib.serial import LineValidator
+
+    lines = _serial_lines(options)
+    legacy, current = _LegacyValidator(), LineValidator('bench')
+    for line in lines[:200]:
+        assert legacy.validate(line) == current.validate(line), line
+
+    legacy, current = _LegacyValidator(), LineValidator('bench')
+    legacy_lines, current_lines = itertools.cycle(lines), itertools.cycle(lines)
+    return [('legacy (split, list)', lambda: legacy.validate(next(legacy_lines))),
+            ('regex + set/deque', lambda: current.validate(next(current_lines)))]
+
+def bench_frame( options ):
+    """シリアル入力の1件の検査（テキストとバイナリフレーム）"""
+    from keilib.serial import LineValidator, FrameDecoder, encode_frame
+
+    validator = LineValidator('bench')
+    decoder = FrameDecoder('bench', unit_names={1: 'U01'}, sensor_names={1: 'CT1'})
+    seq = itertools.count()
+    # 受信データの組み立ては計測に含めない
+    lines = ['U01,CT1,{:.2f},{}'.format(12.5, i) for i in range(0x10000)]
+    frames = [encode_frame(1, 1, 12.5, i) for i in range(0x10000)]
+    print('  text {} bytes/line, binary {} bytes/frame'.format(len(lines[0]) + 1, len(frames[0])))
+
+    return [('text line', lambda: validator.validate(lines[next(seq) & 0xFFFF])),
+            ('binary frame', lambda: decoder.feed(frames[next(seq) & 0xFFFF]))]
+
+def bench_checker( options ):
+    """外れ値のチェック（OutlierChecker、1件あたり）"""
+    from keilib.checker import OutlierChecker, numpy
+
+    # 10ユニット x 4センサーの値、ときどきスパイク（同じ乱数で毎回同じデータ）
+    rand = random.Random(1)
+    names = [('U{:02d}'.format(u), s) for u in range(10) for s in ('T1', 'T2', 'H', 'P')]
+    batches = []
+    for b in range(100):
+        batch = ([], [], [])
+        for k in range(100):
+            unit, sensor = names[rand.randrange(len(names))]
+            value = 20 + rand.gauss(0, 0.3) + (rand.random() < 0.02) * 50
+            for column, x in zip(batch, (unit, sensor, value)):
+                column.append(x)
+        batches.append(batch)
+
+    legacy, current, robust = _LegacyChecker(), OutlierChecker(), OutlierChecker()
+    for unit, sensor in names:
+        legacy.add(unit, sensor, -10, 60, 5)
+        current.add(unit, sensor, -10, 60, 5)
+        robust.add(unit, sensor, -10, 60, 5, mad=5, zscore=5)
+    print('  100 items/batch, {} sensors, numpy {}'.format(
+        len(names), 'not installed' if numpy is None else numpy.__version__))
+
+    def per_item( checker ):
+        it = itertools.cycle(batches)
+        def func():
+            units, sensors, values = next(it)
+            return [checker.check(u, s, v) for u, s, v in zip(units, sensors, values)]
+        return func
+
+    def batch( checker ):
+        it = itertools.cycle(batches)
+        return lambda: checker.check_batch(*next(it))
+
+    return [('legacy check()', per_item(legacy), 100),
+            ('array check()', per_item(current), 100),
+            ('array check_batch()', batch(current), 100),
+            ('robust check()', per_item(robust), 100),
+            ('robust check_batch()', batch(robust), 100)]
+
+def bench_codec( options ):
+    """Bルート電文のデコードと値の取り出し"""
+    from keilib.broute import DataFrame, BrouteReader
+
+    length = '{:04X}'.format(len(SAMPLE_FRAME) // 2)
+
+    def legacy():
+        frame = _legacy_decode(length, SAMPLE_FRAME)
+        values = []
+        for epc, edt in frame['PROPERTIES'].items():
+            if epc == 'E7':
+                values.append(_legacy_signed_int(edt))
+            elif epc == 'E8':
+                values.append(_legacy_signed_int(edt[:4]) * 0.1)
+                values.append(_legacy_signed_int(edt[4:]) * 0.1)
+            elif epc == 'E0':
+                values.append(int(edt, 16) * 0.1)
+        return values
+
+    # BrouteReader はデバイスを開かずにデコード関数だけを使う
+    reader = BrouteReader(None, '', '', state_file=None)
+
+    def current():
+        frame = DataFrame.decode(length, SAMPLE_FRAME)
+        values = []
+        for epc, edt in frame.edt.items():
+            for sensor, value in reader.decoders[epc](epc, edt):
+                values.append(value)
+        return values
+
+    assert legacy() == current(), (legacy(), current())
+    return [('legacy (hex str)', legacy), ('bytes + struct', current)]
+
+def scenario_replay( options ):
+    """記録したシリアル通信の再生（WiSunRL7023 の受信処理）"""
+    from keilib.simulator import ReplayRL7023, load_capture
+
+    if options.get('capture'):
+        records = load_capture(options['capture'])
+    else:
+        length = '{:04X}'.format(len(SAMPLE_FRAME) // 2)
+        line = ('ERXUDP FE80:0000:0000:0000:021D:1290:1234:5678 FE80:0000:0000:0000:021D:1290:0000:0001 '
+                '0E1A 0E1A 001D129012345678 1 0 ' + length + ' ' + SAMPLE_FRAME + '\r\n').encode('ascii')
+        records = [(0, 'rx', line)] * options['number']
+    expected = len([r for r in records if r[1] == 'rx' and r[2][:6] == b'ERXUDP'])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        wisundev = ReplayRL7023(records, speed=0, sync=False, scancache=os.path.join(tmpdir, 'scan.json'))
+        frames = 0
+        start = time.perf_counter()
+        wisundev.open()
+        while not (wisundev.ser.done.is_set() and wisundev.data_que.empty()):
+            if wisundev.receive():
+                frames += 1
+        elapsed = time.perf_counter() - start
+        wisundev.close()
+
+    return [('ERXUDP lines', expected, ''),
+            ('frames decoded', frames, ''),
+            ('frames dropped (queue full)', expected - frames, ''),
+            ('throughput', frames / elapsed if elapsed else 0, 'frames/s')]
+
+def scenario_sim( options ):
+    """シミュレーターの RL7023 とスマートメーターに BrouteReader を接続"""
+    from keilib.broute import WiSunRL7023, BrouteReader
+    from keilib.simulator import SimulatedRL7023
+
+    duration = options['duration']
+    sim = SimulatedRL7023(latency=options['latency'], loss=options['loss'],
+                          time_scale=0.01, seed=1)
+    sim.start()
+    record_que = queue.Queue()
+    requests = [
+        {'epc': ['D3', 'D7', 'E1'], 'cycle': 60},
+        {'epc': ['E7'], 'cycle': 1},
+        {'epc': ['E0'], 'cycle': 5},
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        wisundev = WiSunRL7023(sim.port, 115200, scancache=os.path.join(tmpdir, 'scan.json'))
+        reader = BrouteReader(wisundev, '0' * 32, 'PASSWORD', requests=requests, record_que=record_que,
+                              tx_timeout=2, receive_timeout=5, recover_after=3,
+                              state_file=os.path.join(tmpdir, 'state.json'))
+        start = time.perf_counter()
+        reader.start()
+        join_time = None
+        outage_at = start + duration / 2
+        outage = False
+        while time.perf_counter() - start < duration:
+            if join_time is None and reader.state == reader._STATE_JOIN:
+                join_time = time.perf_counter() - start
+            if not outage and time.perf_counter() >= outage_at:
+                # 途中で 3秒間の通信断（PANA セッションも失う）を起こす
+                sim.outage(3)
+                outage = True
+            time.sleep(0.05)
+        reader.stop()
+        sim.stop()
+
+    records = 0
+    while not record_que.empty():
+        record_que.get()
+        records += 1
+    result = [('time to JOIN', join_time or 0, 's'),
+              ('SKSENDTO', sim.stats['sendto'], ''),
+              ('replied', sim.stats['replied'], ''),
+              ('lost', sim.stats['lost'], ''),
+              ('values recorded', records, '')]
+    for tier, stats in reader.recovery_stats.items():
+        if stats['count']:
+            result.append(('recovery ' + tier, '{}/{} failed {} last {:.2f}'.format(
+                stats['success'], stats['count'], stats['failed'], stats['last']), 's'))
+    return result
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'parser': bench_parser,
+    'validator': bench_validator,
+    'frame': bench_frame,
+    'checker': bench_checker,
+}
+
+SCENARIOS = {
+    'replay': scenario_replay,
+    'sim': scenario_sim,
+}
+
+def run( name, options ):
+    print('[' + name + '] ' + BENCHMARKS[name].__doc__)
+    for label, func, *size in BENCHMARKS[name](options):
+        # 3番目の要素は1回の呼び出しで処理する件数（1件あたりの時間を表示する）
+        size = size[0] if size else 1
+        number = max(1, options['number'] // size)
+        best = min(timeit.repeat(func, number=number, repeat=3)) / size
+        print('  {:<24} {:8.2f} us/call {:10.0f} calls/s'.format(label, best / number * 1e6, number / best))
+
+def run_scenario( name, options ):
+    print('[' + name + '] ' + SCENARIOS[name].__doc__)
+    for label, value, unit in SCENARIOS[name](options):
+        if isinstance(value, float):
+            value = '{:.2f}'.format(value)
+        print('  {:<28} {:>10} {}'.format(label, value, unit))
+
+def main( argv ):
+    options = {'number': 20000, 'capture': None, 'duration': 20, 'latency': 0.05, 'loss': 0.0}
+    flags = {'-n': ('number', int), '-c': ('capture', str), '-t': ('duration', float),
+             '-l': ('latency', float), '-p': ('loss', float)}
+    names = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in flags and i + 1 < len(argv):
+            key, conv = flags[argv[i]]
+            options[key] = conv(argv[i + 1])
+            i += 2
+        else:
+            names.append(argv[i])
+            i += 1
+
+    for name in names:
+        if name not in BENCHMARKS and name not in SCENARIOS:
+            print(__doc__)
+            return 1
+
+    # シミュレーターなどのログはエラーだけを表示する
+    logging.basicConfig(level=logging.ERROR)
+
+    # 名前を省略したときはベンチマークだけを実行する（シナリオは時間がかかる）
+    for name in names or sorted(BENCHMARKS):
+        if name in BENCHMARKS:
+            run(name, options)
+        else:
+            run_scenario(name, options)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -18,6 +18,9 @@ fname_base = 'mylogfile'
 
 # settings for HttpPostUploader
 upload_que = queue.Queue(50)
+# 送信できなかったデータをディスクに保存して再起動後も再送する場合
+# from keilib.spool import DiskSpool
+# upload_que = DiskSpool('spool')
 
 # upload.php のサンプルは php フォルダにある
 target_url = 'https://example.com/upload.php'
@@ -49,7 +52,10 @@ worker_def = [
         'args': {
             'upload_que': upload_que,
             'target_url': target_url,
-            'upload_key': upload_key
+            'upload_key': upload_key,
+            'min_interval': 110,    # upload.php の送信間隔の制限（100秒）に合わせる
+            # 'batch': True,        # 複数のデータをまとめ、gzip で圧縮して送る
+            # 'batch_age': 3600,    # まとめて送る間隔（秒）
         }
     },
 
@@ -18,6 +18,7 @@ SerialReader:
 import queue
 from keilib.recorder import FileRecorder
 from keilib.serial   import SerialReader
+# from keilib.serial import SerialHub
 
 #スレッド間でデータを共有する Queue
 record_que    = queue.Queue(50)
@@ -47,4 +48,15 @@ worker_def = [
             'record_que': record_que,
         }
     },
+
+    # 複数のポートを1つのスレッドで読む場合は SerialReader の代わりに SerialHub を使う
+    # （/dev/serial/by-id に現れたポートのうち pattern に一致するものを自動的に開く）
+    # {
+    #     'class': SerialHub,
+    #     'args': {
+    #         'pattern': 'usb-FTDI_*',
+    #         'baudrate': baud_rate,
+    #         'record_que': record_que,
+    #     }
+    # },
 ]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""センサー値を一定時間ごとに集計するクラスを定義
+
+1分、5分、10分、1時間など、複数の集計期間を同時に扱うことができる。
+複数のスマートメーターの値を合計する SiteAggregator もここに定義する。
+"""
+
+import time
+import queue
+import datetime
+from array import array
+
+from keilib.worker import Worker
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+# 集計スロットの各要素のインデックス
+COUNT = 0
+SUM   = 1
+MIN   = 2
+MAX   = 3
+LAST  = 4
+SUMSQ = 5
+
+def new_slot( value ):
+    """値1件から集計スロットを作成する
+
+    スロットは [count, sum, min, max, last, sum of squares] の固定長配列
+    """
+    return array('d', [1.0, value, value, value, value, value * value])
+
+def merge_slot( dst, src ):
+    """集計スロット src を dst に合算する（src の方が新しいデータとする）"""
+    dst[COUNT] += src[COUNT]
+    dst[SUM]   += src[SUM]
+    if src[MIN] < dst[MIN]:
+        dst[MIN] = src[MIN]
+    if src[MAX] > dst[MAX]:
+        dst[MAX] = src[MAX]
+    dst[LAST]  = src[LAST]
+    dst[SUMSQ] += src[SUMSQ]
+
+def slot_mean( slot ):
+    """集計スロットの平均値"""
+    return slot[SUM] / slot[COUNT]
+
+def slot_std( slot ):
+    """集計スロットの標準偏差（母標準偏差）"""
+    mean = slot[SUM] / slot[COUNT]
+    var = slot[SUMSQ] / slot[COUNT] - mean * mean
+    if var < 0.0:
+        # 丸め誤差でわずかに負になることがある
+        var = 0.0
+    return var ** 0.5
+
+def span_label( span ):
+    """集計期間（秒）を 01m, 10m, 01h のような文字列にする"""
+    if span % 3600 == 0:
+        return '{:02}h'.format(span // 3600)
+    elif span % 60 == 0:
+        return '{:02}m'.format(span // 60)
+    else:
+        return '{:02}s'.format(span)
+
+class RollingAggregator ( ):
+    """(unit, sensor) ごとに、複数の集計期間の統計値を同時に計算する
+
+    * 集計期間は spans に辞書のリストで指定する。'span' キー（秒）は必須で、
+      それ以外のキーは集計結果とともに emit にそのまま渡される。
+        例) [{'span': 60}, {'span': 600, 'prefix': 'sum'}, {'span': 3600}]
+
+    * 各集計期間は最も短い集計期間（基本期間）の整数倍であること
+
+    * 集計期間の区切りはローカル時刻の 0時0分0秒 を起点とする
+
+    * 1件のデータの追加では基本期間のスロットだけを更新するので、
+      集計期間がいくつあっても処理量は一定。基本期間が終わるごとに、
+      そのスロットを各集計期間のスロットに合算する。
+
+    * 集計期間が終わると emit(spec, start, rows) が呼び出される
+        - spec (dict): spans に指定した辞書
+        - start (datetime): 集計期間の開始時刻（ローカル時刻）
+        - rows (list): (unit, sensor, slot) のリスト
+    """
+
+    def __init__( self, spans, emit ):
+        """コンストラクタ
+
+        引数：
+            spans (list of dict): 集計期間の定義
+            emit (callable): 集計期間が終わったときに呼び出す関数
+        """
+        if not spans:
+            raise ValueError('no aggregate span is specified')
+
+        self.spans = sorted(spans, key=lambda spec: spec['span'])
+        self.base = self.spans[0]['span']
+        for spec in self.spans:
+            if spec['span'] % self.base != 0:
+                raise ValueError('span {} is not a multiple of {}'.format(spec['span'], self.base))
+        self.emit = emit
+
+        self.current = {}                                # 基本期間のスロット
+        self.accum = [{} for spec in self.spans]         # 各集計期間のスロット
+        self.window = None                               # 基本期間の開始時刻（ローカル時刻の秒）
+
+    def _local( self, ts ):
+        """UNIX時刻 ts をローカル時刻の通算秒にする"""
+        return int(ts) + time.localtime(ts).tm_gmtoff
+
+    def add( self, ts, unit, sensor, value ):
+        """データを1件追加する
+
+        引数：
+            ts (number): データのタイムスタンプ（UNIX時刻）
+            unit (str): ユニットID
+            sensor (str): センサーID
+            value (number): センサー値
+        """
+        self.tick(ts)
+        key = (unit, sensor)
+        slot = self.current.get(key)
+        if slot is None:
+            self.current[key] = new_slot(value)
+        else:
+            slot[COUNT] += 1
+            slot[SUM]   += value
+            if value < slot[MIN]:
+                slot[MIN] = value
+            if value > slot[MAX]:
+                slot[MAX] = value
+            slot[LAST]  = value
+            slot[SUMSQ] += value * value
+
+    def tick( self, ts ):
+        """時刻 ts までに終わった集計期間を確定する。定期的に呼び出すこと。
+
+        引数：
+            ts (number): 現在時刻（UNIX時刻）
+        """
+        local = self._local(ts)
+        window = local - local % self.base
+        if self.window is None:
+            self.window = window
+            return
+        if window == self.window:
+            return
+
+        # 基本期間のスロットを各集計期間に合算し、終わった集計期間を書き出す
+        for spec, accum in zip(self.spans, self.accum):
+            for key, slot in self.current.items():
+                dst = accum.get(key)
+                if dst is None:
+                    accum[key] = slot if spec is self.spans[0] else array('d', slot)
+                else:
+                    merge_slot(dst, slot)
+
+            span = spec['span']
+            start = self.window - self.window % span
+            if start != window - window % span:
+                if accum:
+                    rows = [(unit, sensor, slot) for (unit, sensor), slot in accum.items()]
+                    dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=start)
+                    try:
+                        self.emit(spec, dt, rows)
+                    except Exception as err:
+                        logger.error('aggregate emit error: ' + str(err))
+                accum.clear()
+
+        self.current = {}
+        self.window = window
+
+class SiteAggregator ( Worker ):
+    """複数のスマートメーター（ユニット）の値を合計して、サイトの合計値を記録する
+
+    in_que から受け取ったデータはそのまま record_que に渡し、units に含まれる
+    ユニットの sensors のデータであれば、ユニットごとの最新値を更新する。
+    すべてのユニットの最新値が max_age 秒以内のものであれば、合計値を
+    [site_id, sensor, 合計値, 'X'] として record_que に追加する。
+    ファイルを読み直すことなく、データが届くたびに合計値を更新する。
+
+    積算電力量の補完（DATA_ID 'H'）など、時刻を指定したデータは合計しない。
+
+    設定例:
+        site_que = queue.Queue(50)
+        record_que = queue.Queue(50)
+        # BrouteReader の record_que に site_que を指定する（unit_id は 'B1', 'B2'）
+        {'class': SiteAggregator,
+         'args': {'in_que': site_que, 'record_que': record_que, 'units': ['B1', 'B2']}}
+    """
+
+    def __init__( self, in_que, record_que, units, sensors=['E7'], site_id='SITE',
+                  max_age=60, min_interval=0 ):
+        """コンストラクタ
+
+        引数：
+            in_que (Queue): BrouteReader などからデータを受け取る Queue
+            record_que (Queue): 受け取ったデータと合計値を渡す Queue（FileRecorder など）
+            units (list of str): 合計するユニットID
+            sensors (list of str): 合計するセンサーID（瞬時電力 E7、積算電力量 E0 など）
+            site_id (str): 合計値のユニットID
+            max_age (number): 合計に使う最新値の有効期間（秒）
+            min_interval (number): 合計値を記録する最小の間隔（秒）
+        """
+        super().__init__()
+        self.in_que = in_que
+        self.record_que = record_que
+        self.units = list(units)
+        self.sensors = set(sensors)
+        self.site_id = site_id
+        self.max_age = max_age
+        self.min_interval = min_interval
+
+        # {sensor: {unit: (value, 受け取った時刻)}}
+        self.latest = {sensor: {} for sensor in self.sensors}
+        self.lasttime_emit = {}
+
+    def _update( self, unit, sensor, value, now ):
+        """ユニットの最新値を更新し、すべて揃っていれば合計値を返す（揃っていなければ None）"""
+        latest = self.latest[sensor]
+        latest[unit] = (value, now)
+        if now - self.lasttime_emit.get(sensor, 0) < self.min_interval:
+            return None
+        total = 0
+        for u in self.units:
+            entry = latest.get(u)
+            if entry is None or now - entry[1] > self.max_age:
+                return None
+            total += entry[0]
+        self.lasttime_emit[sensor] = now
+        return total
+
+    def run( self ):
+        logger.info('[START]')
+        while not self.stopEvent.is_set():
+            try:
+                item = self.in_que.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.record_que.put(item)
+
+            if len(item) != 4:
+                # 時刻を指定したデータ（補完など）は合計しない
+                continue
+            unit, sensor, value = item[0], item[1], item[2]
+            if sensor not in self.sensors or unit not in self.units:
+                continue
+            try:
+                total = self._update(unit, sensor, float(value), time.time())
+            except (TypeError, ValueError):
+                continue
+            if total is not None:
+                self.record_que.put([self.site_id, sensor, total, 'X'])
+        logger.info('[STOP]')
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""asyncio のイベントループ上で動作するワーカーの雛形と、それを動かすランタイム
+
+Worker（スレッド）の代わりに、1つのイベントループ上で複数のワーカーを動かす。
+データが来ないときにタイムアウトで起きるだけのスレッドを減らすことができる。
+
+* AsyncWorker: asyncio で動作するワーカーの抽象クラス
+* AsyncRuntime: worker_def のワーカーを1つのイベントループで動かす
+    - AsyncWorker はタスクとして動かす
+    - 従来の Worker（スレッド）は run() をスレッドプールで動かす。
+      ワーカーを1つずつ asyncio に移行することができる
+
+kei.py に --asyncio を指定すると AsyncRuntime で起動する。
+    $ python3 kei.py --asyncio
+"""
+
+import asyncio
+import queue
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+class AsyncWorker ( ):
+    """AsyncWorker はイベントループ上で動作するワーカーの抽象クラス。
+
+    サブクラスは run() をコルーチンとしてオーバーライドし、
+    self.stopped が True になるか self.wait_stop() が終わったら終了する。
+    """
+    def __init__( self ):
+        self.stopped = False
+        self._stop_event = None
+
+    def _bind( self ):
+        """イベントループ上でストップイベントを作成する（AsyncRuntime が呼び出す）"""
+        self._stop_event = asyncio.Event()
+        if self.stopped:
+            self._stop_event.set()
+
+    def stop ( self ):
+        """ストップイベントをセットする。イベントループのスレッドから呼び出すこと。"""
+        self.stopped = True
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    async def wait_stop( self, timeout=None ):
+        """ストップイベントがセットされるか timeout 秒経つまで待つ
+
+        戻り値:
+            True: ストップイベントがセットされた
+            False: タイムアウトした
+        """
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run( self ):
+        """ストップイベントがセットされていない限り、繰り返し実行する。
+        この関数はオーバーライドする。
+        """
+        while not self.stopped:
+            # do something
+            await self.wait_stop(1)
+
+def put_nowait( que, item ):
+    """queue.Queue と asyncio.Queue のどちらにも待たずにデータを追加する
+
+    戻り値:
+        True: 成功
+        False: キューがいっぱい
+    """
+    try:
+        que.put_nowait(item)
+        return True
+    except (queue.Full, asyncio.QueueFull):
+        return False
+
+async def get( que, timeout=None ):
+    """queue.Queue または asyncio.Queue からデータを取り出す
+
+    queue.Queue の場合はスレッドプールで待つので、イベントループを止めない。
+    タイムアウトした場合は queue.Empty を送出する。
+    """
+    if isinstance(que, asyncio.Queue):
+        try:
+            return await asyncio.wait_for(que.get(), timeout)
+        except asyncio.TimeoutError:
+            raise queue.Empty
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: que.get(timeout=timeout))
+
+class AsyncRuntime ( ):
+    """worker_def に定義されたワーカーを1つのイベントループ上で動かす
+
+    一定間隔でワーカーの状態を確認し、停止しているものがあれば
+    インスタンスを再度作成して再起動する（kei.py のスレッド版と同じ）
+    """
+
+    def __init__( self, worker_def, check_interval=10 ):
+        """コンストラクタ
+
+        引数：
+            worker_def (list of dict): kei.py と同じワーカーの定義
+            check_interval (number): ワーカーの状態を確認する間隔（秒）
+        """
+        self.worker_def = worker_def
+        self.check_interval = check_interval
+        self.stopped = None
+        nthreads = len([w for w in worker_def if not issubclass(w['class'], AsyncWorker)])
+        self.executor = ThreadPoolExecutor(max_workers=max(1, nthreads))
+
+    def _start( self, wdef ):
+        """ワーカーのインスタンスを作成して動かす"""
+        loop = asyncio.get_running_loop()
+        instance = wdef['class']( **wdef['args'] )
+        wdef['instance'] = instance
+        if isinstance(instance, AsyncWorker):
+            instance._bind()
+            wdef['future'] = loop.create_task(instance.run())
+        else:
+            # スレッドの Worker は start() せず、run() をスレッドプールで実行する
+            wdef['future'] = loop.run_in_executor(self.executor, instance.run)
+
+    def _stop_worker( self, wdef ):
+        instance = wdef.get('instance')
+        if instance is None:
+            return
+        if isinstance(instance, AsyncWorker):
+            instance.stop()
+        else:
+            # start() していないスレッドは join() できないのでイベントだけをセット
+            instance.stopEvent.set()
+
+    def stop( self ):
+        """すべてのワーカーにストップイベントをセットする"""
+        logger.info('Stopping all workers. Please wait ...')
+        for wdef in self.worker_def:
+            self._stop_worker(wdef)
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def _main( self ):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for signum in [signal.SIGHUP, signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self.stop)
+
+        for wdef in self.worker_def:
+            self._start(wdef)
+
+        while not self.stopped.is_set():
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.check_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            for wdef in self.worker_def:
+                future = wdef['future']
+                if future.done():
+                    if not future.cancelled() and future.exception() is not None:
+                        logger.error(wdef['class'].__name__ + ' error: ' + repr(future.exception()))
+                    logger.warning(wdef['class'].__name__ + ' worker object is stoped. restart again.')
+                    self._start(wdef)
+
+        # すべてのワーカーの終了を待つ
+        await asyncio.gather(*[wdef['future'] for wdef in self.worker_def], return_exceptions=True)
+
+    def run( self ):
+        """イベントループを開始し、すべてのワーカーが停止するまで戻らない"""
+        try:
+            asyncio.run(self._main())
+        finally:
+            self.executor.shutdown(wait=True)
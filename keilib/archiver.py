@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""記録が終わったデータファイルを圧縮して保存する
+
+* 前日以前の日付のデータファイルを圧縮してアーカイブディレクトリに移す
+    - [YYYYMMDD]-[fname_base].txt
+    - sum[YYYYMMDD]-[fname_base].txt（sum01m, sum01h なども含む）
+* 圧縮方式は zstd（zstandard モジュールがあれば）、xz、gzip
+* 保存期間、合計サイズの上限を超えた古いアーカイブは削除する
+* アーカイブは registry.json に登録しておき、open_archived() で
+  ディスクに展開せずに読み出すことができる
+* アーカイブした後で同じ日のデータファイルができた場合（スマートメーターの履歴による
+  補完など）は、既存のアーカイブの内容に追加して圧縮し直す
+"""
+
+import os
+import re
+import io
+import json
+import gzip
+import lzma
+import time
+import datetime
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from keilib.worker import Worker
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+# 圧縮方式ごとの拡張子
+EXTENSIONS = {
+    'zstd': '.zst',
+    'xz':   '.xz',
+    'gzip': '.gz',
+}
+
+# データファイル名のパターン（集計ファイルも含む）
+re_datafile = re.compile(r'^(sum[0-9a-z]*)?([0-9]{8})-(.+)\.txt$')
+
+REGISTRY = 'registry.json'
+
+def available_method( method='auto' ):
+    """使用できる圧縮方式を返す
+
+    引数：
+        method (str): 'auto', 'zstd', 'xz', 'gzip'。
+            'auto' の場合や zstandard モジュールがない場合は、使用できるものを選ぶ
+    """
+    if method == 'zstd' and zstandard is None:
+        logger.warning('zstandard module is not installed, use xz instead')
+        method = 'xz'
+    if method == 'auto':
+        method = 'zstd' if zstandard is not None else 'xz'
+    if method not in EXTENSIONS:
+        raise ValueError('unknown compression method: ' + str(method))
+    return method
+
+def _open_compressed( path, method, mode ):
+    """圧縮ファイルをバイナリモードで開く"""
+    if method == 'gzip':
+        return gzip.open(path, mode)
+    elif method == 'xz':
+        return lzma.open(path, mode)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard module is not installed')
+        f = open(path, mode)
+        if 'w' in mode:
+            return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+        else:
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    raise ValueError('unknown compression method: ' + str(method))
+
+def load_registry( archive_dir ):
+    """アーカイブの登録情報を読み出す
+
+    戻り値:
+        {元のファイル名: {'archive', 'method', 'size', 'csize', 'time'}}
+    """
+    try:
+        with open(os.path.join(archive_dir, REGISTRY), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_registry( archive_dir, registry ):
+    """アーカイブの登録情報を保存する"""
+    path = os.path.join(archive_dir, REGISTRY)
+    tmpname = path + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(registry, f, indent=1, sort_keys=True)
+    os.replace(tmpname, path)
+
+def open_archived( filename, archive_dir='archive' ):
+    """アーカイブされたデータファイルをテキストモードで開く（ディスクには展開しない）
+
+    引数：
+        filename (str): 元のデータファイル名（ディレクトリは含まない）
+        archive_dir (str): アーカイブディレクトリ
+
+    戻り値:
+        テキストのファイルオブジェクト（アーカイブがなければ None）
+    """
+    entry = load_registry(archive_dir).get(filename)
+    if entry is None:
+        return None
+    path = os.path.join(archive_dir, entry['archive'])
+    try:
+        return io.TextIOWrapper(_open_compressed(path, entry['method'], 'rb'), encoding='ascii',
+                                errors='replace')
+    except (OSError, RuntimeError) as err:
+        logger.error('cannot open archive ' + path + ': ' + str(err))
+        return None
+
+class FileArchiver ( Worker ):
+    """記録が終わったデータファイルを定期的に圧縮し、古いアーカイブを削除する
+
+    * 前日以前の日付で、最終更新から settle 秒以上経ったファイルを対象とする
+      （FileRecorder がまだ書き込み中のファイルを圧縮しないように）
+    * 圧縮に成功したら元のファイルと索引ファイル（.idx）を削除する
+    * keep_days を超えて古いアーカイブ、または合計サイズが max_bytes を
+      超えた分の古いアーカイブを削除する
+    """
+
+    def __init__( self, directory='.', archive_dir='archive', fname_base=None, method='auto',
+                  keep_days=None, max_bytes=None, interval=3600, settle=3600 ):
+        """コンストラクタ
+
+        引数：
+            directory (str):   データファイルのあるディレクトリ
+            archive_dir (str): アーカイブを保存するディレクトリ
+            fname_base (str):  指定するとこの名前のデータファイルだけを対象にする
+            method (str):      圧縮方式 'auto', 'zstd', 'xz', 'gzip'
+            keep_days (int):   アーカイブの保存日数（None なら無期限）
+            max_bytes (int):   アーカイブの合計サイズの上限（None なら無制限）
+            interval (number): 確認する間隔（秒）
+            settle (number):   最終更新からこの秒数が経ったファイルを対象とする
+        """
+        super().__init__()
+        self.directory = directory
+        self.archive_dir = archive_dir
+        self.fname_base = fname_base
+        self.method = available_method(method)
+        self.keep_days = keep_days
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.settle = settle
+
+    def _closed_files( self ):
+        """圧縮の対象となるデータファイルのリスト"""
+        today = datetime.date.today().strftime('%Y%m%d')
+        now = time.time()
+        files = []
+        for name in sorted(os.listdir(self.directory)):
+            m = re_datafile.match(name)
+            if not m:
+                continue
+            if self.fname_base is not None and m.group(3) != self.fname_base:
+                continue
+            if m.group(2) >= today:
+                continue
+            path = os.path.join(self.directory, name)
+            if now - os.stat(path).st_mtime < self.settle:
+                continue
+            files.append(name)
+        return files
+
+    def _compress( self, name, registry ):
+        """データファイルを1つ圧縮して登録する
+
+        すでに同じファイル名のアーカイブがあれば、その内容の後にデータファイルを追加する
+        """
+        src = os.path.join(self.directory, name)
+        archive = name + EXTENSIONS[self.method]
+        dst = os.path.join(self.archive_dir, archive)
+        tmpname = dst + '.tmp'
+        old = registry.get(name)
+        size = 0
+
+        with _open_compressed(tmpname, self.method, 'wb') as fout:
+            if old is not None:
+                with _open_compressed(os.path.join(self.archive_dir, old['archive']), old['method'], 'rb') as fin:
+                    shutil.copyfileobj(fin, fout, 64 * 1024)
+                size = old['size']
+                logger.info('merge ' + name + ' into the existing archive')
+            with open(src, 'rb') as fin:
+                shutil.copyfileobj(fin, fout, 64 * 1024)
+        with open(tmpname, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmpname, dst)
+        if old is not None and old['archive'] != archive:
+            # 圧縮方式を変えた場合は古いアーカイブを削除
+            try:
+                os.remove(os.path.join(self.archive_dir, old['archive']))
+            except OSError:
+                pass
+
+        size += os.stat(src).st_size
+        csize = os.stat(dst).st_size
+        registry[name] = {'archive': archive, 'method': self.method,
+                          'size': size, 'csize': csize, 'time': int(time.time())}
+        save_registry(self.archive_dir, registry)
+
+        # 登録が済んでから元のファイルを削除
+        os.remove(src)
+        try:
+            os.remove(src + '.idx')
+        except OSError:
+            pass
+        logger.info('archive ' + name + ' ' + str(size) + ' -> ' + str(csize) + ' bytes')
+
+    def _expire( self, registry ):
+        """保存期間、合計サイズの上限を超えたアーカイブを削除する"""
+        def day_of( name ):
+            m = re_datafile.match(name)
+            return m.group(2) if m else ''
+
+        # 日付の古い順
+        names = sorted(registry.keys(), key=day_of)
+        expired = []
+        if self.keep_days is not None:
+            limit = (datetime.date.today() - datetime.timedelta(days=self.keep_days)).strftime('%Y%m%d')
+            for name in names:
+                if day_of(name) < limit:
+                    expired.append(name)
+
+        if self.max_bytes is not None:
+            total = sum(registry[name]['csize'] for name in names if name not in expired)
+            for name in names:
+                if total <= self.max_bytes:
+                    break
+                if name not in expired:
+                    expired.append(name)
+                    total -= registry[name]['csize']
+
+        for name in expired:
+            try:
+                os.remove(os.path.join(self.archive_dir, registry[name]['archive']))
+            except OSError:
+                pass
+            del registry[name]
+            logger.info('remove archive ' + name)
+        if expired:
+            save_registry(self.archive_dir, registry)
+
+    def archive( self ):
+        """圧縮と古いアーカイブの削除を1回行う"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        registry = load_registry(self.archive_dir)
+        for name in self._closed_files():
+            if self.stopEvent.is_set():
+                break
+            try:
+                self._compress(name, registry)
+            except OSError as err:
+                logger.error('archive error ' + name + ': ' + str(err))
+        self._expire(registry)
+
+    def run( self ):
+        logger.info('[START] method=' + self.method)
+        while not self.stopEvent.is_set():
+            self.archive()
+            self.stopEvent.wait(self.interval)
+        logger.info('[STOP]')
@@ -4,14 +4,18 @@
 """
 
 import sys
+import re
 import serial
 import time
 import datetime
 import os
 import json
+import struct
+import heapq
 import threading
 import queue
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 from keilib.worker import Worker
 
@@ -41,6 +45,8 @@ reginfo = {
     'SFF': 'auto load',#'オートロード(0:無効、1:有効)'
 }
 
+_HEXDIGITS = '0123456789ABCDEF'
+
 def is_hex( data, length=0 ):
     """妥当な16進数かどうかをチェック
     引数:
@@ -52,10 +58,9 @@ def is_hex( data, length=0 ):
     if length:
         if len(data) != length:
             return False
-    for ch in data:
-        if not ch in '0123456789ABCDEF':
-            return False
-    return True
+    # 両端から16進文字を取り除き、何も残らなければすべて16進文字
+    # （途中に16進以外の文字があれば、そこで止まって残る）
+    return not data.strip(_HEXDIGITS)
 
 def is_ipv6_address( addr ):
     """妥当なipv6アドレスであるかチェック
@@ -84,10 +89,66 @@ def hex_to_signed_int(value, digit=0):
     """
     if digit == 0:
         digit = len(value)
-    digit2 = digit * 4
-    fmtstr = '{:0' + str(digit2) + 'b}'
-    bits = fmtstr.format(int(value,16))
-    return -int(bits[0]) << digit2 | int(bits, 2)
+    bits = digit * 4
+    result = int(value, 16)
+    if result >> (bits - 1) & 1:
+        result -= 1 << bits
+    return result
+
+# SK コマンドのイベント行の正規表現（検査と項目の取り出しを1回で行う）
+_IPV6_PATTERN = rb'[0-9A-F]{4}(?::[0-9A-F]{4}){7}'
+_ERXUDP_PATTERN = (rb'ERXUDP (?P<SENDER>' + _IPV6_PATTERN + rb') (?P<DEST>' + _IPV6_PATTERN + rb')'
+                   rb' (?P<RPORT>[0-9A-F]{4}) (?P<LPORT>[0-9A-F]{4}) (?P<SENDERLLA>[0-9A-F]{16})'
+                   rb' (?P<SECURED>[0-9A-F])%s (?P<DATALEN>[0-9A-F]{4}) (?P<DATA>[0-9A-F]+)')
+_ERXUDP_DSS = re.compile(_ERXUDP_PATTERN % rb' [0-9A-F]')     # SIDE あり
+_ERXUDP_IPS = re.compile(_ERXUDP_PATTERN % rb'')
+_EVENT = re.compile(rb'EVENT (?P<NUM>[0-9A-F]{2}) (?P<SENDER>\S+)(?: .*)?')
+_PANDESC = re.compile(rb'  (?P<KEY>[A-Za-z ]+):(?P<VALUE>\S+)')
+
+# 0x00 - 0xFF の2桁の16進表記
+_HEX2 = ['{:02X}'.format(i) for i in range(256)]
+
+# プロパティ値（EDT）のデコードに使う構造体
+_INT32 = struct.Struct('>i')
+_UINT32 = struct.Struct('>I')
+_INT16X2 = struct.Struct('>hh')
+_DATETIME_UINT32 = struct.Struct('>HBBBBBI')   # 年月日時分秒 + 積算電力量
+_HISTORY = struct.Struct('>H48I')               # 収集日 + 30分ごとの積算電力量 48コマ
+
+# 積算電力量計測値履歴（E2, E4）の値がないコマ
+HISTORY_NO_DATA = 0xFFFFFFFE
+
+def decode_property_map( edt ):
+    """プロパティマップ（9D, 9E, 9F）をプロパティコードの集合に変換する
+
+    先頭1バイトがプロパティの数。16未満の場合は続いてプロパティコードが並び、
+    16以上の場合は続く16バイトのビットマップで表す
+    （バイト i のビット j がプロパティコード 0x80 + j * 16 + i）。
+    """
+    if not edt:
+        return set()
+    count = edt[0]
+    if count < 16:
+        return {_HEX2[code] for code in edt[1 : 1 + count]}
+    props = set()
+    for i, bits in enumerate(edt[1:17]):
+        for j in range(8):
+            if bits >> j & 1:
+                props.add(_HEX2[0x80 + j * 16 + i])
+    return props
+
+# 積算電力量単位（E1）
+ENERGY_UNIT = {
+    0x00: 1.0,
+    0x01: 0.1,
+    0x02: 0.01,
+    0x03: 0.001,
+    0x04: 0.0001,
+    0x0A: 10.0,
+    0x0B: 100.0,
+    0x0C: 1000.0,
+    0x0D: 10000.0,
+}
 
 class WiSunDevice ( metaclass=ABCMeta ):
     """WiSUN デバイスドライバ抽象クラス
@@ -117,8 +178,9 @@ class WiSunDevice ( metaclass=ABCMeta ):
         pass
 
     @abstractmethod
-    def scan( self ):
+    def scan( self, cache=True ):
         """アクティブスキャンの実行、結果の保持
+        引数: cache False のときは前回の結果を使わずにスキャンする
         戻り値: True（成功）/False（失敗）
         """
         pass
@@ -167,49 +229,190 @@ class WiSunDevice ( metaclass=ABCMeta ):
         """
         pass
 
+    def restore( self ):
+        """前回のスキャン結果をスキャンせずにデバイスに設定する（reset, setup の後に呼ぶ）
+        対応しないデバイスは False を返す（BrouteReader はスキャンからやり直す）
+        戻り値: True（成功）/False（失敗）
+        """
+        return False
+
+    def session_event( self ):
+        """receive() で受け取ったセッションの失効や終了のイベントを取り出す
+        対応しないデバイスは None を返す
+        戻り値: イベントの番号（str）/None（なければ）
+        """
+        return None
+
+class _Exchange ( ):
+    """SKコマンド1回分のやり取り
+
+    handler(line) に受信した行を順に渡し、None 以外が返されたら
+    それを結果として future を完了させる。
+    events はコマンドの応答として待つ EVENT の番号（それ以外の EVENT は data_que にも入る）
+    """
+    def __init__( self, handler, events=() ):
+        self.handler = handler
+        self.events = events
+        self.future = Future()
+
+    def feed( self, line ):
+        if self.future.done():
+            return
+        try:
+            result = self.handler(line)
+        except Exception as err:
+            self.future.set_exception(err)
+            return
+        if result is not None:
+            self.future.set_result(result)
+
 class WiSunRL7023 ( WiSunDevice ):
     """RL7023 Stick-D 用デバイスドライバ
 
     テセラテクノロジーの HEMS 用 Wi-SUN モジュール Route-B/HAN デュアル対応
     RL7023 Stick-D/DSS または シングルタイプの D/IPS を制御するクラス。
+
+    シリアルポートは open() で起動する受信スレッドだけが読み出す。
+        * ERXUDP（スマートメーターからの電文）は data_que に入れ、receive() で取り出す
+        * それ以外の行（OK, FAIL, ESREG, EVENT など）は実行中のコマンドに渡し、
+          コマンドの完了を future で待つ
+        * コマンドを実行していないときのイベントと、コマンドの応答ではない EVENT
+          （EVENT 29 セッションの失効など）も data_que に入れる
+    コマンドの実行中に届いた電文やイベントも失われない。
+    セッションの失効や終了のイベントは receive() が記録し、session_event() で取り出す。
     """
     IPS=0
     DSS=1
-    def __init__( self, port, baud , type=DSS):
+
+    # スキャンの段階 (対象, スキャン時間)
+    #   'last': 前回のチャンネル, 'known': 履歴にあるチャンネル, 'all': 全チャンネル
+    SCAN_STEPS = [('last', 4), ('known', 5), ('all', 7)]
+
+    # スキャン履歴に保存する件数
+    SCAN_HISTORY_MAX = 50
+
+    # セッションが使えなくなったことを示すイベント
+    SESSION_EVENTS = {
+        '24': 'PANA authentication failed',
+        '26': 'session terminate requested',
+        '27': 'session terminated',
+        '28': 'session terminate timeout',
+        '29': 'session expired',
+    }
+
+    def __init__( self, port, baud , type=DSS, scancache='scancache.json', capture=None ):
         """コンストラクタ
         引数:
             port (str): RL7023 のシリアルポートを示すファイルパス
             baud (int): 通信ボーレート
+            scancache (str): スキャン結果の履歴を保存するファイル
+            capture (str): シリアルポートの送受信を記録するファイル（keilib/simulator.py で再生できる）
         """
         self.port = port
         self.baud = baud
         self.type = type
+        self.scancache = scancache
+        self.capture = capture
         self.register = {}
         self.scanresult = {}
+        self.ser = None
 
+        # タイムアウト（秒）
         self._TIMEOUT_MAX = 20
+        self._TIMEOUT_JOIN = 60
         self._TIMEOUT_SCAN = 300
 
-    def _wait_ok( self ):
-        """デバイスから返り値 OK を待つ
+        # 受信スレッドとコマンドのやり取り
+        self.data_que = queue.Queue(maxsize=1000)
+        self.reader = None
+        self.reader_stop = threading.Event()
+        self.exchange = None
+        self.exchange_lock = threading.Lock()
+        self.command_lock = threading.Lock()
+        self.lost_event = None
+
+    def _read_loop( self ):
+        """受信スレッド: 1行ずつ読み取り、ERXUDP は data_que へ、それ以外は実行中のコマンドへ渡す
+
+        コマンドの応答ではない EVENT は、コマンドに渡したうえで data_que にも入れる
+        """
+        while not self.reader_stop.is_set():
+            try:
+                line = self.ser.readline()
+            except (serial.SerialException, OSError, TypeError) as err:
+                if not self.reader_stop.is_set():
+                    logger.error('serial read error: ' + str(err))
+                    self.reader_stop.wait(1)
+                continue
+            line = line.rstrip(b'\r\n')
+            if not line.strip():
+                continue
+
+            if line[:6] != b'ERXUDP':
+                with self.exchange_lock:
+                    exchange = self.exchange
+                if exchange is not None:
+                    exchange.feed(line)
+                    if line[:5] != b'EVENT' or line[6:8] in exchange.events:
+                        continue
+
+            event = self._parse_event(line.strip())
+            if not event:
+                continue
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('---- event info -----')
+                logger.debug(line.decode('ascii', errors='replace'))
+                logger.debug(event)
+            try:
+                self.data_que.put_nowait(event)
+            except queue.Full:
+                logger.warning('data queue is full, event dropped')
+
+    def _command( self, cmd, handler, timeout=None, events=() ):
+        """コマンドを送り、handler が結果を返すまで待つ
+
+        引数:
+            cmd (bytes): 送信するコマンド
+            handler (function): 受信した行（bytes）を受け取り、完了したら None 以外を返す
+            timeout (number): タイムアウト（秒）省略時は _TIMEOUT_MAX
+            events (tuple of bytes): コマンドの応答として待つ EVENT の番号 例) (b'21',)
+
+        戻り値:
+            handler が返した結果（タイムアウトの場合は None）
+        """
+        if timeout is None:
+            timeout = self._TIMEOUT_MAX
+        exchange = _Exchange(handler, events)
+        with self.command_lock:
+            with self.exchange_lock:
+                self.exchange = exchange
+            try:
+                self.ser.write(cmd)
+                return exchange.future.result(timeout)
+            except FutureTimeoutError:
+                logger.debug('time out')
+                return None
+            finally:
+                with self.exchange_lock:
+                    self.exchange = None
+
+    def _command_ok( self, cmd ):
+        """コマンドを送り、デバイスから返り値 OK を待つ
         戻り値:
             True: OKを得られた
-            False: OK以外の文字を得たかタイムアウトした
+            False: FAILを得たかタイムアウトした
         """
-        toc = 0
-        while True:
-            res = self.ser.readline()
-            if res[:2] == b'OK':
+        def handler( line ):
+            if line[:2] == b'OK':
                 logger.debug('OK')
                 return True
-            elif res ==  b'':
-                toc += 1
-                if toc > self._TIMEOUT_MAX:
-                    logger.debug('time out')
-                    return False
-            else:
-                # それ以外は読み飛ばし。エコーバック等が来る
-                pass
+            elif line[:4] == b'FAIL':
+                logger.debug(line.decode('ascii', errors='replace'))
+                return False
+            # それ以外は読み飛ばし。エコーバック等が来る
+            return None
+
+        return bool(self._command(cmd.encode('ascii'), handler))
 
     def _set_panid( self, pan_id ):
         """デバイスのレジスタ（S3）に Pan ID をセットする
@@ -220,11 +423,7 @@ class WiSunRL7023 ( WiSunDevice ):
         """
         cmd = 'SKSREG S3 ' + pan_id + '\r\n'
         logger.info(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        if self._wait_ok():
-            return True
-        else:
-            return False
+        return self._command_ok(cmd)
 
     def _set_channel( self, channel ):
         """デバイスのレジスタ（S2）に Channel をセットする
@@ -235,22 +434,13 @@ class WiSunRL7023 ( WiSunDevice ):
         """
         cmd = 'SKSREG S2 ' + channel + '\r\n'
         logger.info(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        if self._wait_ok():
-            return True
-        else:
-            return False
-
-    def _readline( self ):
-        """SKデバイスから１行読み込む
-
-        戻り値:
-            読み込みデータ
-        """
-        return self.ser.readline()
+        return self._command_ok(cmd)
 
     def _parse_event( self, line ):
-        """読み取った一行のイベントデータを、スペースを区切り文字として分解し、チェックして辞書に登録
+        """読み取った一行のイベントデータを、イベントごとの正規表現で検査して辞書に登録
+
+        引数:
+            line (bytes): 前後の空白を取り除いた一行
 
         戻り値:
             変換した結果辞書（空の文字列に対しては空の辞書を返す）
@@ -258,17 +448,6 @@ class WiSunRL7023 ( WiSunDevice ):
         ToDo:
             ERXUDP, EVENT 以外のイベントへの対応
         """
-        # 有効でないASCII文字コードを含む場合は終了
-        for b in line:
-            if b >= 0x80:
-                return {'NAME': 'INVALID_EVENT'}
-
-        # 行をリストに変換
-        list = line.decode('ascii').strip().split()
-        if len(list) == 0:
-            return {}
-
-
         # 1. ERXUDP イベントの場合
         # ERXUDP <SENDER> <DEST> <RPORT> <LPORT> <SENDERLLA> <SECURED> <SIDE> <DATALEN> <DATA><CRLF>
         # 0      1         2      3       4       5           6         7      8         9
@@ -281,7 +460,7 @@ class WiSunRL7023 ( WiSunDevice ):
             4 <LPORT>     0E1A
             5 <SENDERLLA> XXXXXXXXXXXXXXXX
             6 <SECURED>   1
-            7 <SIDE>      0
+            7 <SIDE>      0     （D/IPS にはない）
             8 <DATALEN>   0012
             9 <DATA>      1081000102880105FF017201E704000004A5
         <DATA> 部が Echonet データフレーム
@@ -289,99 +468,34 @@ class WiSunRL7023 ( WiSunDevice ):
         参考文献:
             SKIP_Command_dse_v1_02a.pdf（商品を購入して、製品登録すれば入手できる）
         """
-        if list[0] == 'ERXUDP':
-            idx = 0
-            if self.type == self.DSS:
-                length = 10
-            else:
-                length = 9
-
-            # データ数のチェック
-            if len(list) != length:
-                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-
-            # IPV6 アドレスとして正しいかどうかチェック
-            for i in [1,2]:
-                if not is_ipv6_address(list[i]):
-                    logger.debug('invalid IPV6')
-                    return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-
-            # ポート番号、4byte であるか
-            for i in [3,4]:
-                if not is_hex(list[i], length=4):
-                    logger.debug('invalid PORT')
-                    return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-
-            # SENDERLLA ローカルアドレスが 16byte であるか
-            if not is_hex(list[5], length=16):
-                logger.debug('invalid SENDERLLA')
-                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-
-            # SECURED、が 1byte であるか
-            if not is_hex(list[6], length=1):
-                logger.debug('invalid SECURED')
-                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-
-            idx = 7
-            if self.type == self.DSS:
-                # SIDE が 1byte であるか
-                if not is_hex(list[7], length=1):
-                    logger.debug('invalid SIDE')
-                    return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-                idx = 8
-            else:
-                idx = 7
-
-            # DATALEN が 4byte であるか
-            if not is_hex(list[idx], length=4):
-                logger.debug('invalid DATALEN')
-                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
+        if line[:6] == b'ERXUDP':
+            pattern = _ERXUDP_DSS if self.type == self.DSS else _ERXUDP_IPS
+            match = pattern.fullmatch(line)
+            if match is None:
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug('invalid ERXUDP: ' + line.decode('ascii', errors='replace'))
+                return {'NAME': 'INVALID_ERXUDP', 'LIST': line.decode('ascii', errors='replace').split()}
+            event = {key: value.decode('ascii') for key, value in match.groupdict().items()}
+            event['NAME'] = 'ERXUDP'
+            return event
 
-            # DATAが HEX 値として読み取れる文字列か
-            if not is_hex(list[idx+1]):
-                logger.debug('invalid DATA')
-                return {'NAME': 'INVALID_ERXUDP', 'LIST': list}
-
-            dict = {'NAME':list[0], 'SENDER': list[1], 'DEST': list[2], 'RPORT': list[3],
-                    'LPORT': list[4], 'SENDERLLA': list[5], 'SECURED': list[6],
-                    'DATALEN': list[idx], 'DATA': list[idx+1]}
-
-            return dict
+        # 有効でないASCII文字コードを含む場合は終了
+        if not line.isascii():
+            return {'NAME': 'INVALID_EVENT'}
 
         # 2. EVENT の場合
-        elif list[0] == 'EVENT':
-            if len(list) < 3:
+        if line[:5] == b'EVENT':
+            match = _EVENT.fullmatch(line)
+            if match is None:
                 return {}
-
-            #dict = {'NAME': list[0], 'NUM': list[1], 'SENDER': list[2], 'SIDE': list[3]}
-            dict = {'NAME': list[0], 'NUM': list[1], 'SENDER': list[2]}
-            #if len(list) > 3:
-            #    dict['PARAM'] = list[4]
-            #    return dict
-            return dict
+            return {'NAME': 'EVENT', 'NUM': match.group('NUM').decode('ascii'),
+                    'SENDER': match.group('SENDER').decode('ascii')}
 
         # 3. その他のイベントの場合（EPONG, EADDR, ENEIGHBOR, EPANDESC, EEDSCAN, ESEC, ENBR）
-        else:
-            return {'NAME': 'OTHER_EVENT', 'LIST': list}
-
-        return dict
-
-    def _get_event( self ):
-        """デバイスからイベントを読み取る
-
-        戻り値:
-            読み込んだイベント辞書（タイムアウトの場合は空の辞書）
-        """
-        # SKデバイスから一行読み取る。タイムアウト設定あり。self._readline()
-        line = self._readline().strip()
-        event = self._parse_event(line)
-
-        if event:
-            logger.debug('---- event info -----')
-            logger.debug(line.decode('ascii'))
-            logger.debug(event)
-
-        return event
+        list = line.decode('ascii').split()
+        if len(list) == 0:
+            return {}
+        return {'NAME': 'OTHER_EVENT', 'LIST': list}
 
     def _set_password( self, broute_pwd ):
         """デバイスにパスワードを登録する
@@ -391,11 +505,7 @@ class WiSunRL7023 ( WiSunDevice ):
         """
         cmd = 'SKSETPWD C ' + broute_pwd + '\r\n'
         logger.debug(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        if self._wait_ok():
-            return True
-        else:
-            return False
+        return self._command_ok(cmd)
 
     def _set_id( self, broute_id ):
         """デバイスにBルート認証IDを登録する
@@ -405,69 +515,122 @@ class WiSunRL7023 ( WiSunDevice ):
         """
         cmd = 'SKSETRBID ' + broute_id + '\r\n'
         logger.debug(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        if self._wait_ok():
-            return True
-        else:
-            return False
+        return self._command_ok(cmd)
 
     def _get_registers( self ):
         """デバイスのレジスタの値を読み出して記憶する。"""
         for key, description in sorted(reginfo.items()):
             cmd = 'SKSREG ' + key + '\r\n'
-            self.ser.write(cmd.encode('ascii'))
 
-            toc = 0
-            while True:
-                res = self.ser.readline()
-                if res[:6] == b'ESREG ':
-                    val = res.decode('ascii').strip().split()[1]
+            def handler( line ):
+                if line[:6] == b'ESREG ':
+                    val = line.decode('ascii').strip().split()[1]
                     self.register[key] = val
                     logger.info(key + ' ' + description + ' : ' + val )
+                elif line[:2] == b'OK' or line[:4] == b'FAIL':
+                    return True
+                return None
 
-                else:
-                    pass
+            self._command(cmd.encode('ascii'), handler, timeout=5)
 
-                if res[:2] == b'OK':
-                    break
+    def _load_scanhistory( self ):
+        """スキャン結果の履歴を読み出す
 
-                toc += 1
-                if toc > 5:
-                    break
+        戻り値:
+            {'last': 最後のスキャン結果, 'history': [スキャン結果, ...]}
+            スキャン結果には 'time'（スキャンした時刻）を含む
+        """
+        try:
+            with open(self.scancache, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {'last': {}, 'history': []}
+        if 'history' not in data:
+            # 以前の形式（最後のスキャン結果のみ）
+            if {'Pan ID','Channel','Addr'} <= data.keys():
+                data['time'] = os.stat(self.scancache).st_mtime
+                return {'last': data, 'history': [data]}
+            return {'last': {}, 'history': []}
+        return data
+
+    def _save_scanhistory( self, scanresult ):
+        """スキャン結果を履歴に追加して保存する"""
+        data = self._load_scanhistory()
+        entry = dict(scanresult)
+        entry['time'] = datetime.datetime.now().timestamp()
+        data['last'] = entry
+        data['history'] = (data['history'] + [entry])[-self.SCAN_HISTORY_MAX:]
+        tmpname = self.scancache + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmpname, self.scancache)
 
     def _scancache( self ):
         """スキャン結果のキャッシュが一時間以内であれば、それを使う"""
-        if os.path.exists('scancache.json'):
-            mtime = os.stat('scancache.json').st_mtime
-            now = datetime.datetime.now().timestamp()
-            json_data = {}
-            if now - mtime < 3600:
+        last = self._load_scanhistory()['last']
+        if {'Pan ID','Channel','Addr'} <= last.keys():
+            if datetime.datetime.now().timestamp() - last.get('time', 0) < 3600:
+                return {key: value for key, value in last.items() if key != 'time'}
+        return {}
+
+    def _scan_masks( self ):
+        """スキャンの段階ごとのチャンネルマスクとスキャン時間のリスト
+
+        前回のチャンネル、履歴にあるチャンネルを短いスキャン時間で先に試し、
+        最後に全チャンネルをスキャンする。
+        """
+        data = self._load_scanhistory()
+
+        def mask_of( entries ):
+            mask = 0
+            for entry in entries:
                 try:
-                    with open("scancache.json", 'r') as f:
-                        json_data = json.load(f)
-                    if {'Pan ID','Channel','Addr'} <= json_data.keys():
-                        return json_data
-                    else:
-                        os.remove('scancache.json')
-                        return {}
-                except:
-                    return {}
+                    channel = int(entry['Channel'], 16)
+                except (KeyError, ValueError):
+                    continue
+                if 33 <= channel <= 64:
+                    # 最下位ビットが ch33
+                    mask |= 1 << (channel - 33)
+            return mask
+
+        steps = []
+        used = 0
+        for target, duration in self.SCAN_STEPS:
+            if target == 'last':
+                mask = mask_of([data['last']]) if data['last'] else 0
+            elif target == 'known':
+                mask = mask_of(data['history'])
             else:
-                return{}
-        else:
-            return {}
-
-    def _scanexec( self ):
+                mask = 0xFFFFFFFF
+            # 対象のチャンネルがない、または前の段階と同じなら省略
+            if mask == 0 or mask == used:
+                continue
+            steps.append(('{:08X}'.format(mask), duration))
+            used = mask
+        return steps
+
+    def _scantargeted( self ):
+        """前回のチャンネルから順に範囲を広げてアクティブスキャンを行う"""
+        for mask, duration in self._scan_masks():
+            logger.info('scan mask=' + mask + ' duration=' + str(duration))
+            scanresult = self._scanexec(mask, duration)
+            if scanresult:
+                return scanresult
+        return {}
+
+    def _scanexec( self, mask='FFFFFFFF', duration=7 ):
         """アクティブスキャンを実施する
 
+        引数:
+            mask (str): スキャンするチャンネルを指定するマスク(32bit) 最下位ビットが ch33
+            duration (int): スキャン時間 1増えると2倍の時間がかかる
+
         ToDo:
             sideを省略すれば片面用になるか？
         """
 
         # SKSCANコマンドの設定
         mode     = 2 # アクティブスキャン（Information Element あり）
-        mask     = 'FFFFFFFF' # スキャンするチャンネルを指定するマスク(32bit) 最下位ビットが ch33
-        duration = 7 # スキャン時間 1増えると2倍の時間がかかる
         side     = 0 # 0: B route
 
         scanresult = {}
@@ -480,28 +643,22 @@ class WiSunRL7023 ( WiSunDevice ):
                             + str(duration) + '\r\n'
 
         logger.info(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        # デバイスからOKが返されるのを待つ
-        if not self._wait_ok():
-            return False
 
-        # Step2 スキャン結果がイベントとして返されるのを待つ
+        # Step2 デバイスからOKが返された後、スキャン結果がイベントとして返されるのを待つ
         # 様々なイベントが発生するのでそれぞれ処理する
-        toc = 0
-        while True:
-            # 一行読み取る（タイムアウト1秒）
-            res = self.ser.readline()
-
-            if res == b'':
-                # データ無し。タイムアウト時など。
-                toc += 1
-                if toc > self._TIMEOUT_SCAN:
-                    return False
+        def handler( res ):
+            if res[:2] == b'OK':
+                # コマンド受付
+                return None
+
+            elif res[:4] == b'FAIL':
+                logger.info(res.decode('ascii', errors='replace'))
+                return False
 
             elif res[:8] == b'EVENT 22':
-                # EVENT 22:アクティブスキャンが完了 -> ループ終了
+                # EVENT 22:アクティブスキャンが完了 -> 終了
                 logger.info('EVENT: 22')
-                break
+                return True
 
             elif res[:8] == b'EVENT 20':
                 # EVENT 20:Beaconを受信した
@@ -516,41 +673,68 @@ class WiSunRL7023 ( WiSunDevice ):
                 # EPANDESC イベントに続いてスキャン結果が流れてくるので読み込んでゆく
                 # 行頭のスペース2個に続いて [param]：[value]+<crlf>が繰り返して送られる
                 # [param] = "Channel","Channel Page","Pan ID","Addr","LQI","PairID"
-                lst = res.decode('ascii').strip().split(':')
-                logger.info('  ' + res.decode('ascii').strip())
-                scanresult[lst[0]] = lst[1]
+                match = _PANDESC.fullmatch(res.rstrip())
+                if match is None:
+                    logger.info('Invalid EPANDESC : ' + res.decode('ascii', errors='replace'))
+                    return None
+                key, value = match.group('KEY').decode('ascii'), match.group('VALUE').decode('ascii')
+                logger.info('  ' + key + ':' + value)
+                scanresult[key] = value
+
+            elif res[:4] != b'SKSC':
+                # エコーバック以外
+                logger.info('Unkown EVENT : ' + res.decode('ascii', errors='replace'))
+            return None
 
-            else:
-                logger.info('Unkown EVENT : ' + res.decode('ascii'))
+        if not self._command(cmd.encode('ascii'), handler, timeout=self._TIMEOUT_SCAN, events=(b'20', b'22')):
+            return False
 
         logger.debug('active scan result')
         logger.debug(scanresult)
         if {'Pan ID','Channel','Addr'} <= scanresult.keys():
             # スキャン結果に必要な情報が含まれている場合
-            with open("scancache.json", 'w') as f:
-                # スキャン結果のキャッシュへの書込み
-                json.dump(scanresult, f, indent=4)
+            try:
+                # スキャン結果の履歴への書込み
+                self._save_scanhistory(scanresult)
+            except OSError as err:
+                logger.warning('cannot save scan history: ' + str(err))
             return scanresult
 
         else:
             return {}
 
-    def open( self ):
-        """ デバイスのシリアルポートをオープンする。
-        """
-        self.ser = serial.Serial(
+    def _open_serial( self ):
+        """シリアルポートのオブジェクトを作成する（記録の再生ではオーバーライドする）"""
+        return serial.Serial(
             port     = self.port,
             baudrate = self.baud,
             bytesize = serial.EIGHTBITS,
             parity   = serial.PARITY_NONE,
             stopbits = serial.STOPBITS_ONE,
-            timeout  = 1,
+            timeout  = 0.5,
             xonxoff  = False,
             rtscts   = False,
             dsrdtr   = False
         )
+
+    def open( self ):
+        """ デバイスのシリアルポートをオープンする。
+        """
+        self.ser = self._open_serial()
         # self.ser.timeout = 1
         logger.info('SKDevice open port={}, baud={}'.format(self.port, self.baud))
+        if self.capture:
+            # 送受信の記録
+            from keilib.simulator import CaptureSerial
+            self.ser = CaptureSerial(self.ser, self.capture)
+            logger.info('capture serial data to ' + self.capture)
+
+        # 受信スレッドの起動（前回の受信データは捨てる）
+        self.data_que = queue.Queue(maxsize=1000)
+        self.lost_event = None
+        self.reader_stop.clear()
+        self.reader = threading.Thread(target=self._read_loop, name='WiSunRL7023-reader', daemon=True)
+        self.reader.start()
         return True
 
     def reset( self ):
@@ -561,11 +745,7 @@ class WiSunRL7023 ( WiSunDevice ):
         """
         cmd = 'SKRESET\r\n'
         logger.debug(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        if self._wait_ok():
-            return True
-        else:
-            return False
+        return self._command_ok(cmd)
 
     def setup( self, id, password ):
         """デバイスにBルートIDおよびパスワードを登録し、スキャンの前準備
@@ -580,8 +760,12 @@ class WiSunRL7023 ( WiSunDevice ):
         else:
             return False
 
-    def scan( self ):
+    def scan( self, cache=True ):
         """アクティブスキャンを実行する。結果を self.scanresult 辞書に格納
+
+        引数:
+            cache (bool): False のときはキャッシュを使わずにスキャンする
+
         戻り値:
             True: 成功
             False: 失敗
@@ -589,14 +773,33 @@ class WiSunRL7023 ( WiSunDevice ):
         self.scanresult   = {}
 
         # Step1 スキャン結果のキャッシュがあればそれを使う,なければスキャン実行
-        self.scanresult = self._scancache()
+        if cache:
+            self.scanresult = self._scancache()
         if not self.scanresult:
-            self.scanresult = self._scanexec()
+            self.scanresult = self._scantargeted()
             if not self.scanresult:
                 # スキャン失敗
                 return False
 
         # Step2 スキャン結果を使ったデバイスの設定（通信先の情報を設定する）
+        return self._apply_scanresult()
+
+    def restore( self ):
+        """前回のスキャン結果（PAN ID, チャンネル, アドレス）をスキャンせずにデバイスに設定する
+        戻り値:
+            True: 成功
+            False: 失敗（スキャン結果がない）
+        """
+        if not self.scanresult:
+            self.scanresult = self._scancache()
+        return self._apply_scanresult()
+
+    def _apply_scanresult( self ):
+        """スキャン結果をデバイスに設定し、通信先の IPv6 アドレスを求める
+        戻り値:
+            True: 成功
+            False: 失敗
+        """
         if {'Pan ID', 'Channel', 'Addr'} <= self.scanresult.keys():
             # スキャン結果の核心部がちゃんと取得できてる
 
@@ -607,9 +810,20 @@ class WiSunRL7023 ( WiSunDevice ):
             # SKLL64コマンド: 64ビットMACアドレスをIP_V6アドレスに変換する
             cmd = 'SKLL64 ' + self.scanresult['Addr'] + '\r\n'
             logger.info(cmd.strip())
-            self.ser.write(cmd.encode('ascii'))
-            self.ser.readline() #エコーバック読み飛ばし
-            self.ipv6_addr = self.ser.readline().strip().decode('ascii')
+
+            def handler( line ):
+                addr = line.strip().decode('ascii', errors='replace')
+                # エコーバックは読み飛ばし
+                if is_ipv6_address(addr):
+                    return addr
+                return None
+
+            ipv6_addr = self._command(cmd.encode('ascii'), handler)
+            if ipv6_addr is None:
+                logger.error('SKLL64 failed')
+                self.scanresult = {}
+                return False
+            self.ipv6_addr = ipv6_addr
             logger.info('IP_ADDR = ' + self.ipv6_addr)
 
             # ここまできたらスキャン成功とする
@@ -636,44 +850,42 @@ class WiSunRL7023 ( WiSunDevice ):
         else:
             cmd = 'SKJOIN ' + self.ipv6_addr + '\r\n'
         logger.info(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-
-        # Step2 イベントを監視し、接続先からの返答を待つ EVENT 24が得られるとJoin成功
-        toc = 0
-        while True:
-            event = self._get_event()
-
-            if event:
-                if event['NAME'] == 'EVENT':
-                    if event['NUM'] == '25':
-                        # EVENT 25: PANAによる接続が完了した。
-                        logger.info('EVENT: 25 - JOIN SUCCEED')
-                        return True
-
-                    elif event['NUM'] == '24':
-                        # EVENT 24: PANAによる接続過程でエラーが発生した
-                        logger.info('EVENT: 24 - JOIN FAILED')
-                        return False
-
-                    else:
-                        logger.info('EVENT: ' + event['NUM'])
-                        logger.debug(event)
-
-                elif event['NAME'] == 'ERXUDP':
-                    logger.info('ERXUDP')
-                    logger.debug(event)
+
+        # Step2 イベントを監視し、接続先からの返答を待つ EVENT 25が得られるとJoin成功
+        # （ERXUDP は受信スレッドが data_que に入れるので、ここでは扱わない）
+        def handler( line ):
+            event = self._parse_event(line.strip())
+            if event.get('NAME') == 'EVENT':
+                if event['NUM'] == '25':
+                    # EVENT 25: PANAによる接続が完了した。
+                    logger.info('EVENT: 25 - JOIN SUCCEED')
+                    return True
+
+                elif event['NUM'] == '24':
+                    # EVENT 24: PANAによる接続過程でエラーが発生した
+                    logger.info('EVENT: 24 - JOIN FAILED')
+                    return False
 
                 else:
-                    logger.info(event)
-                    pass
+                    logger.info('EVENT: ' + event['NUM'])
+                    logger.debug(event)
 
-            else:
-                # データ無し、一定回数でタイムアウト
-                toc += 1
-                logger.debug('no evnet')
-                if toc > self._TIMEOUT_MAX:
-                    logger.info('timeout')
-                    return False
+            elif line[:4] == b'FAIL':
+                logger.info(line.decode('ascii', errors='replace'))
+                return False
+
+            elif event:
+                logger.debug(event)
+            return None
+
+        result = self._command(cmd.encode('ascii'), handler, timeout=self._TIMEOUT_JOIN, events=(b'24', b'25'))
+        if result is None:
+            logger.info('timeout')
+            return False
+        if result:
+            # 接続する前に受け取ったセッションのイベントは無効
+            self.lost_event = None
+        return result
 
     def rejoin( self ):
         """PANA認証状態で再認証を行い、暗号化キーの更新を行う
@@ -712,28 +924,28 @@ class WiSunRL7023 ( WiSunDevice ):
         else:
             cmd = "SKSENDTO 1 {0} 0E1A 1 {1:04X} ".format(self.ipv6_addr, len(byteframe)).encode('ascii')
         cmd += byteframe # + b'\r\n'
-        self.ser.write(cmd)
-        evt21 = False
-        toc = 0
-        while True:
-            res = self.ser.readline()
-            if res == b'':
-                toc += 1
-                if toc > self._TIMEOUT_MAX:
-                    logger.debug('timeout')
-                    return False
 
-            elif res[:8] == b'EVENT 21':
+        # EVENT 21（UDP送信完了）に続いて OK が返される
+        evt21 = [False]
+        def handler( res ):
+            if res[:8] == b'EVENT 21':
                 logger.debug(res.decode('ascii').strip())
-                evt21 = True
+                evt21[0] = True
 
             elif res[:2] == b'OK':
                 logger.debug(res.decode('ascii').strip())
-                return evt21
+                return evt21[0]
+
+            elif res[:4] == b'FAIL':
+                logger.debug(res.decode('ascii', errors='replace'))
+                return False
 
             else:
                 #logger.debug(res.decode('ascii').strip())
                 logger.debug('unknown response')
+            return None
+
+        return bool(self._command(cmd, handler, events=(b'21',)))
 
     def receive( self ):
         """スマートメーターからの電文を受信する
@@ -741,8 +953,11 @@ class WiSunRL7023 ( WiSunDevice ):
         戻り値:
             スマートメーターからの電文に対応する DataFrame オブジェクト
         """
-
-        event = self._get_event()
+        # 受信スレッドが入れたイベントを取り出す（最大1秒待つ）
+        try:
+            event = self.data_que.get(timeout=1)
+        except queue.Empty:
+            return None
 
         # 受信イベント処理
         if event:
@@ -751,7 +966,8 @@ class WiSunRL7023 ( WiSunDevice ):
                 dataframe = DataFrame.decode(event['DATALEN'], event['DATA'])
 
                 if dataframe:
-                    logger.debug([event['DATA'], dataframe.endict()])
+                    if logger.isEnabledFor(DEBUG):
+                        logger.debug([event['DATA'], dataframe.endict()])
                     return dataframe
 
                 else:
@@ -759,6 +975,11 @@ class WiSunRL7023 ( WiSunDevice ):
                     logger.error(event)
                     pass
 
+            elif event['NAME'] == 'EVENT' and event['NUM'] in self.SESSION_EVENTS:
+                # セッションが使えなくなった（session_event() で BrouteReader に知らせる）
+                logger.warning('EVENT: ' + event['NUM'] + ' - ' + self.SESSION_EVENTS[event['NUM']])
+                self.lost_event = event['NUM']
+
             # ERXUDP以外のイベントの処理
             else:
                 logger.warning('other EVENT')
@@ -767,6 +988,15 @@ class WiSunRL7023 ( WiSunDevice ):
 
         return None
 
+    def session_event( self ):
+        """receive() で受け取ったセッションの失効や終了のイベントを取り出す
+
+        戻り値:
+            イベントの番号（str）、なければ None
+        """
+        event, self.lost_event = self.lost_event, None
+        return event
+
     def term( self ):
         """デバイスに SKTERM コマンドを送り、PANAセッションの終了を要請
 
@@ -776,49 +1006,42 @@ class WiSunRL7023 ( WiSunDevice ):
         """
         cmd = 'SKTERM\r\n'
         logger.info(cmd.strip())
-        self.ser.write(cmd.encode('ascii'))
-        if self._wait_ok():
-            #return True
-            pass
-        else:
-            return False
 
-        toc = 0
-        while True:
-            event = self._get_event()
-
-            if event:
-                if event['NAME'] == 'EVENT':
-                    if event['NUM'] == '27':
-                        # EVENT 27: セッション終了が成功
-                        logger.info('EVENT: 27 - TERM SUCCEED')
-                        return True
+        # OK に続いて EVENT 27 または 28 が返される
+        def handler( line ):
+            if line[:4] == b'FAIL':
+                logger.info(line.decode('ascii', errors='replace'))
+                return False
 
-                    elif event['NUM'] == '28':
-                        # EVENT 28: タイムアウトしてセッション終了となった
-                        logger.info('EVENT: 28 - TERM TIMEOUT, Session terminate')
-                        return True
+            event = self._parse_event(line.strip())
+            if event.get('NAME') == 'EVENT':
+                if event['NUM'] == '27':
+                    # EVENT 27: セッション終了が成功
+                    logger.info('EVENT: 27 - TERM SUCCEED')
+                    return True
 
-                    else:
-                        logger.info('EVENT: ' + event['NUM'])
-                        logger.debug(event)
+                elif event['NUM'] == '28':
+                    # EVENT 28: タイムアウトしてセッション終了となった
+                    logger.info('EVENT: 28 - TERM TIMEOUT, Session terminate')
+                    return True
 
-                elif event['NAME'] == 'ERXUDP':
-                    logger.info('ERXUDP')
-                    logger.debug(event)
                 else:
-                    logger.info(event)
-                    pass
-            else:
-                # データ無し、一定回数でタイムアウト
-                toc += 1
-                logger.debug('no evnet')
-                if toc > self._TIMEOUT_MAX:
-                    logger.info('timeout')
-                    return False
+                    logger.info('EVENT: ' + event['NUM'])
+                    logger.debug(event)
+            return None
+
+        result = self._command(cmd.encode('ascii'), handler, events=(b'27', b'28'))
+        if result is None:
+            logger.info('timeout')
+            return False
+        return result
 
     def close( self ):
-        """デバイスのシリアルポートをクローズする"""
+        """受信スレッドを止め、デバイスのシリアルポートをクローズする"""
+        self.reader_stop.set()
+        if self.reader is not None:
+            self.reader.join(timeout=5)
+            self.reader = None
         self.ser.close()
         logger.info('skdevice closed. ')
 
@@ -866,6 +1089,9 @@ class DataFrame ( ):
     # トランザクションID
     TID = 0
 
+    # ヘッダ部 EHD(2) TID(2) SEOJ(3) DEOJ(3) ESV(1) OPC(1) = 12 バイト
+    HEADER = struct.Struct('>2s2s3s3sBB')
+
     def __init__( self, dataframe={} ):
         """コンストラクタ"""
         #self.dataframe = dataframe
@@ -876,14 +1102,19 @@ class DataFrame ( ):
             self.deoj = dataframe['DEOJ']
             self.esv = dataframe['ESV']
             self.properties = {}
+            self.edt = {}
             for prop in dataframe['PROPERTIES']:
                 #prop['EPC']: prop[]
                 self.properties[prop['EPC']] = prop['EDT']
+                self.edt[prop['EPC']] = bytes.fromhex(prop['EDT'])
 
     @classmethod
     def decode ( cls, length, encoded_data ):
         """受信した電文（HEX文字データ列）からインスタンスを作成する
 
+        電文は一度だけバイト列に変換し、以降はバイト列から各フィールドを取り出す。
+        プロパティ値は properties（16進文字列）と edt（バイト列）の両方に保持する。
+
         引数:
             length (str):        電文の長さ（16進表記 2byte 文字列）
             encoded_data (str):  電文の本体（16進表記の文字列）
@@ -892,39 +1123,96 @@ class DataFrame ( ):
             DataFrame インスタンス
 
         """
-
-        dataframe = {}
         if len(encoded_data) != int(length, 16) * 2:
             logger.error('DataFrame decode error - invalid length')
             return None
 
-        if not is_hex(encoded_data):
+        try:
+            data = bytes.fromhex(encoded_data)
+        except ValueError:
             logger.error('DataFrame decode error - invalid data')
             return None
 
-        df = cls()
-        try:
-            df.ehd = encoded_data[:4]
-            df.tid = encoded_data[4:8]
-            df.seoj = encoded_data[8:14]
-            df.deoj = encoded_data[14:20]
-            df.esv = encoded_data[20:22]
-            df.opc = encoded_data[22:24]
-            df.properties = {}
-            base = 24
-            int_opc = int(df.opc, 16)
-            for pc in range(int_opc):
-                epc = encoded_data[base     : base + 2]
-                pdc = encoded_data[base + 2 : base + 4]
-                int_pdc = int(pdc, 16)
-                edt = encoded_data[base + 4 : base + 4 + int_pdc * 2]
-                df.properties[epc] = edt
-                base += 4 + int_pdc * 2
-
-        except:
+        size = len(data)
+        if size < cls.HEADER.size:
             logger.error('DataFrame decode error - conflicting data')
             return None
 
+        df = cls()
+        ehd, tid, seoj, deoj, esv, opc = cls.HEADER.unpack_from(data)
+        df.ehd = ehd.hex().upper()
+        df.tid = tid.hex().upper()
+        df.seoj = seoj.hex().upper()
+        df.deoj = deoj.hex().upper()
+        df.esv = _HEX2[esv]
+        df.opc = _HEX2[opc]
+        df.properties = {}
+        df.edt = {}
+        base = cls.HEADER.size
+        for pc in range(opc):
+            if base + 2 > size:
+                logger.error('DataFrame decode error - conflicting data')
+                return None
+            epc = _HEX2[data[base]]
+            pdc = data[base + 1]
+            edt = data[base + 2 : base + 2 + pdc]
+            if len(edt) != pdc:
+                logger.error('DataFrame decode error - conflicting data')
+                return None
+            df.edt[epc] = edt
+            df.properties[epc] = edt.hex().upper()
+            base += 2 + pdc
+
+        return df
+
+    @classmethod
+    def cmd_set_property( cls, edt_dict ):
+        '''Echonet Bルートの「プロパティ値書き込み要求（応答要）」SetC（ESV=61）電文を作成する。
+
+        引数:
+            edt_dict (dict): {プロパティコード: 書き込む値（16進文字列）}
+
+        戻り値:
+            構成されたデータフレームオブジェクト
+        '''
+        df = cls()
+        df.ehd = '1081'
+        df.tid = '{:04X}'.format(cls.TID)
+        cls.TID  = (cls.TID + 1) % 0x10000       # インクリメントしておく
+        df.seoj = '05FF01'
+        df.deoj = '028801'
+        df.esv = '61'
+        df.opc = '{:02X}'.format(len(edt_dict))
+        df.properties = dict(edt_dict)
+        df.edt = {epc: bytes.fromhex(edt) for epc, edt in edt_dict.items()}
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('Echonet-lite sendto frame : ' + df.encode())
+        return df
+
+    @classmethod
+    def cmd_infc_response( cls, dataframe ):
+        '''プロパティ値通知（応答要）ESV=74 に対する応答電文 INFC_Res（ESV=7A）を作成する。
+
+        引数:
+            dataframe (DataFrame): 受信した ESV=74 の電文
+
+        戻り値:
+            構成されたデータフレームオブジェクト（TID は受信した電文と同じ、EDT は省略）
+        '''
+        df = cls()
+        df.ehd = '1081'
+        df.tid = dataframe.tid
+        df.seoj = dataframe.deoj
+        df.deoj = dataframe.seoj
+        df.esv = '7A'
+        df.opc = '{:02X}'.format(len(dataframe.properties))
+        df.properties = {}
+        df.edt = {}
+        for epc in dataframe.properties:
+            df.properties[epc] = ''
+            df.edt[epc] = b''
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('Echonet-lite sendto frame : ' + df.encode())
         return df
 
     @classmethod
@@ -943,15 +1231,18 @@ class DataFrame ( ):
         df = cls()
         df.ehd = '1081'
         df.tid = '{:04X}'.format(cls.TID)
-        # cls.TID  = (cls.TID + 1) % 0xffff       # インクリメントしておく
+        cls.TID  = (cls.TID + 1) % 0x10000       # インクリメントしておく
         df.seoj = '05FF01'
         df.deoj = '028801'
         df.esv = '62'
         df.opc = '{:02X}'.format(len(epc_list))
         df.properties = {}
+        df.edt = {}
         for epc in epc_list:
             df.properties[epc] = ''
-        logger.debug('Echonet-lite sendto frame : ' + df.encode())
+            df.edt[epc] = b''
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('Echonet-lite sendto frame : ' + df.encode())
         return df
 
     def encode( self ):
@@ -1012,10 +1303,64 @@ class BrouteReader ( Worker ):
         以下 JOIN の繰り返し
 
         回復不能なエラーが発生したときは、状態を巻き戻し最初からやり直す。
+
+    トランザクション管理:
+        要求電文ごとに TID（トランザクションID）を付け、応答を待っている要求を
+        self.transactions に登録しておく。応答を待たずに max_inflight 件まで
+        要求を送ることができる。応答は TID で要求と対応付ける。
+        tx_timeout 秒以内に応答がない要求は、新しい TID で tx_retry 回まで再送する。
+
+    プロパティ値通知:
+        スマートメーターは状変アナウンスプロパティマップ（9D）に含まれるプロパティを
+        要求なしで通知してくる（ESV=73 INF, ESV=74 INFC）。INFC には INFC_Res（ESV=7A）を返す。
+        notify=True の場合は接続時に 9D を読み出し、通知されるプロパティについては
+        requests の周期の間に通知がなかったときだけ要求を送る（ポーリングは予備）。
+        920MHz帯の限られた送信時間を節約できる。
+
+    要求のスケジューリング:
+        プロパティ（EPC）ごとに次に要求する時刻をヒープで管理し、同じ時刻までに
+        周期が来たプロパティは max_opc 個までまとめて1つの要求電文で送る。
+        * 応答がないプロパティは、タイムアウトするごとに要求間隔を2倍にする
+          （backoff_max 秒まで、応答があれば元に戻す）
+        * adaptive に指定したプロパティは、前回の値からの変化が delta 以上のとき
+          hold 秒の間、要求間隔を cycle 秒に短くする（負荷の急な変化を細かく記録する）
+
+    積算電力量の補完:
+        最後に積算電力量（E0）を記録した時刻を state_file に保存しておき、接続したときに
+        30分以上記録が途切れていれば、途切れた期間の積算電力量計測値履歴を読み出す。
+        日ごとに積算履歴収集日（E5）を書き込み（SetC）、履歴（E2、history_reverse=True なら
+        E4 も）を読み出して、30分ごとの値を元の時刻で記録する（DATA_ID は 'H'）。
+        * スマートメーターが保持している履歴は最大 backfill_days 日分（45日）
+        * 新しいスマートメーターの積算電力量計測値履歴2（EC, ED）には対応していない
+
+    接続の回復:
+        receive_timeout 秒間電文を受信しないとき、または応答のない要求が
+        recover_after 回続いたときは、次の順に接続の回復を試みる。
+            1. rejoin  : PANA 再認証（SKREJOIN）
+            2. join    : 前回の IPv6 アドレスへ PANA 認証（SKJOIN）
+            3. restore : デバイスのリセットと設定の後、スキャンせずに前回のスキャン結果で認証
+            4. scan    : シリアルポートを開き直し、キャッシュを使わずにスキャンからやり直す
+        段階ごとの回数、成功数、失敗数、回復までの時間は self.recovery_stats に記録し、ログに出力する。
+        scan は、スキャンか PANA 認証が何度も失敗して INIT に戻るたびに失敗として記録し、
+        次のスキャンを新しい回として数える（回数 = 成功数 + 失敗数 + 実行中の1回）。
+
+    複数のスマートメーター:
+        ドングルごとに WiSunRL7023（scancache は別のファイル）と BrouteReader を作り、
+        BrouteReader の unit_id を別にする。記録するデータのユニットIDが unit_id になる。
+        係数（D3）、有効桁数（D7）、単位（E1）はスマートメーターごとに state_file に保存し、
+        再起動した直後から前回の値で積算電力量を換算する。
+        複数のスマートメーターの合計は keilib/aggregator.py の SiteAggregator で求める。
     """
 
+    # 接続の回復を試みる順
+    RECOVERY_TIERS = ['rejoin', 'join', 'restore', 'scan']
+
 #    def __init__( self , port, baudrate, broute_id, broute_pwd, requests=[], record_que=None ):
-    def __init__( self , wisundev, broute_id, broute_pwd, requests=[], record_que=None ):
+    def __init__( self , wisundev, broute_id, broute_pwd, requests=[], record_que=None,
+                  max_inflight=2, tx_timeout=20, tx_retry=2, notify=True,
+                  max_opc=6, backoff_max=600, adaptive=None,
+                  state_file='broute_state.json', backfill_days=45, history_reverse=False,
+                  receive_timeout=600, recover_after=3, unit_id='BR' ):
         """コンストラクタ
 
         引数:
@@ -1025,9 +1370,27 @@ class BrouteReader ( Worker ):
             broute_pwd (str): Bルート接続用パスワード（電力会社に申請して取得）
             requests (list of dic): スマートメータに問い合わせるプロパティリスト、間隔
             record_que (Queue): 記録用 queue
+            max_inflight (int): 応答を待たずに送ることのできる要求の数
+            tx_timeout (number): 要求の応答を待つ時間（秒）
+            tx_retry (int): 応答がない要求を再送する回数
+            notify (bool): スマートメーターが通知するプロパティは、通知がないときだけ要求する
+            max_opc (int): 1つの要求電文にまとめるプロパティの最大数
+            backoff_max (number): 応答がないときに延ばす要求間隔の上限（秒）
+            adaptive (dict): 値の変化に応じて要求間隔を短くするプロパティ
+                {EPC: {'delta': 変化量, 'cycle': 短くした間隔（秒）, 'hold': 継続する時間（秒）}}
+                省略時は E7 を 500W 以上の変化で 60秒間 5秒ごとにする
+            state_file (str): 最後に積算電力量を記録した時刻と、係数、有効桁数、単位を保存するファイル
+                （None なら補完も保存もしない。省略時は broute_state.json、
+                unit_id が 'BR' 以外なら broute_state_<unit_id>.json）
+            backfill_days (int): 補完する最大の日数
+            history_reverse (bool): 逆方向の積算電力量（E4 → E3）も補完する
+            receive_timeout (number): この秒数電文を受信しなければ接続を回復する
+            recover_after (int): 応答のない要求がこの回数続いたら接続を回復する
+            unit_id (str): 記録するデータのユニットID
         """
         super().__init__()
 
+        self.unit_id = unit_id
         self.record_que = record_que
         self.broute_id = broute_id
         self.broute_pwd = broute_pwd
@@ -1038,8 +1401,6 @@ class BrouteReader ( Worker ):
                 { 'epc':['E7'], 'cycle': 10 }, # 瞬時電力(E7)
                 { 'epc':['E0'], 'cycle': 120 }, # 積算電力量(E0)
             ]
-        for req in requests:
-            req['lasttime'] = 0
         self.requests = requests
         #self.wisundev = WiSunRL7023DSS( port, baudrate )
         self.wisundev = wisundev
@@ -1060,6 +1421,68 @@ class BrouteReader ( Worker ):
         self.coefficient = 1
         self.unit = 0.1
         self.effective_digits = 0x06
+        self.unit_known = False
+        self.calibration = {}           # {'D3': 係数, 'D7': 有効桁数, 'E1': 単位のコード}
+
+        # プロパティごとのデコード関数 {EPC: 関数(epc, edt) -> [[sensor, value], ...]}
+        self.decoders = {
+            'E7': self._decode_power,
+            'E8': self._decode_current,
+            'E0': self._decode_energy,
+            'E3': self._decode_energy,
+            'D3': self._decode_coefficient,
+            'D7': self._decode_digits,
+            'E1': self._decode_unit,
+            'EA': self._decode_fixed_time_energy,
+            'EB': self._decode_fixed_time_energy,
+            '9D': self._decode_announce_map,
+            'E2': self._decode_history,
+            'E4': self._decode_history,
+        }
+
+        # 要求のスケジューリング
+        self.max_opc = max_opc
+        self.backoff_max = backoff_max
+        if adaptive is None:
+            adaptive = {'E7': {'delta': 500, 'cycle': 5, 'hold': 60}}
+        self.adaptive = adaptive
+        self._init_schedule()
+
+        # プロパティ値通知
+        self.notify = notify
+        self.announced = set()          # 状変アナウンスプロパティマップ（9D）のプロパティ
+        self.announce_requested = False
+        self.lasttime_notify = {}       # {EPC: 最後に通知を受けた時刻}
+        self.lasttime_join = 0
+
+        # トランザクション管理 {TID: {'epc', 'sent', 'retry'}}
+        self.max_inflight = max_inflight
+        self.tx_timeout = tx_timeout
+        self.tx_retry = tx_retry
+        self.transactions = {}
+
+        # 積算電力量の補完
+        if state_file == 'broute_state.json' and unit_id != 'BR':
+            # スマートメーターごとに別のファイルにする
+            state_file = 'broute_state_' + unit_id + '.json'
+        self.state_file = state_file
+        self.backfill_days = backfill_days
+        self.history_reverse = history_reverse
+        self.lasttime_energy = 0
+        self.lasttime_saved = 0
+        self._load_state()
+        self.backfill = []              # 補完する日（何日前か）のリスト
+        self.backfill_range = None      # 補完する期間 (開始, 終了) UNIX時刻
+        self.backfill_step = None       # None, 'set'（E5 書き込み中）, 'get'（履歴読み出し中）
+
+        # 接続の回復
+        self.receive_timeout = receive_timeout
+        self.recover_after = recover_after
+        self.tx_failures = 0
+        self.force_scan = False
+        self.recovery_start = None
+        self.recovery_stats = {tier: {'count': 0, 'success': 0, 'failed': 0, 'last': 0, 'total': 0}
+                               for tier in self.RECOVERY_TIERS}
 
         # 定期的な実行のための変数（前回実行した時間を記憶しておく）
         self.lasttime_rejoin = 0
@@ -1099,7 +1522,12 @@ class BrouteReader ( Worker ):
 
     def _scan( self ):
         """アクティブスキャンの実行（リトライあり）"""
-        if self.wisundev.scan():
+        if self.force_scan:
+            result = self.wisundev.scan(cache=False)
+        else:
+            result = self.wisundev.scan()
+        if result:
+            self.force_scan = False
             self.state = self._STATE_SCAN
             logger.info('state => SCAN')
             self.scan_retry = 0
@@ -1110,20 +1538,17 @@ class BrouteReader ( Worker ):
             if self.scan_retry > 5:
                 self.scan_retry = 0
                 self.wisundev.close()
+                self._scan_failed()
                 self.state = self._STATE_INIT
             time.sleep(10)
 
     def _join( self ):
         """PANA認証接続要求を行う（リトライあり）"""
         if self.wisundev.join():
-            self.state = self._STATE_JOIN
-            logger.info('state => JOIN')
             self.join_retry = 0
-
-            ts = datetime.datetime.now().timestamp()
-            self.lasttime_erxudp = ts
-            self.lasttime_rejoin = ts
-            self.lasttime_receive = ts
+            if self.recovery_start is not None:
+                self._recovered('scan', True)
+            self._joined()
 
         else:
             # 失敗してもただちに状態を遷移させず、ループで何度かトライ
@@ -1132,29 +1557,106 @@ class BrouteReader ( Worker ):
             if self.join_retry > 5:
                 self.join_retry = 0
                 self.wisundev.close()
-                try:
-                    os.remove('scancache.json')
-                except:
-                    pass
+                # スキャン結果の履歴は残し、キャッシュを使わずにスキャンし直す
+                self.force_scan = True
+                self._scan_failed()
                 self.state = self._STATE_INIT
             time.sleep(10)
 
+    def _joined( self ):
+        """PANA認証に成功したときの処理（JOIN 状態へ）"""
+        self.state = self._STATE_JOIN
+        logger.info('state => JOIN')
+        self.transactions = {}
+        self.tx_failures = 0
+
+        ts = datetime.datetime.now().timestamp()
+        self.lasttime_erxudp = ts
+        self.lasttime_rejoin = ts
+        self.lasttime_receive = ts
+        self.lasttime_join = ts
+        self.announce_requested = False
+        self._init_schedule()
+        self._plan_backfill(ts)
+
     def _rejoin( self ):
         """PANA再認証を行う
         セッションの有効期限が近づくとデバイスが自動的に再認証を行う設定になっている場合は不要
         """
         if self.wisundev.rejoin():
-            self.state = self._STATE_JOIN
-            logger.info('state => JOIN')
-
-            ts = datetime.datetime.now().timestamp()
-            self.lasttime_erxudp = ts
-            self.lasttime_rejoin = ts
-            self.lasttime_receive = ts
+            self._joined()
         else:
             self.state = self._STATE_INIT
             time.sleep(5)
 
+    def _recover_tier( self, tier ):
+        """回復の段階を1つ実行する
+
+        戻り値:
+            True: 成功
+            False: 失敗
+        """
+        if tier == 'rejoin':
+            return self.wisundev.rejoin()
+        elif tier == 'join':
+            return self.wisundev.join()
+        elif tier == 'restore':
+            return (self.wisundev.reset()
+                    and self.wisundev.setup(self.broute_id, self.broute_pwd)
+                    and self.wisundev.restore()
+                    and self.wisundev.join())
+        return False
+
+    def _recovered( self, tier, success ):
+        """回復の段階ごとの結果と、回復を始めてからの時間を記録する
+        （回数は段階を始めるときに数える）
+        """
+        elapsed = time.monotonic() - self.recovery_start
+        stats = self.recovery_stats[tier]
+        if success:
+            stats['success'] += 1
+            stats['last'] = elapsed
+            stats['total'] += elapsed
+            self.recovery_start = None
+            logger.info('recovered by {} in {:.1f} sec, stats {}'.format(tier, elapsed, self.recovery_stats))
+        else:
+            stats['failed'] += 1
+            logger.warning('recovery by {} failed ({:.1f} sec)'.format(tier, elapsed))
+
+    def _scan_failed( self ):
+        """スキャンか PANA 認証をあきらめて INIT に戻るときの処理
+
+        回復中であれば最後の段階（scan）の失敗を記録し、INIT からのやり直しを次の回として数える
+        """
+        if self.recovery_start is not None:
+            self._recovered('scan', False)
+            self.recovery_stats['scan']['count'] += 1
+
+    def _recover( self, reason ):
+        """接続の回復を段階的に試みる。すべて失敗したらスキャンからやり直す"""
+        logger.error('ERROR ' + reason + ', start recovery')
+        self.transactions = {}
+        self.recovery_start = time.monotonic()
+        for tier in self.RECOVERY_TIERS[:-1]:
+            if self.stopEvent.is_set():
+                return
+            logger.info('recovery: ' + tier)
+            self.recovery_stats[tier]['count'] += 1
+            if self._recover_tier(tier):
+                self._recovered(tier, True)
+                self._joined()
+                return
+            self._recovered(tier, False)
+
+        # 最後の手段: シリアルポートを開き直し、キャッシュを使わずにスキャンする
+        # （回復までの時間は JOIN したときに、失敗は INIT に戻るときに記録する）
+        logger.info('recovery: scan')
+        self.recovery_stats['scan']['count'] += 1
+        self.wisundev.term()
+        self.wisundev.close()
+        self.force_scan = True
+        self.state = self._STATE_INIT
+
     def _sendto( self, cmd ):
         """Bルートのプロパティ値要求電文をスマートメーターに送る"""
         return self.wisundev.sendto( cmd )
@@ -1162,98 +1664,432 @@ class BrouteReader ( Worker ):
     def _receive ( self ):
         return self.wisundev.receive()
 
-    def _accept( self, dataframe ):
-        """受信した電文を受け付ける処理"""
+    def _request( self, epc_list, retry=0, edt=None ):
+        """プロパティ値要求電文を送り、応答待ちのトランザクションとして登録する
+
+        引数:
+            epc_list (list of str): 要求するプロパティコード
+            retry (int): 再送回数
+            edt (dict): 指定すると読み出し要求の代わりに書き込み要求（SetC）を送る
+                {プロパティコード: 書き込む値（16進文字列）}
+
+        戻り値:
+            True: 送信成功
+            False: 送信失敗
+        """
+        if edt is None:
+            cmd = DataFrame.cmd_get_property(epc_list)
+        else:
+            cmd = DataFrame.cmd_set_property(edt)
+        if not self._sendto(cmd):
+            logger.warning('sendto failed TID=' + cmd.tid + ' EPC=' + ','.join(epc_list))
+            return False
+        self.transactions[cmd.tid] = {
+            'epc': epc_list,
+            'edt': edt,
+            'sent': datetime.datetime.now().timestamp(),
+            'retry': retry
+        }
+        return True
+
+    def _notified( self, epc, cycle, now ):
+        """プロパティが通知されるので、要求を送らなくてよいとき True"""
+        if not self.notify or epc not in self.announced:
+            return False
+        # 接続直後は最初の通知を待つ
+        lasttime = max(self.lasttime_notify.get(epc, 0), self.lasttime_join)
+        return now - lasttime <= cycle
+
+    def _init_schedule( self ):
+        """requests からプロパティごとの要求スケジュールを作成する（すべて直ちに要求する）"""
+        self.schedule = {}
+        for req in self.requests:
+            for epc in req['epc']:
+                entry = self.schedule.get(epc)
+                if entry is None:
+                    self.schedule[epc] = {'cycle': req['cycle'], 'due': 0, 'backoff': 0,
+                                          'fast_until': 0, 'last': None}
+                elif req['cycle'] < entry['cycle']:
+                    entry['cycle'] = req['cycle']
+        # (要求する時刻, EPC) のヒープ
+        self.heap = [(0, epc) for epc in self.schedule]
+        heapq.heapify(self.heap)
+
+    def _reschedule( self, epc, due ):
+        """プロパティを次に要求する時刻を設定する（古いヒープの要素は取り出すときに捨てる）"""
+        self.schedule[epc]['due'] = due
+        heapq.heappush(self.heap, (due, epc))
+
+    def _interval( self, epc, now ):
+        """プロパティの現在の要求間隔"""
+        entry = self.schedule[epc]
+        cycle = entry['cycle']
+        if now < entry['fast_until']:
+            cycle = self.adaptive[epc]['cycle']
+        if entry['backoff']:
+            cycle = max(cycle, min(cycle * 2 ** entry['backoff'], self.backoff_max))
+        return cycle
+
+    def _next_due( self, epc, now ):
+        """周期を保って次に要求する時刻を求める"""
+        due = self.schedule[epc]['due'] + self._interval(epc, now)
+        if due <= now:
+            due = now + self._interval(epc, now)
+        return due
+
+    def _send_requests( self, now ):
+        """周期が来たプロパティをまとめて、応答待ちの数が max_inflight を超えない範囲で送る"""
+        if self.notify and not self.announce_requested:
+            # 状変アナウンスプロパティマップを読み出す
+            if len(self.transactions) < self.max_inflight and self._request(['9D']):
+                self.announce_requested = True
+
+        if len(self.transactions) >= self.max_inflight:
+            # 応答待ちが多いときは次の機会に送る
+            return
+
+        epc_list = []
+        while self.heap and self.heap[0][0] <= now and len(epc_list) < self.max_opc:
+            due, epc = heapq.heappop(self.heap)
+            if due != self.schedule[epc]['due'] or epc in epc_list:
+                # 再スケジュールされた古い要素
+                continue
+            if self._notified(epc, self.schedule[epc]['cycle'], now):
+                # 周期の間に通知があったプロパティは要求しない
+                self._reschedule(epc, self._next_due(epc, now))
+                continue
+            epc_list.append(epc)
+
+        if not epc_list:
+            return
+        if not self._request(epc_list):
+            # 送信できなかったものは次の機会に送る
+            for epc in epc_list:
+                heapq.heappush(self.heap, (self.schedule[epc]['due'], epc))
+            return
+        for epc in epc_list:
+            self._reschedule(epc, self._next_due(epc, now))
+
+    def _backoff( self, epc_list, success ):
+        """応答の有無に応じてプロパティの要求間隔を延ばす、または元に戻す"""
+        for epc in epc_list:
+            entry = self.schedule.get(epc)
+            if entry is None:
+                continue
+            if success:
+                entry['backoff'] = 0
+            elif self._interval(epc, 0) < self.backoff_max:
+                entry['backoff'] += 1
+                logger.info('backoff EPC=' + epc + ' interval=' + str(self._interval(epc, 0)))
+
+    def _adapt( self, epc, value, now ):
+        """値の変化が大きいときは、しばらくの間そのプロパティの要求間隔を短くする"""
+        rule = self.adaptive.get(epc)
+        entry = self.schedule.get(epc)
+        if rule is None or entry is None:
+            return
+        last = entry['last']
+        entry['last'] = value
+        if last is None or abs(value - last) < rule['delta']:
+            return
+        if now >= entry['fast_until']:
+            logger.info('EPC=' + epc + ' changed ' + str(last) + ' -> ' + str(value)
+                        + ', interval ' + str(rule['cycle']) + ' sec')
+        entry['fast_until'] = now + rule['hold']
+        due = now + rule['cycle']
+        if due < entry['due']:
+            self._reschedule(epc, due)
+
+    def _match_transaction( self, dataframe ):
+        """受信した応答電文を TID で要求と対応付け、応答待ちから外す"""
+        if dataframe.esv not in ['72', '52', '71', '51']:
+            # 通知（73, 74）などはスマートメーターが付けた TID なので対応付けない
+            return
+        tx = self.transactions.pop(dataframe.tid, None)
+        if tx is None:
+            logger.debug('response for unknown TID=' + dataframe.tid)
+            return
+        if dataframe.esv in ['71', '51']:
+            # 書き込み要求の応答
+            return
+        if dataframe.esv == '52':
+            # Get_SNA: 一部のプロパティが読み出せなかった
+            logger.warning('property not available TID=' + dataframe.tid + ' EPC=' + ','.join(tx['epc']))
+        # 値が返されなかったプロパティは要求間隔を延ばす
+        failed = [epc for epc in tx['epc'] if not dataframe.edt.get(epc)]
+        self._backoff(failed, False)
+        if self.backfill_step == 'get' and set(failed) & {'E2', 'E4'}:
+            self._next_backfill('history not available')
+        self._backoff([epc for epc in tx['epc'] if epc not in failed], True)
+
+    def _check_transactions( self, now ):
+        """応答のない要求を再送し、再送回数を超えたものはあきらめる"""
+        for tid, tx in list(self.transactions.items()):
+            if now - tx['sent'] <= self.tx_timeout:
+                continue
+            del self.transactions[tid]
+            self._backoff(tx['epc'], False)
+            if tx['retry'] < self.tx_retry:
+                logger.info('request timeout TID=' + tid + ' EPC=' + ','.join(tx['epc']) + ', resend')
+                if self._request(tx['epc'], tx['retry'] + 1, tx['edt']):
+                    continue
+                # 再送できなければあきらめる（補完が止まらないように）
+                reason = 'resend failed'
+            else:
+                logger.warning('request timeout TID=' + tid + ' EPC=' + ','.join(tx['epc']) + ', give up')
+                reason = 'timeout'
+            self.tx_failures += 1
+            if self.backfill_step is not None and set(tx['epc']) & {'E5', 'E2', 'E4'}:
+                self._next_backfill(reason)
+
+    def _load_state( self ):
+        """state_file から最後に積算電力量を記録した時刻と、係数、有効桁数、単位を読み出す"""
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.lasttime_energy = state.get('lasttime_energy', 0)
+            calibration = state.get('calibration', {})
+        except (OSError, ValueError, AttributeError):
+            return
+        for epc in ['D3', 'D7', 'E1']:
+            if isinstance(calibration.get(epc), int):
+                self._set_calibration(epc, calibration[epc])
+        if self.calibration:
+            logger.info('calibration of ' + self.unit_id + ' restored: ' + str(self.calibration))
+
+    def _save_state( self ):
+        """最後に積算電力量を記録した時刻と、係数、有効桁数、単位を state_file に保存する"""
+        if self.state_file is None or not (self.lasttime_energy or self.calibration):
+            return
+        try:
+            tmpname = self.state_file + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump({'lasttime_energy': self.lasttime_energy,
+                           'calibration': self.calibration}, f)
+            os.replace(tmpname, self.state_file)
+            self.lasttime_saved = self.lasttime_energy
+        except OSError as err:
+            logger.warning('cannot save state: ' + str(err))
+
+    def _recorded_energy( self, now ):
+        """積算電力量を記録した時刻を更新する
+
+        ファイルへの保存は、履歴の30分のコマが変わったときだけ行う。保存した時刻と
+        実際に最後に記録した時刻の間にコマの時刻が入らないので、再起動の後の補完で
+        記録済みの時刻のコマを重ねて記録することはない。
+        """
+        self.lasttime_energy = now
+        if now // 1800 != self.lasttime_saved // 1800:
+            self._save_state()
+
+    def _plan_backfill( self, now ):
+        """記録が30分以上途切れていれば、途切れた期間の日を補完の対象にする"""
+        last = self.lasttime_energy
+        if self.backfill and self.backfill_range is not None:
+            # 前回の補完が終わっていなければ、その期間も含める
+            last = min(last, self.backfill_range[0])
+        self.backfill = []
+        self.backfill_step = None
+        if self.state_file is None or not last or now - last < 1800:
+            return
+        today = datetime.date.today()
+        first = max(datetime.date.fromtimestamp(last), today - datetime.timedelta(days=self.backfill_days))
+        # 古い日から順に（0 が今日、1 が前日）
+        self.backfill = list(range((today - first).days, -1, -1))
+        self.backfill_range = (last, now)
+        logger.info('energy history gap ' + time.strftime('%Y/%m/%d %H:%M', time.localtime(last))
+                    + ' - ' + time.strftime('%Y/%m/%d %H:%M', time.localtime(now))
+                    + ', backfill ' + str(len(self.backfill)) + ' days')
+
+    def _send_backfill( self ):
+        """補完する日があれば、積算履歴収集日（E5）を書き込む"""
+        if not self.backfill or self.backfill_step is not None:
+            return
+        if 'E1' in self.schedule and not self.unit_known:
+            # 単位（E1）がわかるまで待つ
+            return
+        if len(self.transactions) >= self.max_inflight:
+            return
+        day = self.backfill[0]
+        if self._request(['E5'], edt={'E5': '{:02X}'.format(day)}):
+            self.backfill_step = 'set'
+
+    def _next_backfill( self, reason=None ):
+        """補完中の日を終えて次の日に進む"""
+        if reason is not None:
+            logger.warning('backfill failed (' + reason + ') day=' + str(self.backfill[0]))
+        self.backfill.pop(0)
+        self.backfill_step = None
+        if not self.backfill:
+            logger.info('backfill finished')
+
+    def _accept_set( self, dataframe ):
+        """書き込み要求の応答（Set_Res 71, SetC_SNA 51）を処理する"""
+        if 'E5' not in dataframe.properties or self.backfill_step != 'set':
+            return
+        if dataframe.esv == '51':
+            # 積算履歴収集日を設定できないスマートメーター
+            logger.warning('meter does not accept E5, backfill canceled')
+            self.backfill = []
+            self.backfill_step = None
+            return
+        epc_list = ['E2', 'E4'] if self.history_reverse else ['E2']
+        if self._request(epc_list):
+            self.backfill_step = 'get'
+        else:
+            self.backfill_step = None
 
-        def getvalue(rawdata):
-            value = int(rawdata, 16)
-            return value * self.coefficient * self.unit
+    def _decode_history( self, epc, edt ):
+        """積算電力量計測値履歴 E2, E4（正方向, 逆方向）
+
+        収集日と30分ごとの積算電力量 48コマをまとめて取り出し、補完する期間のコマを
+        元の時刻のデータとして記録する。値として返すものはない。
+        """
+        values = _HISTORY.unpack(edt)
+        day = values[0]
+        if self.backfill_step != 'get' or not self.backfill or day != self.backfill[0]:
+            logger.debug('history for day ' + str(day) + ' is ignored')
+            return []
+
+        sensor = 'E0' if epc == 'E2' else 'E3'
+        date = datetime.date.today() - datetime.timedelta(days=day)
+        base = time.mktime(date.timetuple())
+        start, end = self.backfill_range
+        factor = self.coefficient * self.unit
+        count = 0
+        for i, raw in enumerate(values[1:]):
+            ts = base + i * 1800
+            if start < ts < end and raw != HISTORY_NO_DATA:
+                self.record_que.put([self.unit_id, sensor, raw * factor, 'H', ts])
+                count += 1
+        logger.info('backfill ' + date.strftime('%Y/%m/%d') + ' ' + sensor + ' ' + str(count) + ' values')
+
+        # 要求した履歴がすべて揃ったら次の日へ
+        if epc == 'E2' and not self.history_reverse or epc == 'E4':
+            self._next_backfill()
+        return []
+
+    def _decode_power( self, epc, edt ):
+        """瞬時電力 E7（符号付き32bit, W）"""
+        return [[epc, _INT32.unpack(edt)[0]]]
+
+    def _decode_current( self, epc, edt ):
+        """瞬時電流計測値 E8（R相、T相 符号付き16bit, 0.1A）"""
+        rvalue, tvalue = _INT16X2.unpack(edt)
+        return [['E8R', rvalue * 0.1], ['E8T', tvalue * 0.1]]
+
+    def _decode_energy( self, epc, edt ):
+        """積算電力量（正／負）E0, E3"""
+        value = _UINT32.unpack(edt)[0] * self.coefficient * self.unit
+        if epc == 'E0':
+            self._recorded_energy(datetime.datetime.now().timestamp())
+        return [[epc, value]]
+
+    def _set_calibration( self, epc, value ):
+        """係数（D3）、有効桁数（D7）、単位（E1）を設定する
+
+        戻り値:
+            True: 値が変わった
+            False: 前回と同じ値
+        """
+        if epc == 'D3':
+            self.coefficient = value
+        elif epc == 'D7':
+            self.effective_digits = value
+        elif epc == 'E1':
+            self.unit = ENERGY_UNIT.get(value, 0.1)
+            self.unit_known = True
+        changed = self.calibration.get(epc) != value
+        self.calibration[epc] = value
+        return changed
+
+    def _calibrated( self, epc, value ):
+        """スマートメーターから読み出した係数、有効桁数、単位を設定し、変わっていれば保存する"""
+        if self._set_calibration(epc, value):
+            logger.info('calibration of ' + self.unit_id + ' changed: ' + epc + ' = ' + str(value))
+            self._save_state()
+
+    def _decode_coefficient( self, epc, edt ):
+        """係数 coefficient D3"""
+        value = int.from_bytes(edt, 'big')
+        self._calibrated(epc, value)
+        logger.debug('cofficient = ' + str(value))
+        return [[epc, value]]
+
+    def _decode_digits( self, epc, edt ):
+        """積算電力有効桁数 effective digits D7"""
+        value = int.from_bytes(edt, 'big')
+        self._calibrated(epc, value)
+        logger.debug('effective_digits = ' + str(value))
+        return [[epc, value]]
+
+    def _decode_unit( self, epc, edt ):
+        """積算電力単位 unit E1"""
+        value = int.from_bytes(edt, 'big')
+        self._calibrated(epc, value)
+        logger.debug('unit = ' + str(self.unit))
+        return [[epc, value]]
+
+    def _decode_fixed_time_energy( self, epc, edt ):
+        """定時 積算電力量 計測値 EA, EB（正方向, 逆方向計測値）"""
+        year, month, day, hour, minute, second, raw = _DATETIME_UINT32.unpack(edt)
+        value = raw * self.coefficient * self.unit
+        logger.info("{:0=4}/{:0=2}/{:0=2} {:0=2}:{:0=2}:{:0=2}".format(year,month,day,hour,minute,second)
+                    + ' ' + epc + ' = ' + str(value))
+        return [[epc, value]]
+
+    def _decode_announce_map( self, epc, edt ):
+        """状変アナウンスプロパティマップ 9D（通知されるプロパティの一覧、記録はしない）"""
+        self.announced = decode_property_map(edt)
+        logger.info('announced properties: ' + ','.join(sorted(self.announced)))
+        return []
 
-        def datestr(rawdata):
-            year = int(rawdata[:4],16)
-            month = int(rawdata[4:6],16)
-            day =int (rawdata[6:8],16)
-            hour = int(rawdata[8:10],16)
-            minute = int(rawdata[10:12],16)
-            second = int(rawdata[12:14],16)
-            return "{:0=4}/{:0=2}/{:0=2} {:0=2}:{:0=2}:{:0=2}".format(year,month,day,hour,minute,second)
+    def _accept( self, dataframe ):
+        """受信した電文を受け付ける処理
 
+        プロパティごとに self.decoders のデコード関数でバイト列から値を取り出し、記録する。
+        """
         seoj = dataframe.seoj
         esv = dataframe.esv
-        if seoj == '028801' and esv in ['72','73']:
-            # 送信元が '028801'（スマートメーター）で ESV が 72（プロパティ値要求の応答）
-            for epc, edt in dataframe.properties.items():
-                if epc == 'E7': # 瞬時電力 E7
-                    value = hex_to_signed_int(edt)
-                    self.record_que.put(['BR', epc, value, 'X'])
-
-                elif epc == 'E8': # 瞬時電流計測値
-                    rphase = edt[:4]
-                    tphase = edt[4:]
-                    rvalue = hex_to_signed_int(rphase) * 0.1 # アンペア
-                    tvalue = hex_to_signed_int(tphase) * 0.1 # アンペア
-                    self.record_que.put(['BR', 'E8R', rvalue, 'X'])
-                    self.record_que.put(['BR', 'E8T', tvalue, 'X'])
-
-                elif epc in ['E0','E3']: # 積算電力量（正／負）
-                    value = getvalue(edt)
-                    self.record_que.put(['BR', epc, value, 'X'])
-
-                elif epc == 'D3': # 係数 coefficient D3
-                    value = int(edt, 16)
-                    self.coefficient = value
-                    logger.debug('cofficient = ' + str(value))
-                    self.record_que.put(['BR', epc, value, 'X'])
-
-                elif epc == 'D7': # 積算電力有効桁数 effective digits D7
-                    value = int(edt, 16)
-                    self.effective_digits = value
-                    logger.debug('effective_digits = ' + str(value))
-                    self.record_que.put(['BR', epc, value, 'X'])
-
-                elif epc == 'E1': # 積算電力単位 unit E1
-                    value = int(edt, 16)
-                    if value == 0x00:
-                        unit = 1.0
-                    elif value== 0x01:
-                        unit = 0.1
-                    elif value == 0x02:
-                        unit = 0.01
-                    elif value == 0x03:
-                        unit = 0.001
-                    elif value == 0x04:
-                        unit = 0.0001
-                    elif value == 0x0A:
-                        unit = 10.0
-                    elif value == 0x0B:
-                        unit =  100.0
-                    elif value == 0x0C:
-                        unit =  1000.0
-                    elif value == 0x0D:
-                        unit = 10000.0
-                    else:
-                        value = 0.1
-                    self.unit = unit
-                    logger.debug('unit = ' + str(self.unit))
-                    self.record_que.put(['BR','E1',value,'X'])
-
-                elif epc in ['EA', 'EB']: # 定時 積算電力量 計測値 (正方向,逆方向計測値)
-                    value = getvalue(edt[14:])
-                    logger.info(datestr(edt[:14]) + ' ' + epc + ' = ' + str(value))
-                    self.record_que.put(['BR', epc, value, 'X'])
+        if seoj == '028801' and esv in ['71','51']:
+            # 書き込み要求の応答
+            self._accept_set(dataframe)
 
-                else:
-                    logger.warning('unknown property:' + epc + ' value:' + edt)
+        elif seoj == '028801' and esv in ['72','73','74']:
+            # 送信元が '028801'（スマートメーター）で ESV が 72（プロパティ値要求の応答）
+            # 73（プロパティ値通知）、74（プロパティ値通知（応答要））
+            if esv in ['73','74']:
+                now = datetime.datetime.now().timestamp()
+                for epc in dataframe.edt:
+                    self.lasttime_notify[epc] = now
+                if esv == '74':
+                    # 応答要の通知には INFC_Res を返す
+                    self._sendto(DataFrame.cmd_infc_response(dataframe))
+
+            for epc, edt in dataframe.edt.items():
+                decoder = self.decoders.get(epc)
+                if decoder is None:
+                    logger.warning('unknown property:' + epc + ' value:' + edt.hex().upper())
+                    continue
+                try:
+                    values = decoder(epc, edt)
+                except struct.error:
+                    logger.error('invalid property data:' + epc + ' value:' + edt.hex().upper())
+                    continue
+                for sensor, value in values:
+                    self.record_que.put([self.unit_id, sensor, value, 'X'])
+                    if sensor in self.adaptive:
+                        self._adapt(sensor, value, datetime.datetime.now().timestamp())
 
         else:
-            # スマートメーターからのプロパティ読み出し応答以外の電文を処理
-            # ESV=73 プロパティ値通知も定期的に受信している
-            #   EPC=EA:定時 積算電力量 計測値 (正方向計測値)
-            #   EPC=EB:定時 積算電力量 計測値 (逆方向計測値)
+            # スマートメーターからのプロパティ読み出し応答、通知以外の電文を処理
             logger.warning('unknown SEOJ or ESV : ' + dataframe.seoj + ',' + dataframe.esv)
             logger.warning(dataframe.endict())
 
     def _term( self ):
+        self._save_state()
         self.wisundev.term()
         self.wisundev.close()
 
@@ -1277,25 +2113,14 @@ class BrouteReader ( Worker ):
 
             # 以下は接続状態（JOIN）においての処理
             elif self.state == self._STATE_JOIN:
-                """
-                ToDo:
-                    トランザクション管理
-                    TIDの対応付け、成功失敗時の何らかの処理したほうが良い。
-                    失敗時に再送など。info の場合
-                """
                 now = datetime.datetime.now().timestamp()
 
                 # 必要があればここで定期的に _rejoin() を行う。
 
-                for req in self.requests:
-                    # 要求するデータのリストについて、定期的に値要求する
-                    if now - req['lasttime'] > req['cycle']:
-                        cmd = DataFrame.cmd_get_property(req['epc'])
-                        res = self._sendto(cmd)
-                        if req['lasttime'] == 0:
-                            req['lasttime'] = now
-                        else:
-                            req['lasttime'] += req['cycle']
+                # 応答のない要求の再送と、周期が来た要求の送信
+                self._check_transactions(now)
+                self._send_requests(now)
+                self._send_backfill()
 
                 # スマートメーターからの電文を待つ
                 # この関数は電文があれば直ちに DataFrame オブジェクトを返すが、
@@ -1306,6 +2131,8 @@ class BrouteReader ( Worker ):
                 if dataframe:
                     now = datetime.datetime.now().timestamp()
                     self.lasttime_receive = now
+                    self.tx_failures = 0
+                    self._match_transaction(dataframe)
                     self._accept(dataframe)
 
                 else:
@@ -1313,13 +2140,15 @@ class BrouteReader ( Worker ):
                     # print('.')
                     pass
 
-                # 過去10分(600秒)で 電文受信が発生しなかったら初期化
-                if now - self.lasttime_receive > 600:
-                    logger.error('ERROR broute data receive timeout')
-                    self.wisundev.term()
-                    self.wisundev.close()
-                    self.state = self._STATE_INIT
-                    time.sleep(5)
+                # セッションの失効などのイベントを受け取ったら接続を回復する
+                # receive_timeout 秒（10分）電文受信が発生しなかったら接続を回復する
+                lost_event = self.wisundev.session_event()
+                if lost_event is not None:
+                    self._recover('session lost (EVENT ' + lost_event + ')')
+                elif now - self.lasttime_receive > self.receive_timeout:
+                    self._recover('broute data receive timeout')
+                elif self.tx_failures >= self.recover_after:
+                    self._recover('no response for ' + str(self.tx_failures) + ' requests')
 
         # スレッドストップイベントがセットされ、run()の終了の前
         self._term()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""センサー値の外れ値をチェックする
+
+    * Checker: チェッカーのアブストラクトクラス
+    * OutlierChecker: センサーごとに外れ値の規則を定義してチェックする
+
+OutlierChecker の規則（add() で指定、すべて省略可）
+    * 定義域 min, max: 範囲外の値は外れ値
+    * 変動 variation: 前回値からの変動が大きい値は外れ値
+    * 移動中央値と MAD mad: 直近 window 個の中央値から MAD の mad 倍以上離れた値は外れ値
+    * EWMA の z スコア zscore: 指数移動平均から標準偏差の zscore 倍以上離れた値は外れ値
+
+変動、MAD、z スコアの外れ値が STRIKES 回続いたら、その値を新しい基準とする
+（値の水準が本当に変わった場合に、いつまでも外れ値にしないため）。
+
+センサーごとの状態は、登録順の番号で引く配列（array）に持つ。
+check_batch() は Queue からまとめて取り出したデータを一度に調べる。
+numpy がインストールされていて、バッチに MAD か z スコアの規則を持つセンサーの値が
+STATS_BATCH_MIN 件以上あれば、それらの値を配列をコピーせずに numpy で評価する。
+定義域と変動だけの規則のセンサーは、いつも1件ずつ check() と同じ方法で調べる。
+
+numpy で評価する場合の違い（check() を順に呼んだ場合と比べて）
+    * MAD と z スコアは、バッチの開始時点の移動中央値、MAD、指数移動平均、標準偏差と比べる。
+      バッチの中の値で統計が動いても判定には使わないので、統計のしきい値の近くの値は
+      結果が変わることがある
+    * 外れ値の疑いがある値を含むセンサーと、統計がまだ落ち着いていないセンサー（基準からの
+      データ数が window 未満、z スコアは SETTLE_SPANS / alpha 未満）は、そのバッチの値を
+      すべて1件ずつ順に調べるので、check() と同じ結果になる
+    * 基準が変わった直後の大きく乱れた統計は、落ち着くまで1件ずつ調べるが、落ち着いた後も
+      バッチの中では統計の残りの乱れが判定に残る（z スコアの標準偏差が大きめで、外れ値を見逃しやすい）
+    * 定義域と変動は、バッチの中の1つ前の値と比べるので、check() と同じ結果になる
+
+1つの OutlierChecker は1つのワーカーだけで使う（SerialReader などの読み取り側か、
+FileRecorder, SqlRecorder の記録側のどちらか）。前回値などの状態を持つので、
+両方で同じ OutlierChecker を使うと、同じ値を2回数えてしまう。
+"""
+
+import sys
+import math
+import itertools
+from array import array
+from abc import ABCMeta, abstractmethod
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+INF = float('inf')
+NAN = float('nan')
+
+class Checker (metaclass=ABCMeta):
+    """センサー値をチェックするクラス（アブストラクト）
+    """
+    @abstractmethod
+    def check(self, unit, sensor, value):
+        """ユニット、センサー、その値を受け取りチェックしてTrueまたはFalseを返す
+        オーバーライドする
+        """
+        pass
+
+    def check_batch(self, units, sensors, values):
+        """複数のデータをまとめてチェックする
+
+        引数：
+            units (list of str): ユニットの識別子
+            sensors (list of str): センサーの識別子
+            values (list of number): データの値
+
+        戻り値:
+            [True または False, ...]（引数と同じ順）
+        """
+        return [self.check(unit, sensor, value) for unit, sensor, value in zip(units, sensors, values)]
+
+def _median( values ):
+    """ソート済みのリストの中央値"""
+    half = len(values) // 2
+    if len(values) % 2:
+        return values[half]
+    return (values[half - 1] + values[half]) / 2
+
+class OutlierChecker ( Checker ):
+    """センサーごとに必要があれば外れ値を定義しチェックする
+
+    外れ値とは、
+        * 定義域を外れた値
+        * 一定値以上に大きな変動を示した値
+        * 移動中央値、または指数移動平均（EWMA）から統計的に大きく離れた値
+    """
+
+    # この回数続いた外れ値（定義域外を除く）は新しい基準とする
+    STRIKES = 3
+    # 新しい基準から、MAD と z スコアの判定を始めるまでのデータ数
+    MIN_SAMPLES = 5
+    # check_batch() の numpy 版で、統計が落ち着くまで1件ずつ調べるデータ数の目安
+    # （z スコアは指数移動平均の時定数 1 / alpha のこの倍数）
+    SETTLE_SPANS = 3
+    # MAD を正規分布の標準偏差に換算する係数
+    MAD_SCALE = 1.4826
+    # check_batch() で numpy を使う、MAD か z スコアの規則を持つセンサーの値の最小の件数
+    # （これより少ないと1件ずつの方が速い、keibench checker）
+    STATS_BATCH_MIN = 40
+
+    def __init__(self, window=15):
+        """コンストラクタ
+
+        引数：
+            window (int): 移動中央値と MAD を計算するデータ数
+        """
+        super().__init__()
+        self.window = window
+        # {(unit, sensor): 番号}
+        self.index = {}
+        # 番号ごとの (unit, sensor)
+        self.names = []
+
+        # 番号で引く規則（check() 用に (min, max, variation, 統計の規則があるか) のタプルも持つ）
+        self.rules = []
+        self.lo = array('d')
+        self.hi = array('d')
+        self.variation = array('d')
+        self.mad = array('d')
+        self.zscore = array('d')
+        self.alpha = array('d')
+        # 番号で引く状態（prev: 前回値、count: 基準からのデータ数、strikes: 続いた外れ値の数）
+        self.prev = array('d')
+        self.count = array('q')
+        self.strikes = array('q')
+        self.mean = array('d')
+        self.var = array('d')
+        # 移動中央値の窓（番号 * window から window 個、空きは NaN）
+        self.win = array('d')
+        self.winpos = array('q')
+        # 番号で引く、numpy でまとめて評価を始める基準からのデータ数
+        self.settle = array('q')
+        # MAD か z スコアの規則を持つセンサーの番号
+        self.robust = set()
+
+    def check(self, unit, sensor, value):
+        """引数に与えたセンサーと値の組について、
+
+        外れ値であればFalseを返す
+        引数：
+            unit (str): ユニットの識別子
+            sensor (str): センサーの識別子
+            value (number): データの値
+        """
+        i = self.index.get((unit, sensor))
+        if i is None:
+            return True
+        return self._check(i, value)
+
+    def _check(self, i, value):
+        """番号 i のセンサーの値をチェックし、状態を更新する"""
+        min, max, variation, stats = self.rules[i]
+        if not(min <= value <= max):
+            return False
+
+        if self.count[i] and (abs(value - self.prev[i]) > variation
+                              or stats and self._deviates(i, value)):
+            strikes = self.strikes[i] + 1
+            if strikes < self.STRIKES:
+                self.strikes[i] = strikes
+                return False
+            # 外れ値が続いたので、この値を新しい基準とする
+            self._reset(i)
+
+        if stats:
+            self._update_stats(i, value, self.count[i])
+        self.prev[i] = value
+        self.strikes[i] = 0
+        self.count[i] += 1
+        return True
+
+    def _deviates(self, i, value):
+        """移動中央値や指数移動平均と比べて外れ値であれば True"""
+        count = self.count[i]
+        if count < self.MIN_SAMPLES:
+            return False
+
+        if self.mad[i]:
+            base = i * self.window
+            values = self.win[base : base + self.window]
+            if count < self.window:
+                values = [x for x in values if x == x]
+            values = sorted(values)
+            median = _median(values)
+            mad = _median(sorted([abs(x - median) for x in values]))
+            # MAD が 0 のとき（一定の値が続いている）は判定しない
+            if mad and abs(value - median) > self.mad[i] * self.MAD_SCALE * mad:
+                return True
+
+        if self.zscore[i]:
+            sd = math.sqrt(self.var[i])
+            if sd and abs(value - self.mean[i]) > self.zscore[i] * sd:
+                return True
+
+        return False
+
+    def _update_stats(self, i, value, count):
+        """外れ値でなかった値で統計（指数移動平均と移動中央値の窓）を更新する
+
+        引数：
+            count (int): この値より前の、基準からのデータ数
+        """
+        if self.zscore[i]:
+            if count:
+                # 指数移動平均と分散の逐次計算
+                alpha = self.alpha[i]
+                diff = value - self.mean[i]
+                incr = alpha * diff
+                self.mean[i] += incr
+                self.var[i] = (1 - alpha) * (self.var[i] + diff * incr)
+            else:
+                self.mean[i] = value
+                self.var[i] = 0.0
+
+        if self.mad[i]:
+            pos = self.winpos[i]
+            self.win[i * self.window + pos] = value
+            self.winpos[i] = (pos + 1) % self.window
+
+    def _reset(self, i):
+        """統計を捨てて、次の値から新しい基準とする"""
+        self.count[i] = 0
+        self.winpos[i] = 0
+        base = i * self.window
+        for k in range(base, base + self.window):
+            self.win[k] = NAN
+
+    def check_batch(self, units, sensors, values):
+        """複数のデータをまとめてチェックする
+
+        結果と状態の更新は check() を順に呼んだ場合と同じ。
+        ただし numpy で評価する場合、MAD と z スコアはバッチの開始時点の統計と比べる
+        （モジュールの説明を参照）。
+
+        引数：
+            units (list of str): ユニットの識別子
+            sensors (list of str): センサーの識別子
+            values (list of number): データの値
+
+        戻り値:
+            [True または False, ...]（引数と同じ順）
+        """
+        # 未登録のセンサーは -1
+        ids = list(map(self.index.get, zip(units, sensors), itertools.repeat(-1)))
+        if numpy is None or sum(map(self.robust.__contains__, ids)) < self.STATS_BATCH_MIN:
+            check = self._check
+            return [i < 0 or check(i, value) for i, value in zip(ids, values)]
+        return self._check_numpy(ids, values)
+
+    def _view(self, arr):
+        """配列をコピーせずに numpy の配列として参照する"""
+        return numpy.frombuffer(arr, dtype=arr.typecode)
+
+    def _check_numpy(self, ids, values):
+        """check_batch() の numpy 版
+
+        1. 定義域と変動だけの規則のセンサーの値は、_check() で1件ずつ順に調べる
+        2. MAD か z スコアの規則を持つセンサーの値は、定義域、変動、MAD、z スコアをまとめて評価する
+        3. 外れ値の疑いがあるセンサーと、統計がまだ落ち着いていないセンサーの値は、
+           _check() で1件ずつ順に調べる
+        4. それ以外のセンサーの値はすべて OK、状態をまとめて更新する
+        """
+        ids = numpy.array(ids, dtype=numpy.intp)
+        result = numpy.ones(len(ids), dtype=bool)
+        rows = numpy.flatnonzero(ids >= 0)
+        mad = self._view(self.mad)
+        zscore = self._view(self.zscore)
+
+        # 定義域と変動だけの規則のセンサーは1件ずつ（元の順）
+        i = ids[rows]
+        plain = (mad[i] == 0) & (zscore[i] == 0)
+        if plain.any():
+            check = self._check
+            result[rows[plain]] = [check(k, value) for k, value
+                                   in zip(i[plain].tolist(), [values[r] for r in rows[plain].tolist()])]
+            rows = rows[~plain]
+        if not rows.size:
+            return result.tolist()
+
+        # 定義域の外は外れ値（状態は変わらない）
+        i = ids[rows]
+        v = numpy.asarray(values, dtype=numpy.float64)[rows]
+        inside = (self._view(self.lo)[i] <= v) & (v <= self._view(self.hi)[i])
+        result[rows[~inside]] = False
+        rows, i, v = rows[inside], i[inside], v[inside]
+        if not rows.size:
+            return result.tolist()
+
+        # センサーごとにまとめる（同じセンサーの中では元の順）
+        order = numpy.argsort(i, kind='stable')
+        rows, i, v = rows[order], i[order], v[order]
+        first = numpy.ones(len(i), dtype=bool)
+        first[1:] = i[1:] != i[:-1]
+        last = numpy.ones(len(i), dtype=bool)
+        last[:-1] = first[1:]
+        # センサーの中での順番
+        start = numpy.flatnonzero(first)
+        rank = numpy.arange(len(i)) - numpy.repeat(start, numpy.diff(numpy.append(start, len(i))))
+
+        # 前回値はバッチの中の1つ前の値（先頭はこれまでの前回値）
+        count = self._view(self.count)
+        prev = numpy.empty_like(v)
+        prev[1:] = v[:-1]
+        prev[first] = self._view(self.prev)[i[first]]
+        deviates = ((count[i] > 0) | ~first) & (numpy.abs(v - prev) > self._view(self.variation)[i])
+
+        # 統計が落ち着いたセンサー（基準からのデータ数が settle 以上）だけをまとめて評価する
+        ready = count[i] >= self._view(self.settle)[i]
+        zscore = zscore[i]
+        if zscore.any():
+            sd = numpy.sqrt(self._view(self.var)[i])
+            deviates |= ready & (sd > 0) & (numpy.abs(v - self._view(self.mean)[i]) > zscore * sd)
+
+        mad = mad[i]
+        judge = ready & (mad > 0)
+        if judge.any():
+            # 窓には MIN_SAMPLES 個以上の値がある。ソートすると空き（NaN）は後ろに並ぶので、
+            # 値の数から中央値の位置を決める
+            target = numpy.unique(i[judge])
+            win = self._view(self.win).reshape(-1, self.window)[target]
+            filled = numpy.minimum(count[target], self.window)
+            lower, upper, line = (filled - 1) // 2, filled // 2, numpy.arange(len(target))
+            win.sort(axis=1)
+            median = (win[line, lower] + win[line, upper]) / 2
+            win = numpy.abs(win - median[:, None])
+            win.sort(axis=1)
+            spread = (win[line, lower] + win[line, upper]) / 2
+            at = numpy.searchsorted(target, i)
+            at[~judge] = 0
+            deviates |= judge & (spread[at] > 0) \
+                        & (numpy.abs(v - median[at]) > mad * self.MAD_SCALE * spread[at])
+
+        # 外れ値の疑いがあるセンサーと、統計がまだ落ち着いていないセンサーは1件ずつ順に調べる
+        slow = numpy.isin(i, i[deviates | ~ready])
+        check = self._check
+        result[rows[slow]] = [check(k, value) for k, value in zip(i[slow].tolist(), v[slow].tolist())]
+
+        # 統計は1件ずつ順に更新し、前回値などは最後の値でまとめて更新する
+        fast = ~slow
+        if fast.any():
+            update = self._update_stats
+            for k, value, n in zip(i[fast].tolist(), v[fast].tolist(), (count[i] + rank)[fast].tolist()):
+                update(k, value, n)
+            tail = fast & last
+            count[i[tail]] += rank[tail] + 1
+            self._view(self.prev)[i[tail]] = v[tail]
+            self._view(self.strikes)[i[tail]] = 0
+
+        return result.tolist()
+
+    def add(self, unit, sensor, min=-INF, max=INF, variation=INF, mad=0, zscore=0, alpha=0.1):
+        """チェックリストにセンサーの定義域と変動範囲を指定する
+        引数；
+            unit (str): ユニット識別子 unitid
+            sensor (str): センサーの識別子 sensorid
+            min (number): 最小値、これより小さい値は外れ値とみなす
+            max (number): 最大値、これより大きい値は外れ値とみなす
+            variation (number): 変動範囲、これより大きな変動は外れ値とみなす。
+                ただし、３回目以上変動の外れ値が続いたら、それを新しい基準とする。
+            mad (number): 直近 window 個の中央値から、MAD（標準偏差に換算）のこの倍数より
+                離れた値は外れ値とみなす。0 なら判定しない
+            zscore (number): 指数移動平均から、標準偏差のこの倍数より離れた値は外れ値とみなす。
+                0 なら判定しない
+            alpha (number): 指数移動平均の平滑化係数（0 < alpha <= 1、小さいほどゆっくり追従する）
+        """
+        unit = sys.intern(unit)
+        sensor = sys.intern(sensor)
+        i = self.index.get((unit, sensor))
+        if i is None:
+            i = self.index[(unit, sensor)] = len(self.names)
+            self.names.append((unit, sensor))
+            self.rules.append(None)
+            for arr in (self.lo, self.hi, self.variation, self.mad, self.zscore, self.alpha,
+                        self.prev, self.mean, self.var):
+                arr.append(0.0)
+            for arr in (self.count, self.strikes, self.winpos, self.settle):
+                arr.append(0)
+            self.win.extend([NAN] * self.window)
+
+        self.lo[i] = min
+        self.hi[i] = max
+        self.variation[i] = INF if variation is None else variation
+        self.mad[i] = mad
+        self.zscore[i] = zscore
+        self.alpha[i] = alpha
+        self.rules[i] = (min, max, self.variation[i], bool(mad or zscore))
+        # min, max は引数の名前なので、組み込み関数を使わずに大きい方を選ぶ
+        settle = [self.window, self.MIN_SAMPLES]
+        if zscore:
+            settle.append(math.ceil(self.SETTLE_SPANS / alpha))
+        self.settle[i] = sorted(settle)[-1]
+        if mad or zscore:
+            self.robust.add(i)
+        else:
+            self.robust.discard(i)
+        self.strikes[i] = 0
+        self._reset(i)
+        logger.debug('add ' + sensor + '_' + unit)
+        return True
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""データを列ごとのバイナリファイルに保存・読み出しする
+
+テキストのデータファイル（[YYYYMMDD]-[fname_base].txt）を毎回解析しなくても、
+ファイルをメモリマップしてそのまま配列として読み出せるようにする。
+
+1日分のデータを1つのディレクトリ [YYYYMMDD]-[fname_base].col/ に保存する。
+
+    ts.i64      タイムスタンプ（UNIX時刻の秒, int64）
+    value.f64   センサー値（float64）
+    unit.u16    ユニットIDの番号（uint16、dict.json の units の添字）
+    sensor.u16  センサーIDの番号（uint16、dict.json の sensors の添字）
+    dict.json   ユニットID、センサーIDの辞書 {"units": [...], "sensors": [...]}
+
+* 各ファイルはリトルエンディアンで、追記のみ行う
+* 書き込み途中で停止した場合に列の長さがそろわないことがあるが、
+  読み出し時は最も短い列の長さまでを有効なデータとする。
+  また、ColumnarWriter がその日を開くときに、すべての列を最も短い列の長さに切り詰める
+  （切り詰めずに追記すると、それ以降の行がずれてしまうため）
+* numpy がインストールされていれば numpy の配列で、なければ array で返す
+
+コマンドラインからの利用:
+    テキストのデータファイルを変換
+        $ python3 -m keilib.columnar convert 20191201-mylogfile.txt ...
+    データの読み出し
+        $ python3 -m keilib.columnar read mylogfile BR E7 "2019/12/01 00:00" "2019/12/02 00:00"
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import datetime
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+# 列の定義 (ファイル名, array の型コード, numpy の型)
+COLUMNS = [
+    ('ts',     'q', '<i8'),
+    ('value',  'd', '<f8'),
+    ('unit',   'H', '<u2'),
+    ('sensor', 'H', '<u2'),
+]
+COLUMN_FILES = {
+    'ts':     'ts.i64',
+    'value':  'value.f64',
+    'unit':   'unit.u16',
+    'sensor': 'sensor.u16',
+}
+
+def day_dirname( fname_base, day, directory='.' ):
+    """1日分のデータを保存するディレクトリ名
+
+    引数：
+        fname_base (str): ファイル名の基本文字列
+        day (str): YYYYMMDD 形式の日付
+        directory (str): 保存先のディレクトリ
+    """
+    return os.path.join(directory, day + '-' + fname_base + '.col')
+
+def _truncate_columns( dirname ):
+    """すべての列ファイルを、最も短い列の行数に切り詰める
+
+    書き込み途中で停止して列の長さがそろっていない場合に、追記を始める前に呼び出す。
+
+    戻り値:
+        切り詰めた後の行数
+    """
+    sizes = {}
+    for name, code, dtype in COLUMNS:
+        try:
+            sizes[name] = os.path.getsize(os.path.join(dirname, COLUMN_FILES[name]))
+        except OSError:
+            sizes[name] = 0
+    rows = min(sizes[name] // array(code).itemsize for name, code, dtype in COLUMNS)
+
+    for name, code, dtype in COLUMNS:
+        size = rows * array(code).itemsize
+        if sizes[name] > size:
+            logger.warning('truncate ' + COLUMN_FILES[name] + ' in ' + dirname
+                           + ' to ' + str(rows) + ' rows (' + str(sizes[name] - size) + ' bytes)')
+            with open(os.path.join(dirname, COLUMN_FILES[name]), 'r+b') as f:
+                f.truncate(size)
+    return rows
+
+def _load_dict( dirname ):
+    """ユニットID、センサーIDの辞書を読み出す"""
+    try:
+        with open(os.path.join(dirname, 'dict.json'), 'r') as f:
+            d = json.load(f)
+        return d.get('units', []), d.get('sensors', [])
+    except (OSError, ValueError):
+        return [], []
+
+class ColumnarWriter ( ):
+    """データを日ごとの列ファイルに追記する
+
+    データはメモリ上の配列にためておき、flush_rows 件以上になるか
+    flush_interval 秒を経過したら、列ごとにまとめて追記する。
+    """
+
+    def __init__( self, fname_base, directory='.', flush_rows=256, flush_interval=30 ):
+        """コンストラクタ
+
+        引数：
+            fname_base (str): ファイル名の基本文字列（これに日付情報が付加される）
+            directory (str): 保存先のディレクトリ
+            flush_rows (int): この件数以上たまったら書き出す
+            flush_interval (number): データがこの秒数を経過したら書き出す
+        """
+        self.fname_base = fname_base
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self.day = None
+        self.dirname = None
+        self.units = []
+        self.sensors = []
+        self.unit_codes = {}
+        self.sensor_codes = {}
+        self.dict_dirty = False
+        self._reset_buffer()
+
+    def _reset_buffer( self ):
+        self.buff = {name: array(code) for name, code, dtype in COLUMNS}
+        self.bufftime = 0
+
+    def _open_day( self, day ):
+        """日付が変わったら保存先のディレクトリを切り替える"""
+        self.flush()
+        self.day = day
+        self.dirname = day_dirname(self.fname_base, day, self.directory)
+        os.makedirs(self.dirname, exist_ok=True)
+        # 前回の書き込みが途中で止まっていたら、列の長さをそろえてから追記する
+        _truncate_columns(self.dirname)
+        self.units, self.sensors = _load_dict(self.dirname)
+        self.unit_codes = {u: i for i, u in enumerate(self.units)}
+        self.sensor_codes = {s: i for i, s in enumerate(self.sensors)}
+
+    def _code( self, codes, names, name ):
+        """ID を辞書の番号に変換する（新しい ID は辞書に追加）"""
+        code = codes.get(name)
+        if code is None:
+            code = len(names)
+            names.append(name)
+            codes[name] = code
+            self.dict_dirty = True
+        return code
+
+    def append( self, ts, unit, sensor, value, day=None ):
+        """データを1件追加する
+
+        引数：
+            ts (int): タイムスタンプ（UNIX時刻の秒）
+            unit (str): ユニットID
+            sensor (str): センサーID
+            value (number): センサー値
+            day (str): YYYYMMDD 形式の日付（省略すると ts から求める）
+        """
+        if day is None:
+            day = time.strftime('%Y%m%d', time.localtime(ts))
+        if day != self.day:
+            self._open_day(day)
+
+        buff = self.buff
+        if not len(buff['ts']):
+            self.bufftime = time.monotonic()
+        buff['ts'].append(int(ts))
+        buff['value'].append(float(value))
+        buff['unit'].append(self._code(self.unit_codes, self.units, unit))
+        buff['sensor'].append(self._code(self.sensor_codes, self.sensors, sensor))
+
+        if len(buff['ts']) >= self.flush_rows:
+            self.flush()
+
+    def tick( self ):
+        """経過時間による書き出し。定期的に呼び出すこと。"""
+        if len(self.buff['ts']) and time.monotonic() - self.bufftime >= self.flush_interval:
+            self.flush()
+
+    def flush( self ):
+        """ためているデータを列ファイルに追記する"""
+        if not len(self.buff['ts']):
+            return
+
+        # 列データより先に辞書を書き出す（辞書にない番号が残らないように）
+        if self.dict_dirty:
+            tmpname = os.path.join(self.dirname, 'dict.json.tmp')
+            with open(tmpname, 'w') as f:
+                json.dump({'units': self.units, 'sensors': self.sensors}, f)
+            os.replace(tmpname, os.path.join(self.dirname, 'dict.json'))
+            self.dict_dirty = False
+
+        for name, code, dtype in COLUMNS:
+            data = self.buff[name]
+            if sys.byteorder == 'big':
+                data.byteswap()
+            with open(os.path.join(self.dirname, COLUMN_FILES[name]), 'ab') as f:
+                f.write(data.tobytes())
+        self._reset_buffer()
+
+    def close( self ):
+        """ためているデータを書き出す"""
+        self.flush()
+
+def _map_column( dirname, name ):
+    """列ファイルをメモリマップする（空のときは None）"""
+    path = os.path.join(dirname, COLUMN_FILES[name])
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+def open_day( dirname ):
+    """1日分の列ファイルをメモリマップして配列として返す
+
+    引数：
+        dirname (str): 1日分のデータのディレクトリ
+
+    戻り値:
+        {'ts', 'value', 'unit', 'sensor': 列の配列, 'units', 'sensors': IDのリスト}
+        numpy があれば numpy.ndarray、なければ memoryview（どちらもコピーしない）
+        データがなければ None
+    """
+    maps = {}
+    for name, code, dtype in COLUMNS:
+        mm = _map_column(dirname, name)
+        if mm is None:
+            return None
+        maps[name] = mm
+
+    # 列の長さをそろえる（書き込み途中の停止対策）
+    rows = min(len(maps[name]) // array(code).itemsize for name, code, dtype in COLUMNS)
+    units, sensors = _load_dict(dirname)
+    result = {'units': units, 'sensors': sensors}
+    for name, code, dtype in COLUMNS:
+        if numpy is not None:
+            result[name] = numpy.frombuffer(maps[name], dtype=dtype, count=rows)
+        else:
+            # memoryview.cast はネイティブのバイトオーダーで解釈する
+            result[name] = memoryview(maps[name]).cast('B')[:rows * array(code).itemsize].cast(code)
+    return result
+
+def read_range( fname_base, unit, sensor, start, end, directory='.' ):
+    """指定したユニット、センサー、期間のデータを読み出す
+
+    引数：
+        fname_base (str): ファイル名の基本文字列
+        unit (str): ユニットID
+        sensor (str): センサーID
+        start (datetime): 期間の始め（この時刻を含む）
+        end (datetime): 期間の終わり（この時刻を含まない）
+        directory (str): 保存先のディレクトリ
+
+    戻り値:
+        (タイムスタンプの配列, センサー値の配列)
+        numpy があれば numpy.ndarray、なければ array
+    """
+    ts_start = int(time.mktime(start.timetuple()))
+    ts_end = int(time.mktime(end.timetuple()))
+    ts_parts = []
+    value_parts = []
+
+    day = start.date()
+    while day <= end.date():
+        cols = open_day(day_dirname(fname_base, day.strftime('%Y%m%d'), directory))
+        day += datetime.timedelta(days=1)
+        if cols is None:
+            continue
+        if unit not in cols['units'] or sensor not in cols['sensors']:
+            continue
+        ucode = cols['units'].index(unit)
+        scode = cols['sensors'].index(sensor)
+
+        if numpy is not None:
+            ts = cols['ts']
+            mask = (cols['unit'] == ucode) & (cols['sensor'] == scode) \
+                 & (ts >= ts_start) & (ts < ts_end)
+            ts_parts.append(ts[mask])
+            value_parts.append(cols['value'][mask])
+        else:
+            ts = array('q')
+            value = array('d')
+            for t, v, u, s in zip(cols['ts'], cols['value'], cols['unit'], cols['sensor']):
+                if u == ucode and s == scode and ts_start <= t < ts_end:
+                    ts.append(t)
+                    value.append(v)
+            ts_parts.append(ts)
+            value_parts.append(value)
+
+    if numpy is not None:
+        if not ts_parts:
+            return numpy.zeros(0, dtype='<i8'), numpy.zeros(0, dtype='<f8')
+        return numpy.concatenate(ts_parts), numpy.concatenate(value_parts)
+    else:
+        ts = array('q')
+        value = array('d')
+        for t, v in zip(ts_parts, value_parts):
+            ts.extend(t)
+            value.extend(v)
+        return ts, value
+
+def convert_textfile( path, directory=None ):
+    """テキストのデータファイルを列ファイルに変換する
+
+    引数：
+        path (str): [YYYYMMDD]-[fname_base].txt 形式のデータファイル
+        directory (str): 保存先のディレクトリ（省略するとデータファイルと同じ場所）
+
+    戻り値:
+        変換したデータの件数
+
+    変換先に既にデータがあるときは追記になるので注意。
+    """
+    dirname, filename = os.path.split(path)
+    if directory is None:
+        directory = dirname or '.'
+    day, fname_base = filename[:-len('.txt')].split('-', 1)
+
+    writer = ColumnarWriter(fname_base, directory, flush_rows=4096, flush_interval=float('inf'))
+    # 同じ時間帯の行は mktime の結果を使い回す
+    hourcache = {}
+    count = 0
+    with open(path, 'r') as f:
+        for line in f:
+            cols = line.rstrip('\n').split(',')
+            if len(cols) < 4:
+                continue
+            stamp = cols[0]
+            try:
+                hour = stamp[:13]
+                base = hourcache.get(hour)
+                if base is None:
+                    base = int(time.mktime((int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+                                            int(stamp[11:13]), 0, 0, 0, 0, -1)))
+                    hourcache[hour] = base
+                ts = base + int(stamp[14:16]) * 60 + int(stamp[17:19])
+                value = float(cols[3])
+            except ValueError:
+                logger.warning('invalid line: ' + line.strip())
+                continue
+            writer.append(ts, cols[1], cols[2], value, day=day)
+            count += 1
+    writer.close()
+    return count
+
+def main( argv ):
+    """コマンドラインからの利用"""
+    if len(argv) >= 2 and argv[0] == 'convert':
+        for path in argv[1:]:
+            count = convert_textfile(path)
+            print(path + ': ' + str(count) + ' rows')
+        return 0
+
+    elif len(argv) == 6 and argv[0] == 'read':
+        fname_base, unit, sensor = argv[1:4]
+        start = datetime.datetime.strptime(argv[4], '%Y/%m/%d %H:%M')
+        end = datetime.datetime.strptime(argv[5], '%Y/%m/%d %H:%M')
+        ts, value = read_range(fname_base, unit, sensor, start, end)
+        for t, v in zip(ts, value):
+            stamp = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(int(t)))
+            print(stamp + ',' + unit + ',' + sensor + ',' + str(round(float(v), 4)))
+        return 0
+
+    print(__doc__)
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""FileRecorder が保存したデータファイルを読み出す
+
+[YYYYMMDD]-[fname_base].txt から、ユニット、センサー、期間を指定して
+データまたは集計値を取り出す。
+
+* データファイルごとに小さな索引ファイル（[データファイル名].idx）を作る
+    - 時（hour）ごとのバイト位置 [開始, 終了]
+    - (unit, sensor) ごとにデータが存在する時（hour）のリスト
+    - データファイルのサイズと更新時刻
+* 読み出しの際は索引を使い、必要な時間帯だけを seek して読む
+* 索引はデータファイルのサイズか更新時刻が変わったときだけ作り直す
+  （データファイルは追記のみなので、増えた部分だけを読んで索引に追加する）
+* FileArchiver が圧縮したデータファイルは、展開せずに先頭から読み出す（索引は使わない）
+  アーカイブした後に補完データが書かれた日は、データファイルとアーカイブの両方を読む
+
+コマンドラインからの利用（kei.py のサブコマンド）:
+    $ python3 kei.py query mylogfile BR E7 "2019/12/01 00:00" "2019/12/02 00:00"
+    $ python3 kei.py query mylogfile BR E7 "2019/12/01 00:00" "2019/12/02 00:00" --span 3600
+    $ python3 kei.py query mylogfile BR E7 "2019/12/01 00:00" "2019/12/02 00:00" --archive /var/keilog/archive
+"""
+
+import os
+import sys
+import json
+import time
+import datetime
+import itertools
+
+from keilib.aggregator import RollingAggregator, slot_mean, slot_std, COUNT, MIN, MAX, LAST
+from keilib.archiver import open_archived
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+INDEX_VERSION = 1
+
+def day_filename( fname_base, day, directory='.' ):
+    """1日分のデータファイル名
+
+    引数：
+        fname_base (str): ファイル名の基本文字列
+        day (date): 日付
+        directory (str): データファイルのあるディレクトリ
+    """
+    return os.path.join(directory, day.strftime('%Y%m%d') + '-' + fname_base + '.txt')
+
+def build_index( filename, index=None ):
+    """データファイルの索引を作る
+
+    引数：
+        filename (str): データファイル名
+        index (dict): 既存の索引。指定するとその続きから読んで索引に追加する
+
+    戻り値:
+        索引の辞書
+            'version': 索引の形式のバージョン
+            'size', 'mtime': 索引を作ったときのデータファイルのサイズと更新時刻
+            'hours': {'hh': [開始バイト, 終了バイト]}
+            'sensors': {'unit,sensor': [hh, ...]}
+    """
+    st = os.stat(filename)
+    if index is None:
+        hours = {}
+        sensors = {}
+        pos = 0
+    else:
+        hours = index['hours']
+        sensors = index['sensors']
+        pos = index['size']
+
+    with open(filename, 'rb') as f:
+        f.seek(pos)
+        for line in f:
+            end = pos + len(line)
+            # 行の形式 YYYY/MM/DD hh:mm:ss,unit,sensor,value,id
+            hour = line[11:13].decode('ascii', 'replace')
+            span = hours.get(hour)
+            if span is None:
+                hours[hour] = [pos, end]
+            else:
+                span[1] = end
+            cols = line.split(b',', 3)
+            if len(cols) >= 3:
+                key = cols[1].decode('ascii', 'replace') + ',' + cols[2].decode('ascii', 'replace')
+                hlist = sensors.setdefault(key, [])
+                if hour not in hlist:
+                    hlist.append(hour)
+            pos = end
+    for hlist in sensors.values():
+        hlist.sort()
+    return {'version': INDEX_VERSION, 'size': pos, 'mtime': st.st_mtime,
+            'hours': hours, 'sensors': sensors}
+
+def load_index( filename ):
+    """データファイルの索引を読み出す。なければ作り、古くなっていれば作り直す
+
+    戻り値:
+        索引の辞書
+    """
+    idxname = filename + '.idx'
+    st = os.stat(filename)
+    index = None
+    try:
+        with open(idxname, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION or index['size'] > st.st_size:
+            index = None
+        elif index['size'] == st.st_size and index['mtime'] == st.st_mtime:
+            return index
+    except (OSError, ValueError, KeyError):
+        index = None
+
+    logger.debug('build index ' + filename)
+    index = build_index(filename, index)
+    try:
+        tmpname = idxname + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmpname, idxname)
+    except OSError as err:
+        # 書き込めなくても読み出しには支障がない
+        logger.warning('cannot write index ' + idxname + ': ' + str(err))
+    return index
+
+def _parse_time( stamp ):
+    """YYYY/MM/DD hh:mm:ss を UNIX時刻にする"""
+    return time.mktime((int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+                        int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19]), 0, 0, -1))
+
+def _read_lines( filename, index, unit, sensor, hour_from, hour_to ):
+    """索引を使って、指定したセンサーのデータを含む時間帯の行だけを読む"""
+    hlist = index['sensors'].get(unit + ',' + sensor, [])
+    hlist = [h for h in hlist if hour_from <= h <= hour_to]
+    if not hlist:
+        return
+
+    with open(filename, 'rb') as f:
+        # 連続する時間帯はまとめて読む
+        regions = []
+        for h in hlist:
+            start, end = index['hours'][h]
+            regions.append([start, end])
+        # 連続する、または重なる時間帯（補完データが後から追記された場合）をまとめる
+        regions.sort()
+        merged = []
+        for start, end in regions:
+            if merged and merged[-1][1] >= start:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        regions = merged
+
+        for start, end in regions:
+            f.seek(start)
+            for line in f.read(end - start).splitlines():
+                yield line.decode('ascii', 'replace')
+
+def _read_archived( filename, archive_dir, unit, sensor ):
+    """圧縮されたデータファイルから、指定したセンサーの行を読む"""
+    f = open_archived(os.path.basename(filename), archive_dir)
+    if f is None:
+        return
+    prefix = ',' + unit + ',' + sensor + ','
+    with f:
+        for line in f:
+            if prefix in line:
+                yield line.rstrip('\n')
+
+def samples( fname_base, unit, sensor, start, end, directory='.', archive_dir=None ):
+    """指定したユニット、センサー、期間のデータを返す
+
+    引数：
+        fname_base (str): ファイル名の基本文字列
+        unit (str): ユニットID
+        sensor (str): センサーID
+        start (datetime): 期間の始め（この時刻を含む）
+        end (datetime): 期間の終わり（この時刻を含まない）
+        directory (str): データファイルのあるディレクトリ
+        archive_dir (str): アーカイブディレクトリ（省略すると directory/archive）
+
+    戻り値:
+        (UNIX時刻, 値) を時刻順に返すジェネレータ
+    """
+    if archive_dir is None:
+        archive_dir = os.path.join(directory, 'archive')
+    ts_start = time.mktime(start.timetuple())
+    ts_end = time.mktime(end.timetuple())
+    day = start.date()
+    while day <= end.date():
+        hour_from = start.strftime('%H') if day == start.date() else '00'
+        hour_to = end.strftime('%H') if day == end.date() else '23'
+        filename = day_filename(fname_base, day, directory)
+        day += datetime.timedelta(days=1)
+        # アーカイブした後に補完データが書かれると、同じ日のデータファイルとアーカイブが両方ある
+        lines = _read_archived(filename, archive_dir, unit, sensor)
+        if os.path.exists(filename):
+            index = load_index(filename)
+            lines = itertools.chain(lines, _read_lines(filename, index, unit, sensor, hour_from, hour_to))
+
+        rows = []
+        for line in lines:
+            cols = line.split(',')
+            if len(cols) < 4 or cols[1] != unit or cols[2] != sensor:
+                continue
+            try:
+                ts = _parse_time(cols[0])
+                value = float(cols[3])
+            except ValueError:
+                continue
+            if ts_start <= ts < ts_end:
+                rows.append((ts, value))
+        # 補完データは後から追記されるので、時刻順に並べ替える
+        rows.sort(key=lambda row: row[0])
+        yield from rows
+
+def aggregates( fname_base, unit, sensor, start, end, span, directory='.', archive_dir=None ):
+    """指定したユニット、センサー、期間のデータを span 秒ごとに集計して返す
+
+    引数は samples() と同じ（span は集計する秒数）
+
+    戻り値:
+        (集計期間の開始時刻 datetime, 集計スロット) のリスト
+        集計スロットの内容は keilib.aggregator を参照
+    """
+    result = []
+    def emit( spec, dt, rows ):
+        for u, s, slot in rows:
+            result.append((dt, slot))
+
+    aggregator = RollingAggregator([{'span': span}], emit)
+    for ts, value in samples(fname_base, unit, sensor, start, end, directory, archive_dir):
+        aggregator.add(ts, unit, sensor, value)
+    # 最後の集計期間を確定させる
+    aggregator.tick(time.mktime(end.timetuple()) + span)
+    return result
+
+def main( argv ):
+    """コマンドラインからの利用
+
+    引数: fname_base unit sensor start end [--span 秒] [--dir ディレクトリ] [--archive ディレクトリ]
+    （--archive は FileArchiver の archive_dir、省略すると --dir の archive）
+    """
+    args = []
+    span = 0
+    directory = '.'
+    archive_dir = None
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--span' and i + 1 < len(argv):
+            span = int(argv[i + 1])
+            i += 2
+        elif argv[i] == '--dir' and i + 1 < len(argv):
+            directory = argv[i + 1]
+            i += 2
+        elif argv[i] == '--archive' and i + 1 < len(argv):
+            archive_dir = argv[i + 1]
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+
+    if len(args) != 5:
+        print(__doc__)
+        return 1
+
+    fname_base, unit, sensor = args[:3]
+    start = datetime.datetime.strptime(args[3], '%Y/%m/%d %H:%M')
+    end = datetime.datetime.strptime(args[4], '%Y/%m/%d %H:%M')
+
+    if span:
+        for dt, slot in aggregates(fname_base, unit, sensor, start, end, span, directory, archive_dir):
+            print(dt.strftime('%Y/%m/%d %H:%M') + ',' + unit + ',' + sensor + ','
+                  + str(slot_mean(slot)) + ',' + str(int(slot[COUNT])) + ',' + str(slot[MIN])
+                  + ',' + str(slot[MAX]) + ',' + str(slot[LAST]) + ',' + str(slot_std(slot)))
+    else:
+        for ts, value in samples(fname_base, unit, sensor, start, end, directory, archive_dir):
+            stamp = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(ts))
+            print(stamp + ',' + unit + ',' + sensor + ',' + str(value))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 """データを保存するためのクラスを定義
 
+    * FileRecorder: テキストファイルへの保存
+    * SqlRecorder: SQLite データベースへの保存
+
+どちらも checker（keilib.checker.OutlierChecker など）を指定すると、
+record_que からまとめて取り出したデータの外れ値を check_batch() で一度に除く。
+
 ToDo:
-    * リレーショナルデータベースへの保存
     * データの流れをもっと細かく制御するクラスなど
 
 """
@@ -11,11 +16,165 @@ ToDo:
 import threading
 import datetime
 import time
+import os
+import queue
+import sqlite3
 from keilib.worker import Worker
+from keilib.aggregator import RollingAggregator, span_label, slot_mean, slot_std, \
+                              COUNT, MIN, MAX, LAST
+from keilib.columnar import ColumnarWriter
 
 from logging import getLogger, StreamHandler, DEBUG
 logger = getLogger(__name__)
 
+def drain_queue( que, batch_max, timeout=3 ):
+    """Queue からデータをまとめて取り出す
+
+    最初の1件はタイムアウト付きで待ち、その後はキューにたまっている分を
+    batch_max 件まで待たずに取り出す。
+
+    戻り値:
+        取り出したデータのリスト（タイムアウトの場合は空のリスト）
+    """
+    try:
+        items = [que.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+
+    while len(items) < batch_max:
+        try:
+            items.append(que.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def check_items( checker, items ):
+    """checker で外れ値を調べ、外れ値でないデータだけを返す
+
+    元の時刻があるデータ [unit, sensor, value, id, ts] は過去のデータなのでチェックしない。
+    """
+    live = [item for item in items if len(item) <= 4]
+    if not live:
+        return items
+    results = checker.check_batch([item[0] for item in live], [item[1] for item in live],
+                                  [item[2] for item in live])
+    if all(results):
+        return items
+
+    outliers = set()
+    for item, ok in zip(live, results):
+        if not ok:
+            logger.error('sensor value outlier error ' + item[1] + '_' + item[0] + ': ' + str(item[2]))
+            outliers.add(id(item))
+    return [item for item in items if id(item) not in outliers]
+
+class BufferedFileWriter ( ):
+    """ファイルを開いたまま保持し、書き込むデータをバッファにためてまとめて書き出す
+
+    1行ごとに open/close を繰り返さないので、システムコールの回数と
+    SDカードへの細かい書き込みを減らすことができる。
+
+    * 書き出しのタイミング
+        - バッファが flush_size バイト以上になったとき
+        - バッファの最も古いデータが flush_interval 秒を経過したとき
+        - 書き込み先のファイル名が変わったとき（日付が変わったとき）
+        - close() されたとき
+
+    * fsync の方針
+        - FSYNC_NEVER:    fsync しない（OSに任せる）
+        - FSYNC_BATCH:    書き出しのたびに fsync する
+        - FSYNC_INTERVAL: fsync_interval 秒ごとに fsync する
+    """
+    FSYNC_NEVER = 0
+    FSYNC_BATCH = 1
+    FSYNC_INTERVAL = 2
+
+    def __init__( self, flush_size=4096, flush_interval=30, fsync=FSYNC_NEVER, fsync_interval=60 ):
+        """コンストラクタ
+
+        引数：
+            flush_size (int): バッファがこのバイト数を超えたら書き出す
+            flush_interval (number): バッファのデータがこの秒数を経過したら書き出す
+            fsync (int): fsync の方針 FSYNC_NEVER/FSYNC_BATCH/FSYNC_INTERVAL
+            fsync_interval (number): FSYNC_INTERVAL の場合の fsync 間隔（秒）
+        """
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        self.filename = None
+        self.f = None
+        self.buff = []
+        self.buffsize = 0
+        self.bufftime = 0
+        self.synctime = time.monotonic()
+        self.unsynced = False
+
+    def write( self, filename, data ):
+        """data を filename に追記する（バッファに追加する）
+
+        引数：
+            filename (str): 書き込み先のファイル名
+            data (str): 書き込む文字列
+        """
+        if filename != self.filename:
+            # 日付が変わるなどしてファイル名が変わったら、前のファイルを閉じる
+            self.close()
+            self.filename = filename
+
+        if not self.buff:
+            self.bufftime = time.monotonic()
+        self.buff.append(data)
+        self.buffsize += len(data)
+
+        if self.buffsize >= self.flush_size:
+            self.flush()
+
+    def tick( self ):
+        """経過時間による書き出しと fsync を行う。定期的に呼び出すこと。"""
+        now = time.monotonic()
+        if self.buff and now - self.bufftime >= self.flush_interval:
+            self.flush()
+        elif self.fsync == self.FSYNC_INTERVAL and self.unsynced \
+                and now - self.synctime >= self.fsync_interval:
+            self._sync()
+
+    def flush( self ):
+        """バッファの内容をファイルに書き出す"""
+        if not self.buff:
+            return
+
+        if self.f is None:
+            self.f = open(self.filename, 'a')
+        self.f.write(''.join(self.buff))
+        self.f.flush()
+        self.buff = []
+        self.buffsize = 0
+        self.unsynced = True
+
+        if self.fsync == self.FSYNC_BATCH:
+            self._sync()
+        elif self.fsync == self.FSYNC_INTERVAL:
+            if time.monotonic() - self.synctime >= self.fsync_interval:
+                self._sync()
+
+    def _sync( self ):
+        """ファイルの内容をストレージに同期する"""
+        if self.f is not None:
+            os.fsync(self.f.fileno())
+        self.synctime = time.monotonic()
+        self.unsynced = False
+
+    def close( self ):
+        """バッファを書き出してファイルを閉じる"""
+        self.flush()
+        if self.f is not None:
+            if self.fsync != self.FSYNC_NEVER and self.unsynced:
+                self._sync()
+            self.f.close()
+            self.f = None
+
 class FileRecorder ( Worker ):
     """record_queからデータを取り出し、それをファイルに保存する。
 
@@ -24,23 +183,40 @@ class FileRecorder ( Worker ):
         - 10分ごとの平均を記録: sum[YYYYMMDD]-[fnameBase].txt
         - ファイルは日毎に作成。ファイル名には日付の情報が含まれる
 
+    * 集計は RollingAggregator が担当する。aggregates を指定すると、
+      1分、5分、1時間など複数の集計期間をそれぞれ別のファイルや Queue に出力できる
+
     * 保存に際して
         - record_que から取り出したときのタイムスタンプを追加
         − 保存形式は、TIMESTAMP、UNIT_ID, SENSOR_ID, VALUE, DATA_ID
         - タイムスタンプは YYYY/MM/DD hh:mm:ss の形式
         例) 2019/12/01 19:12:03,A,T1,12.3,0F<LF>
+        - 5番目の要素に UNIX時刻があるデータ [unit, sensor, value, id, ts] は、
+          その時刻のデータとしてその日のファイルに記録する（集計はしない）
 
     * upload_que が指定されていれば 10分平均データを追加
+      （aggregates を指定した場合は、各集計期間の 'que' に追加）
 
     * disp_def に指定されたデータは disp_queに追加
 
+    * record_que にたまっているデータは batch_max 件までまとめて取り出し、
+      同じタイムスタンプを付けて一度に書き出す
+
+    * columnar=True のときは、テキストのファイルに加えて列ごとのバイナリファイル
+      [YYYYMMDD]-[fnameBase].col/ にも保存する（keilib.columnar を参照）
+
+    * buffered=True のときは BufferedFileWriter を使い、ファイルを開いたまま
+      まとめて書き出す（デフォルトは従来通り1行ごとに open/close する）
+
     ToDo:
         * 機能が固定的で柔軟性がない、もっと柔軟かつシンプルに設定できればよい
         * アップロードやディスプレイへ送信するなどの機能は、他のクラスに担当させるべき
-        * 10分平均の計算なども別クラスがよいかも、さらに柔軟に5分平均などへの対応も
     """
 
-    def __init__( self , record_que, fname_base='data', upload_que=None, disp_def=[] ,disp_que=None):
+    def __init__( self , record_que, fname_base='data', upload_que=None, disp_def=[] ,disp_que=None,
+                  buffered=False, flush_size=4096, flush_interval=30,
+                  fsync=BufferedFileWriter.FSYNC_NEVER, fsync_interval=60, batch_max=100,
+                  aggregates=None, columnar=False, checker=None ):
         """コンストラクタ
 
         引数：
@@ -50,60 +226,129 @@ class FileRecorder ( Worker ):
             -- 以下未実装機能 --
             disp_def (list):    外部表示機 Displayer に送るためのデータを定義。
             disp_queue (Queue): Displayer オブジェクトにデータを送るための Queue
+            -- 以下 buffered=True のときの設定 --
+            buffered (bool):    ファイルを開いたままにしてまとめて書き出す
+            flush_size (int):   バッファがこのバイト数を超えたら書き出す
+            flush_interval (number): バッファのデータがこの秒数を経過したら書き出す
+            fsync (int):        fsync の方針（BufferedFileWriter.FSYNC_*）
+            fsync_interval (number): FSYNC_INTERVAL の場合の fsync 間隔（秒）
+            -- その他 --
+            batch_max (int):    record_que から一度に取り出すデータの最大件数
+            aggregates (list of dict): 集計期間ごとの出力の定義。省略すると10分平均のみ。
+                'span' (int):    集計期間（秒）、必須
+                'prefix' (str):  出力ファイル名の接頭辞 [prefix][YYYYMMDD]-[fname_base].txt
+                                 省略すると 'sum' + 01m,01h などの期間を表す文字列
+                'file' (bool):   ファイルに出力するか（デフォルト True）
+                'que' (Queue):   [ファイル名, データ] を送る Queue（HttpPostUploader 等）
+                'stats' (bool):  True のとき平均値に加えて件数、最小、最大、最終値、標準偏差も出力
+                例) [{'span': 60}, {'span': 600, 'prefix': 'sum', 'que': upload_que},
+                     {'span': 3600, 'stats': True}]
+            columnar (bool):    列ごとのバイナリファイルにも保存する
+            checker (Checker):  取り出したデータの外れ値をまとめて除く
         """
         super().__init__()
         self.fileNameBase = fname_base
         self.record_que = record_que
         self.upload_que = upload_que
         self.disp_que = disp_que
-
-        self.sum10m = {}
-        now = datetime.datetime.today()
-        self.datePre = now.strftime('%Y/%m/%d')
-        self.key10mPre = now.strftime('%Y%m%d%H%M%S')[:11] + '0'
+        self.checker = checker
+
+        if buffered:
+            writer_args = {
+                'flush_size': flush_size,
+                'flush_interval': flush_interval,
+                'fsync': fsync,
+                'fsync_interval': fsync_interval
+            }
+            self.writer = BufferedFileWriter(**writer_args)
+        else:
+            writer_args = None
+            self.writer = None
+
+        if columnar:
+            self.colwriter = ColumnarWriter(fname_base, flush_interval=flush_interval)
+        else:
+            self.colwriter = None
+
+        # 集計期間の定義（省略時は従来通りの10分平均）
+        if aggregates is None:
+            aggregates = [{'span': 600, 'prefix': 'sum', 'que': upload_que}]
+        self.aggregates = []
+        for spec in aggregates:
+            spec = dict(spec)
+            spec.setdefault('prefix', 'sum' + span_label(spec['span']))
+            spec.setdefault('file', True)
+            spec.setdefault('que', None)
+            spec.setdefault('stats', False)
+            if writer_args is not None:
+                spec['writer'] = BufferedFileWriter(**writer_args)
+            else:
+                spec['writer'] = None
+            self.aggregates.append(spec)
+        self.aggregator = RollingAggregator(self.aggregates, self._write_aggregate)
+
+        # 一度に取り出したデータ件数の度数分布 {件数: 回数}（10分ごとにログに出力）
+        self.batch_max = batch_max
+        self.batch_stats = {}
+        self.statsTime = time.time()
+
+        self.stampsec = None
         self.disp_def = disp_def
         self._update_timestamp()
 
     def _update_timestamp( self ):
-        """タイムスタンプ値のアップデート"""
-        now = datetime.datetime.today()
+        """タイムスタンプ値のアップデート
+
+        時刻の秒が前回と変わらなければ何もしない（strftime の呼び出しを減らす）
+        """
+        sec = int(time.time())
+        if sec == self.stampsec:
+            return
+        self.stampsec = sec
+        now = datetime.datetime.fromtimestamp(sec)
         self.date = now.strftime('%Y/%m/%d')
         self.mytime = now.strftime('%H:%M:%S')
         self.key01m = now.strftime('%Y%m%d%H%M%S')
-        self.key10m = self.key01m[:11] + '0'
 
-    def _write10m( self ):
-        """10分ごとの処理
+    def _write_aggregate( self, spec, start, rows ):
+        """集計期間ごとの処理（RollingAggregator から呼び出される）
 
-        10分平均をファイルに書き出す
-        upload_queにデータを送る
+        集計結果をファイルに書き出す
+        spec['que'] にデータを送る
         """
-        data = ''
-        for u in self.sum10m:
-            for s in self.sum10m[u]:
-                count = self.sum10m[u][s]['count']
-                mysum = self.sum10m[u][s]['sum']
-                avr = mysum / count
-                d = self.key10mPre
-                date10m = d[:4]+'/'+d[4:6]+'/'+d[6:8]+' '+d[8:10]+':'+d[10:12]
-                outtext = date10m + ',' + u + ',' + s + ',' + str(avr) + '\n'
-                data += outtext
+        datestr = start.strftime('%Y/%m/%d %H:%M')
+        lines = []
+        for unit, sensor, slot in rows:
+            if spec['stats']:
+                outtext = datestr + ',' + unit + ',' + sensor + ',' + str(slot_mean(slot)) \
+                        + ',' + str(int(slot[COUNT])) + ',' + str(slot[MIN]) + ',' + str(slot[MAX]) \
+                        + ',' + str(slot[LAST]) + ',' + str(slot_std(slot)) + '\n'
+            else:
+                outtext = datestr + ',' + unit + ',' + sensor + ',' + str(slot_mean(slot)) + '\n'
+            lines.append(outtext)
+        data = ''.join(lines)
 
         if data != '':
-            #filename = 'sum'+self.key01m[:8]+'-'+self.fileNameBase+'.txt'
-            filename = 'sum'+self.key10mPre[:8]+'-'+self.fileNameBase+'.txt'
-            with open(filename, 'a') as f:
-                f.write(data)
+            filename = spec['prefix'] + start.strftime('%Y%m%d') + '-' + self.fileNameBase + '.txt'
+            if spec['file']:
+                self._append(spec['writer'], filename, data)
 
-            if self.upload_que is not None:
+            if spec['que'] is not None:
                 try:
-                    self.upload_que.put([filename, data], block=False)
+                    spec['que'].put([filename, data], block=False)
                 except:
                     #print ('upload queue is full')
                     pass
 
-        self.sum10m = {}
-        self.key10mPre = self.key10m
+    def _log_batch_stats( self ):
+        """一度に取り出したデータ件数の度数分布を10分ごとにログに出力する"""
+        now = time.time()
+        if now - self.statsTime < 600:
+            return
+        self.statsTime = now
+        if self.batch_stats:
+            logger.info('batch sizes ' + str(dict(sorted(self.batch_stats.items()))))
+            self.batch_stats = {}
 
     def _writeline( self, unit, sensor, value, id='x' ):
         """データにタイムスタンプを追加してファイルに書き出す
@@ -118,21 +363,94 @@ class FileRecorder ( Worker ):
 
             [timestamp],[unit],[sensor],[value],[id]
         """
-        #print(self.disp_que)
-        if unit not in self.sum10m:
-            self.sum10m[unit] = {}
-        if sensor not in self.sum10m[unit]:
-            self.sum10m[unit][sensor] = {'count':0, 'sum':0.0}
-        self.sum10m[unit][sensor]['count'] += 1
-        self.sum10m[unit][sensor]['sum'] += value
-        # ファイルへの書き出し（1行）
-        linedata = self.date+' '+self.mytime+','+unit+','+sensor+','+str(round(value,4))+','+id+'\n'
+        self._writelines([[unit, sensor, value, id]])
+
+    def _writelines( self, items ):
+        """複数のデータに同じタイムスタンプを追加して、まとめてファイルに書き出す
+
+        引数：
+            items (list): [unit, sensor, value, id] のリスト
+                5番目の要素（UNIX時刻）があるデータはその時刻で記録する（_write_history）
+        """
+        if any(len(item) > 4 for item in items):
+            self._write_history([item for item in items if len(item) > 4])
+            items = [item for item in items if len(item) <= 4]
+            if not items:
+                return
+
+        stamp = self.date + ' ' + self.mytime + ','
+        ts = self.stampsec
+        lines = []
+        for unit, sensor, value, id in items:
+            self.aggregator.add(ts, unit, sensor, value)
+            lines.append(stamp+unit+','+sensor+','+str(round(value,4))+','+id+'\n')
+
+        # ファイルへの書き出し（まとめて1回）
         filename = self.key01m[:8]+'-'+self.fileNameBase+'.txt'
+        self._append(self.writer, filename, ''.join(lines))
+
+        if self.colwriter is not None:
+            day = self.key01m[:8]
+            for unit, sensor, value, id in items:
+                self.colwriter.append(ts, unit, sensor, value, day=day)
 
-        with open(filename, 'a') as f:
-            f.write(linedata)
+        for unit, sensor, value, id in items:
+            self._send_disp( unit, sensor, value )
 
-        self._send_disp( unit, sensor, value )
+    def _write_history( self, items ):
+        """元の時刻が指定されたデータを、その日のファイルに書き出す
+
+        スマートメーターの履歴による補完など、過去の時刻のデータ。
+        集計期間はすでに終わっているので集計はせず、disp_que にも送らない。
+
+        引数：
+            items (list): [unit, sensor, value, id, ts] のリスト
+        """
+        files = {}
+        for unit, sensor, value, id, ts in items:
+            tm = time.localtime(ts)
+            day = time.strftime('%Y%m%d', tm)
+            stamp = time.strftime('%Y/%m/%d %H:%M:%S', tm)
+            files.setdefault(day, []).append(stamp+','+unit+','+sensor+','+str(round(value,4))+','+id+'\n')
+            if self.colwriter is not None:
+                self.colwriter.append(ts, unit, sensor, value, day=day)
+
+        for day, lines in sorted(files.items()):
+            self._append(self.writer, day+'-'+self.fileNameBase+'.txt', ''.join(lines))
+
+    def _drain( self ):
+        """record_que からデータをまとめて取り出し、件数を記録する
+
+        戻り値:
+            取り出したデータのリスト（タイムアウトの場合は空のリスト）
+        """
+        items = drain_queue(self.record_que, self.batch_max)
+        size = len(items)
+        if size:
+            self.batch_stats[size] = self.batch_stats.get(size, 0) + 1
+            if self.checker is not None:
+                items = check_items(self.checker, items)
+        return items
+
+    def _append( self, writer, filename, data ):
+        """ファイルに追記する。writer があればそれを介してまとめて書き出す"""
+        if writer is None:
+            with open(filename, 'a') as f:
+                f.write(data)
+        else:
+            writer.write(filename, data)
+
+    def _tick_writers( self ):
+        """経過時間によるバッファの書き出し"""
+        for writer in [self.writer, self.colwriter] + [spec['writer'] for spec in self.aggregates]:
+            if writer is not None:
+                writer.tick()
+
+    def _close_writers( self ):
+        """バッファを書き出してファイルを閉じる"""
+        for writer in [self.writer, self.colwriter] + [spec['writer'] for spec in self.aggregates]:
+            if writer is not None:
+                writer.close()
 
     def _send_disp( self, unit, sensor, value ):
         """データが disp_def に一致するとき disp_queue に送信する
@@ -165,23 +483,178 @@ class FileRecorder ( Worker ):
 
     def run( self ):
         logger.info('[START]')
-        while not self.stopEvent.is_set():
-            # タイムスタンプ更新
-            self._update_timestamp()
-            # 10分ごとに平均値を書き出す
-            if self.key10m != self.key10mPre:
-                self._write10m()
-
-            # queueからデータの取得
+        try:
+            while not self.stopEvent.is_set():
+                # タイムスタンプ更新
+                self._update_timestamp()
+                # 集計期間が終わったら集計値を書き出す
+                self.aggregator.tick(self.stampsec)
+                # 時間経過によるバッファの書き出し
+                self._tick_writers()
+                self._log_batch_stats()
+
+                # queueからデータの取得（たまっている分はまとめて取り出す）
+                items = self._drain()
+                if not items:
+                    # logger.debug('file queue is empty')
+                    continue
+
+                # もう一度タイムスタンプ更新
+                self._update_timestamp()
+                # ファイルへの書き込み
+                self._writelines(items)
+
+        finally:
+            # 停止時（エラーによる停止も含む）はバッファを書き出す
+            self._close_writers()
+
+        logger.info('[STOP]')
+
+class SqlRecorder ( Worker ):
+    """record_queからデータを取り出し、SQLite データベースに保存する。
+
+    * data テーブル: すべてのデータの記録
+        - ts (UNIX時刻の秒), unit, sensor, value, dataid
+        - (unit, sensor, ts) の複合インデックスにより、期間を指定した読み出しは
+          インデックスの範囲検索になる
+        例) SELECT ts, value FROM data WHERE unit='BR' AND sensor='E7' AND ts >= ?
+
+    * rollup テーブル: 集計期間ごとの集計値（RollingAggregator で計算）
+        - span (集計期間の秒), ts (集計期間の開始時刻), unit, sensor,
+          count, mean, min, max, last, std
+
+    * 保存に際して
+        - record_que から取り出したときのタイムスタンプを追加
+          （5番目の要素に UNIX時刻があるデータはその時刻で記録し、集計はしない）
+        - データベースは WAL モードで使用する
+        - 書き込みは flush_interval 秒ごとに1回のトランザクションにまとめる
+        - 書き込みに失敗したとき（ディスクフル、I/O エラー、ロックなど）は、データを
+          ためたまま次の flush_interval 秒後に書き込み直す。ためるデータは max_rows 件までとし、
+          超えたら古いものから捨てる
+    """
+
+    def __init__( self, record_que, dbname='kei.db', flush_interval=10, batch_max=100, aggregates=None,
+                  checker=None, max_rows=100000 ):
+        """コンストラクタ
+
+        引数：
+            record_que (Queue): 保存するデータをここから取り出す
+            dbname (str):       データベースファイル名
+            flush_interval (number): この秒数ごとにまとめてデータベースに書き込む
+            batch_max (int):    record_que から一度に取り出すデータの最大件数
+            aggregates (list of dict): 集計期間の定義（'span' キーに秒を指定）。
+                省略すると10分のみ。 例) [{'span': 600}, {'span': 3600}]
+            checker (Checker):  取り出したデータの外れ値をまとめて除く
+            max_rows (int):     書き込めないときにためておくデータ（と集計値）の最大件数
+        """
+        super().__init__()
+        self.record_que = record_que
+        self.dbname = dbname
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.batch_max = batch_max
+        self.checker = checker
+        if aggregates is None:
+            aggregates = [{'span': 600}]
+        self.aggregator = RollingAggregator(aggregates, self._add_rollup)
+
+        self.rows = []
+        self.rollups = []
+        self.lastflush = time.monotonic()
+
+    def _connect( self ):
+        """データベースに接続し、テーブルとインデックスを作成する
+
+        sqlite3 の接続は作成したスレッドでしか使えないため run() の中で呼び出す
+        """
+        conn = sqlite3.connect(self.dbname)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS data ('
+                     'ts INTEGER NOT NULL, unit TEXT NOT NULL, sensor TEXT NOT NULL, '
+                     'value REAL, dataid TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS data_unit_sensor_ts ON data (unit, sensor, ts)')
+        conn.execute('CREATE TABLE IF NOT EXISTS rollup ('
+                     'span INTEGER NOT NULL, ts INTEGER NOT NULL, '
+                     'unit TEXT NOT NULL, sensor TEXT NOT NULL, '
+                     'count INTEGER, mean REAL, min REAL, max REAL, last REAL, std REAL, '
+                     'PRIMARY KEY (span, unit, sensor, ts))')
+        conn.commit()
+        return conn
+
+    def _add_rollup( self, spec, start, rows ):
+        """集計期間ごとの処理（RollingAggregator から呼び出される）"""
+        ts = int(time.mktime(start.timetuple()))
+        for unit, sensor, slot in rows:
+            self.rollups.append((spec['span'], ts, unit, sensor, int(slot[COUNT]),
+                                 slot_mean(slot), slot[MIN], slot[MAX], slot[LAST], slot_std(slot)))
+
+    def _flush( self, conn ):
+        """ためているデータを1回のトランザクションで書き込む"""
+        self.lastflush = time.monotonic()
+        if not self.rows and not self.rollups:
+            return
+
+        with conn:
+            if self.rows:
+                conn.executemany('INSERT INTO data (ts, unit, sensor, value, dataid) '
+                                 'VALUES (?, ?, ?, ?, ?)', self.rows)
+            if self.rollups:
+                conn.executemany('INSERT OR REPLACE INTO rollup '
+                                 '(span, ts, unit, sensor, count, mean, min, max, last, std) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self.rollups)
+        logger.debug('sql insert ' + str(len(self.rows)) + ' rows, '
+                     + str(len(self.rollups)) + ' rollups')
+        self.rows = []
+        self.rollups = []
+
+    def _try_flush( self, conn ):
+        """_flush() を呼び、失敗したらログに記録してデータは次の書き込みまでためておく"""
+        try:
+            self._flush(conn)
+        except sqlite3.Error as err:
+            logger.error('sql write error: ' + str(err) + ', keep ' + str(len(self.rows)) + ' rows, '
+                         + str(len(self.rollups)) + ' rollups')
+            for name in ('rows', 'rollups'):
+                buff = getattr(self, name)
+                if len(buff) > self.max_rows:
+                    logger.error('sql buffer is full, drop ' + str(len(buff) - self.max_rows)
+                                 + ' oldest ' + name)
+                    del buff[:len(buff) - self.max_rows]
+
+    def run( self ):
+        logger.info('[START] db=' + self.dbname)
+        conn = self._connect()
+        try:
+            while not self.stopEvent.is_set():
+                now = time.time()
+                self.aggregator.tick(now)
+                if time.monotonic() - self.lastflush >= self.flush_interval:
+                    self._try_flush(conn)
+
+                # queueからデータの取得（たまっている分はまとめて取り出す）
+                items = drain_queue(self.record_que, self.batch_max)
+                if self.checker is not None and items:
+                    items = check_items(self.checker, items)
+                if not items:
+                    continue
+
+                ts = int(time.time())
+                for item in items:
+                    if len(item) > 4:
+                        # 元の時刻が指定されたデータ（集計はしない）
+                        unit, sensor, value, dataid, itemts = item
+                        self.rows.append((int(itemts), unit, sensor, value, dataid))
+                        continue
+                    unit, sensor, value, dataid = item
+                    self.rows.append((ts, unit, sensor, value, dataid))
+                    self.aggregator.add(ts, unit, sensor, value)
+
+        finally:
+            # 停止時（エラーによる停止も含む）はためているデータを書き込む
             try:
-                unit, sensor, value, dataid = self.record_que.get(timeout=3)
-            except:
-                # logger.debug('file queue is empty')
-                continue
-
-            # もう一度タイムスタンプ更新
-            self._update_timestamp()
-            # ファイルへの書き込み
-            self._writeline(unit, sensor, value, dataid)
+                self._try_flush(conn)
+            finally:
+                conn.close()
 
         logger.info('[STOP]')
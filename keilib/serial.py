@@ -6,104 +6,458 @@
     * データフォーマット、型
     * 重複受信（無線通信での再送を検出）
     * 外れ値（チェッカー）
+
+ワーカーは3種類
+    * SerialReader: 1つのポートを1つのスレッドで読む
+    * AsyncSerialReader: SerialReader の asyncio 版
+    * SerialHub: 複数のポートを1つのスレッドで読む（ポートの抜き差しにも対応）
+
+データの形式は2種類（SerialReader の protocol 引数）
+    * 'text': UNITID,SENSORID,VALUE,DATAID<改行>（LineValidator）
+    * 'binary': 同期バイトと CRC16 のついたバイナリフレーム（FrameDecoder）
+      高い頻度で送るセンサー（電流クランプ、パルスカウンタなど）向け
 """
 
 import re
 import io
 import os
+import sys
 import time
+import struct
+import binascii
+import collections
+import fnmatch
+import asyncio
+import selectors
 import threading
 import serial
 import queue
-from abc import ABCMeta, abstractmethod
 
 from keilib.worker import Worker
+# Checker と OutlierChecker は keilib.checker に移動（従来通り keilib.serial からも使える）
+from keilib.checker import Checker, OutlierChecker
+from keilib.aioworker import AsyncWorker, put_nowait
 
 from logging import getLogger, StreamHandler, DEBUG
 logger = getLogger(__name__)
 
-class Checker (metaclass=ABCMeta):
-    """センサー値をチェックするクラス（アブストラクト）
-    """
-    @abstractmethod
-    def check(self, unit, sensor, value):
-        """ユニット、センサー、その値を受け取りチェックしてTrueまたはFalseを返す
-        オーバーライドする
-        """
-        pass
+class LineValidator ( ):
+    """シリアルポートから読み取った1行を検査して、記録するデータに変換する
+
+        * 無効な形式のデータを破棄
+        * checkerが指定されている場合、それを使用して外れ値を確認
+        * 再送されたデータの受信の破棄（無線の場合に起こる）
 
-class OutlierChecker ( Checker ):
-    """センサーごとに必要があれば外れ値を定義しチェックする
+    1行の形式の検査と項目の取り出しは1つの正規表現（LINE）で行う。
+    一致しなかった行だけ、項目ごとに検査して理由をログに出力する。
+    重複データの検査には、直近に受信した dedup_size 件のデータの集合を使う。
+    （以前と同じく件数の窓で、時間では判定しない。送信側の dataID は一巡するので、
+      時間の窓では同じ値が続くときに正しいデータを重複として捨ててしまう）
 
-    外れ値とは、
-        * 定義域を外れた値
-        * 一定値以上に大きな変動を示した値
+    SerialReader などのシリアルポートを読むワーカーで共通に使う
     """
 
-    def __init__(self):
-        """コンストラクタ"""
-        super().__init__()
-        self.check_list = {}
+    # UNITID,SENSORID,VALUE[,DATAID[,...]]（前後の空白は取り除いた行）
+    LINE = re.compile(r'(?P<unit>[a-zA-Z0-9_-]+) *, *(?P<sensor>[a-zA-Z0-9_-]+) *,'
+                      r' *(?P<value>[a-zA-Z0-9_.-]+) *'
+                      r'(?:, *(?P<dataid>[a-zA-Z0-9_;:.-]*(?: +[a-zA-Z0-9_;:.-]+)*) *'
+                      r'(?:,[a-zA-Z0-9_;:., -]*)?)?')
 
-    def check(self, unit, sensor, value):
-        """引数に与えたセンサーと値の組について、
+    def __init__( self, name, checker=None, dedup_size=10 ):
+        """コンストラクタ
 
-        外れ値であればFalseを返す
         引数：
-            unit (str): ユニットの識別子
-            sensor (str): センサーの識別子
-            value (number): データの値
+            name (str): ログに出力するポートの名前
+            cheker ( Checker ): 値をチェックする
+            dedup_size (int): 重複データの検査のために記憶する直近のデータの件数
         """
-        checkid = sensor + '_' + unit
-        if checkid in self.check_list.keys():
-            sensorData = self.check_list[checkid]
-            max = sensorData['max']
-            min = sensorData['min']
-            variation = sensorData['variation']
+        self.fileNameBase = name
+        self.rechkline = re.compile(r'^[a-zA-Z0-9_;:., -]*$')
+        self.rechkid = re.compile(r'^[a-zA-Z0-9-_]+$')
+        self.dataID = 0
+        self.checker = checker
 
-            if not(min <= value <= max):
-                return False
+        # 重複データの検査 直近に受信したデータの集合と、受信した順
+        self.dedup_size = dedup_size
+        self.recent = set()
+        self.recent_order = collections.deque()
+
+    def _diagnose( self, line ):
+        """正規表現に一致しなかった行について、無効な理由をログに出力する"""
+        # 文字化け等の不正データ
+        if not self.rechkline.match(line):
+            logger.warning('Receiving a invalid data, port=' + str(self.fileNameBase))
+            return
+
+        # unit, sensor, valueの３つが必要
+        line_list = line.split(',')
+        if len(line_list) < 3:
+            logger.warning('incomplete data, port=' + str(self.fileNameBase) + ' data=' + line)
+            return
+
+        unit, sensor, valueStr = [field.strip() for field in line_list[:3]]
+        if not self.rechkid.match(unit):
+            logger.warning('invarid unit id. "' + unit + '" port=' + self.fileNameBase)
+        elif not self.rechkid.match(sensor):
+            logger.warning('invarid sensor id. "' + sensor + '" port=' + self.fileNameBase)
+        else:
+            logger.warning('invalid numeric value ="' + valueStr + '", port=' + str(self.fileNameBase))
 
-            # 前回値との比較
-            if 'prev' in sensorData.keys():
-                prev = sensorData['prev']
-                if abs(value - prev) > variation:
-                    sensorData['count'] += 1
+    def validate( self, line ):
+        """1行を検査する
 
-                    if sensorData['count'] < 3:
-                        return False
+        引数：
+            line (str): 読み取った1行
+
+        戻り値:
+            [unit, sensor, value, dataID] のリスト（無効なデータの場合は None）
+        """
+        # 空行の場合スキップ
+        line = line.strip()
+        if line == '':
+            return None
+
+        match = self.LINE.fullmatch(line)
+        if match is None:
+            self._diagnose(line)
+            return None
+        unit, sensor, valueStr, dataID = match.groups()
+
+        # valueが有効な数値であるか
+        try:
+            value = float(valueStr)
+        except ValueError:
+            logger.warning('invalid numeric value ="' + valueStr + '", port=' + str(self.fileNameBase))
+            return None
+
+        # dataIDがない場合は連番をつける
+        if dataID is None:
+            dataID = str(self.dataID)
+            self.dataID += 1
+            if self.dataID > 100:
+                self.dataID = 0
+
+        # 同じIDの文字列は1つのオブジェクトにする（記録や集計で辞書のキーになる）
+        unit = sys.intern(unit)
+        sensor = sys.intern(sensor)
+
+        # 重複データのチェック（無線の再送処理等で同じデータを受信した場合）
+        # 直近の dedup_size 件を超えた古いものから忘れる
+        key = (unit, sensor, valueStr, dataID)
+        recent = self.recent
+        if key in recent:
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('Receiving a duplicated data, port=' + str(self.fileNameBase) + ', data=' + line)
+            return None
+        recent.add(key)
+        order = self.recent_order
+        order.append(key)
+        if len(order) > self.dedup_size:
+            recent.discard(order.popleft())
+
+        # 外れ値のチェック
+        if not self.checker is None:
+            if not self.checker.check(unit, sensor, value):
+                logger.error('sensor value outlier error ' + sensor + '_' + unit + ': ' + str(value))
+                return None
+
+        return [unit, sensor, value, dataID]
+
+class FrameDecoder ( ):
+    """バイナリフレームを切り出して検査し、記録するデータに変換する
+
+    フレームの構成（リトルエンディアン）
+        0  sync   2byte  0xA5 0x5A
+        2  len    1byte  unit から seq までのバイト数（9）
+        3  unit   1byte  ユニットのコード
+        4  sensor 1byte  センサーのコード
+        5  type   1byte  値の型 0: float32, 1: int32
+        6  value  4byte  センサー値
+        10 seq    2byte  ユニットごとの通し番号（0 - 65535 を繰り返す）
+        12 crc    2byte  len から seq までの CRC16（CRC-16/CCITT-FALSE, 初期値 0xFFFF）
+
+    * 同期バイトが見つかるまで読み飛ばし、CRC が合わないフレームは破棄して同期をやり直す
+    * ユニットとセンサーのコードは unit_names, sensor_names で ID に変換する
+      （ないものは 'U01', 'S01' のような16進表記）
+    * seq を DATAID とし、ユニットごとに最近受信した seq で重複を検出する
+    * seq の飛びから失われたフレームの数を数える（self.stats）
+    * checker が指定されている場合、それを使用して外れ値を確認
+    """
 
-            sensorData['prev'] = value
-            sensorData['count'] = 0
-            return True
+    SYNC = b'\xA5\x5A'
+    PAYLOAD_SIZE = 9
+    MAX_PAYLOAD = 64
 
-        else:
-            return True
-
-    def add(self, unit, sensor, min, max, variation):
-        """チェックリストにセンサーの定義域と変動範囲を指定する
-        引数；
-            unit (str): ユニット識別子 unitid
-            sensor (str): センサーの識別子 sensorid
-            min (number): 最小値、これより小さい値は外れ値とみなす
-            max (number): 最大値、これより大きい値は外れ値とみなす
-            variation (number): 変動範囲、これより大きな変動は外れ値とみなす。
-                ただし、３回目以上変動の外れ値が続いたら、それを新しい基準とする。
+    # 値の型ごとのペイロードの構造 unit, sensor, type, value, seq
+    PAYLOAD = {
+        0: struct.Struct('<BBBfH'),
+        1: struct.Struct('<BBBiH'),
+    }
+    CRC = struct.Struct('<H')
+
+    # 重複の検出のために記憶するユニットごとの seq の数
+    # （これより大きく seq が戻ったら、遅れて届いたフレームではなく送信側の再起動とみなす）
+    RECENT_SEQ = 32
+
+    def __init__( self, name, checker=None, unit_names=None, sensor_names=None ):
+        """コンストラクタ
+
+        引数：
+            name (str): ログに出力するポートの名前
+            cheker ( Checker ): 値をチェックする
+            unit_names (dict): {ユニットのコード: ユニットID}
+            sensor_names (dict): {センサーのコード: センサーID}
         """
-        checkid = sensor + '_' + unit
-        self.check_list[checkid] = {'min': min, 'max': max, 'variation': variation}
-        logger.debug('add ' + checkid)
+        self.fileNameBase = name
+        self.checker = checker
+        self.unit_names = {code: sys.intern(name) for code, name in (unit_names or {}).items()}
+        self.sensor_names = {code: sys.intern(name) for code, name in (sensor_names or {}).items()}
+        self.buff = b''
+
+        # ユニットごとの状態 {unit: [最後の seq, 最近の seq の集合, 最近の seq の順]}
+        self.units = {}
+        # seq が 0 に戻ったので保留しているフレーム {unit: [unit, sensor, value, dataID]}
+        self.held = {}
+        # ユニットごとの統計 {unit: {'received', 'lost', 'duplicated', 'restarted'}}、CRC エラーなどはポート全体で数える
+        self.stats = {}
+        self.errors = {'crc': 0, 'invalid': 0, 'discarded': 0}
+
+    def _unit_id( self, code ):
+        name = self.unit_names.get(code)
+        if name is None:
+            name = self.unit_names[code] = sys.intern('U{:02X}'.format(code))
+        return name
+
+    def _sensor_id( self, code ):
+        name = self.sensor_names.get(code)
+        if name is None:
+            name = self.sensor_names[code] = sys.intern('S{:02X}'.format(code))
+        return name
+
+    def _sequence( self, unit, seq ):
+        """seq で重複を検出し、飛びを数える
+
+        seq が RECENT_SEQ より大きく戻った場合は送信側の再起動とみなし、そのユニットの seq の
+        状態を捨てる（古い seq で新しいフレームを捨てないように）。
+
+        起動して間もない送信側（記憶している最も古い seq が 0）で seq が 0 に戻った場合は、
+        遅れて届いた 0 の再送かもしれないので、そのフレームを保留する（戻り値 None）。
+        次のフレームの seq が 1 なら再起動とみなし、保留したフレームを新しいフレームとして数える。
+        それ以外なら保留したフレームは重複とする。
+
+        戻り値:
+            True: 新しいフレーム
+            False: 重複したフレーム
+            None: 保留するフレーム（送信側の再起動かもしれない）
+        """
+        state = self.units.get(unit)
+        if state is None:
+            state = self.units[unit] = [None, set(), collections.deque()]
+            self.stats[unit] = {'received': 0, 'lost': 0, 'duplicated': 0, 'restarted': 0}
+        last, recent, order = state
+        stats = self.stats[unit]
+
+        if self.held and unit in self.held:
+            # 前のフレームで seq が 0 に戻った。1 が続けば送信側の再起動
+            if seq == 1:
+                logger.info('sequence restarted, port=' + self.fileNameBase + ', unit=' + unit
+                            + ', seq=' + str(last) + ' -> 0')
+                stats['restarted'] += 1
+                stats['received'] += 1
+                recent.clear()
+                order.clear()
+                recent.add(0)
+                order.append(0)
+                last = state[0] = 0
+            else:
+                del self.held[unit]
+                stats['duplicated'] += 1
+
+        if last is not None:
+            gap = (seq - last - 1) & 0xFFFF
+            behind = 0xFFFF - gap
+            if gap >= 0x8000 and behind:
+                if behind > self.RECENT_SEQ:
+                    # 送信側の再起動
+                    logger.info('sequence restarted, port=' + self.fileNameBase + ', unit=' + unit
+                                + ', seq=' + str(last) + ' -> ' + str(seq))
+                    stats['restarted'] += 1
+                    recent.clear()
+                    order.clear()
+                    last = None
+                elif seq == 0 and order[0] == 0:
+                    # 遅れて届いた再送か、起動して間もない送信側の再起動か、次のフレームで決める
+                    return None
+
+        if seq in recent:
+            stats['duplicated'] += 1
+            return False
+
+        if last is None:
+            state[0] = seq
+        elif gap < 0x8000:
+            stats['lost'] += gap
+            state[0] = seq
+        # それ以外は遅れて届いたフレーム
+
+        recent.add(seq)
+        order.append(seq)
+        if len(order) > self.RECENT_SEQ:
+            recent.discard(order.popleft())
+        stats['received'] += 1
         return True
 
+    def feed( self, data ):
+        """受信したデータを追加し、揃ったフレームをデータに変換する
+
+        引数：
+            data (bytes): 受信したデータ
+
+        戻り値:
+            [[unit, sensor, value, dataID], ...]
+        """
+        buff = self.buff + data if self.buff else data
+        size = len(buff)
+        items = []
+        pos = 0
+        while pos < size:
+            # 先頭が同期バイトなら検索を省く（通常はこちら）
+            start = pos if buff.startswith(self.SYNC, pos) else buff.find(self.SYNC, pos)
+            if start < 0:
+                # 同期バイトの前半だけが届いている場合は残す
+                rest = size - 1 if buff[-1:] == self.SYNC[:1] else size
+                if rest > pos:
+                    self.errors['discarded'] += rest - pos
+                    pos = rest
+                break
+            if start > pos:
+                self.errors['discarded'] += start - pos
+            if size < start + 3:
+                pos = start
+                break
+            length = buff[start + 2]
+            if length < self.PAYLOAD_SIZE or length > self.MAX_PAYLOAD:
+                self.errors['invalid'] += 1
+                pos = start + 1
+                continue
+            end = start + 3 + length + 2
+            if size < end:
+                pos = start
+                break
+            crc = self.CRC.unpack_from(buff, end - 2)[0]
+            if binascii.crc_hqx(buff[start + 2 : end - 2], 0xFFFF) != crc:
+                logger.warning('CRC error, port=' + self.fileNameBase)
+                self.errors['crc'] += 1
+                pos = start + 1
+                continue
+            pos = end
+
+            payload = self.PAYLOAD.get(buff[start + 5])
+            if payload is None:
+                logger.warning('invalid value type ' + str(buff[start + 5]) + ', port=' + self.fileNameBase)
+                self.errors['invalid'] += 1
+                continue
+            unit_code, sensor_code, vtype, value, seq = payload.unpack_from(buff, start + 3)
+            unit = self.unit_names.get(unit_code) or self._unit_id(unit_code)
+            sensor = self.sensor_names.get(sensor_code) or self._sensor_id(sensor_code)
+            new = self._sequence(unit, seq)
+            if not new:
+                if new is None:
+                    self.held[unit] = [unit, sensor, value, str(seq)]
+                elif logger.isEnabledFor(DEBUG):
+                    logger.debug('Receiving a duplicated frame, port=' + self.fileNameBase
+                                 + ', unit=' + unit + ', seq=' + str(seq))
+                continue
+            if self.held and unit in self.held:
+                # 送信側の再起動が確かめられたので、保留したフレームを先に出す
+                self._append(items, self.held.pop(unit))
+
+            self._append(items, [unit, sensor, value, str(seq)])
+
+        self.buff = buff[pos:]
+        if len(self.buff) > MAX_LINE:
+            self.errors['discarded'] += len(self.buff)
+            self.buff = b''
+        return items
+
+    def _append( self, items, item ):
+        """外れ値でなければデータを items に加える"""
+        if not self.checker is None:
+            unit, sensor, value = item[:3]
+            if not self.checker.check(unit, sensor, value):
+                logger.error('sensor value outlier error ' + sensor + '_' + unit + ': ' + str(value))
+                return
+        items.append(item)
+
+    def log_stats( self ):
+        """ユニットごとの受信数、失われたフレーム数、重複数をログに出力する"""
+        for unit, stats in sorted(self.stats.items()):
+            logger.info('frame stats port=' + self.fileNameBase + ' unit=' + unit
+                        + ' received=' + str(stats['received']) + ' lost=' + str(stats['lost'])
+                        + ' duplicated=' + str(stats['duplicated'])
+                        + ' restarted=' + str(stats['restarted']))
+        if any(self.errors.values()):
+            logger.info('frame errors port=' + self.fileNameBase + ' ' + str(self.errors))
+
+def encode_frame( unit, sensor, value, seq, vtype=0 ):
+    """バイナリフレームを作る（送信側の実装の参考、試験用）
+
+    引数：
+        unit (int): ユニットのコード（0 - 255）
+        sensor (int): センサーのコード（0 - 255）
+        value (number): センサー値
+        seq (int): 通し番号（0 - 65535）
+        vtype (int): 値の型 0: float32, 1: int32
+    """
+    body = bytes([FrameDecoder.PAYLOAD_SIZE]) \
+        + FrameDecoder.PAYLOAD[vtype].pack(unit, sensor, vtype, value, seq & 0xFFFF)
+    return FrameDecoder.SYNC + body + FrameDecoder.CRC.pack(binascii.crc_hqx(body, 0xFFFF))
+
+# 改行が来ないまま、これ以上たまったデータは捨てる
+MAX_LINE = 1024
+
+def split_lines( buff, data, name ):
+    """受信したデータをバッファに追加し、改行までの行を切り出す
+
+    引数：
+        buff (bytes): 前回までに受信して、改行が来ていないデータ
+        data (bytes): 今回受信したデータ
+        name (str): ログに出力するポートの名前
+
+    戻り値:
+        (行（str）のリスト, 残りのデータ（bytes）)
+    """
+    buff += data
+    raws = buff.split(b'\n')
+    buff = raws.pop()
+    if len(buff) > MAX_LINE:
+        logger.warning('too long line is discarded, port=' + name)
+        buff = b''
+
+    lines = []
+    for raw in raws:
+        try:
+            lines.append(raw.decode('ascii'))
+        except UnicodeDecodeError:
+            logger.warning('Unicode Decode Error, port=' + name)
+    return lines, buff
+
 class SerialReader( Worker ):
     """シリアルポートからデータ（1行）を読み取り、内容をチェックした上で record_queに送信する。
 
         * 無効な形式のデータを破棄
         * checkerが指定されている場合、それを使用して外れ値を確認
         * 再送されたデータの受信の破棄（無線の場合に起こる）
+
+    protocol='binary' の場合はバイナリフレーム（FrameDecoder）を読み取る。
+    ユニットごとの受信数、失われたフレーム数を STATS_INTERVAL 秒ごとにログに出力する。
     """
 
-    def __init__(self, port, baudrate, record_que=None, checker=None ):
+    # バイナリフレームの統計をログに出力する間隔（秒）
+    STATS_INTERVAL = 3600
+
+    def __init__(self, port, baudrate, record_que=None, checker=None,
+                 protocol='text', unit_names=None, sensor_names=None ):
         """コンストラクタ
 
         引数：
@@ -111,6 +465,9 @@ class SerialReader( Worker ):
             baudrate (int): ボーレート(9600、19200、... )
             record_que (Queue): FileRecorderオブジェクトにデータを送信する
             cheker ( Checker ): 値をチェックする
+            protocol (str): データの形式 'text' または 'binary'
+            unit_names (dict): バイナリフレームのユニットのコードとIDの対応 {1: 'ARD1', ...}
+            sensor_names (dict): バイナリフレームのセンサーのコードとIDの対応 {1: 'CT1', ...}
 
         シリアル通信の他のパラメータは以下固定
             - データビット: 8bit
@@ -124,11 +481,11 @@ class SerialReader( Worker ):
         self.record_que = record_que
         self.port = port
         self.baudrate = baudrate
-        self.recent = []
-        # self.buff = []
-        self.rechkline = re.compile(r'^[a-zA-Z0-9_;:., -]*$')
-        self.rechkid = re.compile(r'^[a-zA-Z0-9-_]+$')
-        self.dataID = 0
+        self.validator = LineValidator(self.fileNameBase, checker)
+        if protocol not in ('text', 'binary'):
+            raise ValueError('unknown protocol: ' + str(protocol))
+        self.protocol = protocol
+        self.decoder = FrameDecoder(self.fileNameBase, checker, unit_names, sensor_names)
         self.checker = checker
         self.errorcount = 0
         if os.path.exists(self.port):
@@ -152,6 +509,19 @@ class SerialReader( Worker ):
                                           )
 
 
+    def _read_items( self ):
+        """データを読み取り、検査して [unit, sensor, value, dataID] のリストにする"""
+        if self.protocol == 'binary':
+            return self.decoder.feed(self.ser.read(self.ser.in_waiting or 1))
+
+        line = self.ser_io.readline();
+
+        # 内容のチェックとデータの抽出
+        item = self.validator.validate(line)
+        if item is None:
+            return []
+        return [item]
+
     def run(self):
         """スレッド処理"""
 
@@ -160,14 +530,19 @@ class SerialReader( Worker ):
             logger.warning("port not found : " + self.port)
             time.sleep(60)
 
-        logger.info('[START] port=' + self.port + ', boudrate=' + str(self.baudrate))
-
+        logger.info('[START] port=' + self.port + ', boudrate=' + str(self.baudrate)
+                    + ', protocol=' + self.protocol)
 
+        lasttime_stats = time.time()
         while not self.stopEvent.is_set():
             # ストップイベントが設定されるまで繰り返す
 
+            if self.protocol == 'binary' and time.time() - lasttime_stats >= self.STATS_INTERVAL:
+                lasttime_stats = time.time()
+                self.decoder.log_stats()
+
             try:
-                line = self.ser_io.readline();
+                items = self._read_items()
                 self.errorcount = 0
 
             except UnicodeDecodeError as err:
@@ -186,79 +561,274 @@ class SerialReader( Worker ):
                     break
                 continue
 
-            # 空行の場合スキップ
-            line = line.strip()
-            if line == '':
-                continue
+            # 一行書き出す
+            for item in items:
+                if self.record_que is None:
+                    logger.error('file queue does not exist.')
+                else:
+                    try:
+                        self.record_que.put(item, block=False)
+                    except queue.Full:
+                        logger.error('record_queue is full')
+                        continue
+
+        if self.protocol == 'binary':
+            self.decoder.log_stats()
+        self.ser.close()
+        logger.info('[STOP] port=' + self.port)
 
-            # 文字化け等の不正データのスキップ
-            if not self.rechkline.match(line):
-                logger.warning('Receiving a invalid data, port=' + str(self.fileNameBase))
-                continue
+class AsyncSerialReader ( AsyncWorker ):
+    """SerialReader の asyncio 版
 
-            # Data extraction（データ抽出）
-            line_list = line.split(',')
-            # unit, sensor, valueの３つが必要
-            if len(line_list) < 3:
-                logger.warning('incomplete data, port=' + str(self.fileNameBase) + ' data=' + line)
-                continue
+    シリアルポートをノンブロッキングで開き、イベントループに読み取り可能の
+    通知（add_reader）を登録する。データが届いたときだけ動作するので、
+    タイムアウトで定期的に起きることがない。
 
-            unit     = line_list.pop(0).strip()
-            sensor   = line_list.pop(0).strip() #[:5]
-            valueStr = line_list.pop(0).strip()
+    データの検査は SerialReader と同じ（LineValidator）
+    """
 
-            # When dataID exists（さらにdataIDがある場合）
-            if len(line_list) > 0:
-                dataID = line_list.pop(0).strip()
-            else:
-                dataID = str(self.dataID)
-                self.dataID += 1
-                if self.dataID > 100:
-                    self.dataID = 0
-
-            # unitのチェック
-            if not self.rechkid.match(unit):
-                logger.warning('invarid unit id. "' + unit + '" port=' + self.fileNameBase)
-                continue
+    def __init__(self, port, baudrate, record_que=None, checker=None ):
+        """コンストラクタ
 
-            # sensorのチェック
-            if not self.rechkid.match(sensor):
-                logger.warning('invarid sensor id. "' + sensor + '" port=' + self.fileNameBase)
+        引数は SerialReader と同じ
+        """
+        super().__init__()
+        self.fileNameBase = port.split('/').pop(-1)
+        self.record_que = record_que
+        self.port = port
+        self.baudrate = baudrate
+        self.validator = LineValidator(self.fileNameBase, checker)
+        self.ser = None
+        self.buff = b''
+
+    def _on_readable( self ):
+        """シリアルポートが読み取り可能になったときに呼び出される"""
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as err:
+            logger.error('serial read error, port=' + self.fileNameBase + ' ' + str(err))
+            # run() を終了させ、ランタイムに再起動させる
+            self.stop()
+            return
+
+        lines, self.buff = split_lines(self.buff, data, self.fileNameBase)
+        for line in lines:
+            item = self.validator.validate(line)
+            if item is None:
                 continue
 
-            # valueが有効な数値であるか
-            try:
-                value = float(valueStr)
-            except:
-                logger.warning('invalid numeric value ="' + valueStr + '", port=' + str(self.fileNameBase))
-                continue
+            if self.record_que is None:
+                logger.error('file queue does not exist.')
+            elif not put_nowait(self.record_que, item):
+                logger.error('record_queue is full')
 
-            # 重複データのチェック（無線の再送処理等で同じデータを受信した場合）
-            line = unit + ',' + sensor + ',' + valueStr + ',' + dataID
-            if line in self.recent:
-                logger.debug('Receiving a duplicated data, port=' + str(self.fileNameBase) + ', data=' + line)
-                continue
+    async def run( self ):
+        while not os.path.exists(self.port):
+            # ポートが見つかるまで待機
+            logger.warning("port not found : " + self.port)
+            if await self.wait_stop(60):
+                return
+
+        self.ser = serial.Serial(
+            port     = self.port,
+            baudrate = self.baudrate,
+            bytesize = serial.EIGHTBITS,
+            parity   = serial.PARITY_NONE,
+            stopbits = serial.STOPBITS_ONE,
+            timeout  = 0,
+            xonxoff  = False,
+            rtscts   = False,
+            dsrdtr   = False
+        )
+        logger.info('[START] port=' + self.port + ', boudrate=' + str(self.baudrate))
 
-            # 受信データの記録（過去１０件分）
-            self.recent.insert(0, line)
-            if len(self.recent) > 10:
-                self.recent.pop()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.ser.fileno(), self._on_readable)
+        try:
+            await self.wait_stop()
+        finally:
+            loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+        logger.info('[STOP] port=' + self.port)
 
-            # 外れ値のチェック
-            if not self.checker is None:
-                if not self.checker.check(unit, sensor, value):
-                    logger.error('sensor value outlier error ' + sensor + '_' + unit + ': ' + str(value))
-                    continue
+class _HubPort ( ):
+    """SerialHub が開いているポート1つ分の状態"""
+    def __init__( self, path, ser, validator ):
+        self.path = path
+        self.name = path.split('/').pop(-1)
+        self.ser = ser
+        self.validator = validator
+        self.buff = b''
+
+class SerialHub ( Worker ):
+    """複数のシリアルポートを1つのスレッドで読み取り、内容をチェックした上で record_que に送信する。
+
+    ポートをノンブロッキングで開き、selectors ですべてのポートを同時に待つ。
+    データが届いたポートだけを読み、ポートごとのバッファから行を切り出して
+    SerialReader と同じ検査（LineValidator）を行う。
+
+    ポートの抜き差し:
+        * 読み取りエラーになったポートは閉じて、再び現れるのを待つ
+        * ports に指定したポートと、watch_dir（/dev/serial/by-id）の中で pattern に
+          一致するポートが現れたら開く。watch_dir は更新時刻が変わったときだけ読み直す
+        * 重複データの検査の状態はポートを閉じても残す
+
+    設定例:
+        {'class': SerialHub,
+         'args': {'pattern': 'usb-FTDI_*', 'baudrate': 115200, 'record_que': record_que}}
+    """
+
+    def __init__( self, ports=[], baudrate=115200, record_que=None, checker=None,
+                  pattern=None, watch_dir='/dev/serial/by-id', check_interval=1 ):
+        """コンストラクタ
+
+        引数：
+            ports (list of str): 読み取るシリアルポートのデバイス文字列
+            baudrate (int): ボーレート（すべてのポートで共通）
+            record_que (Queue): FileRecorderオブジェクトにデータを送信する
+            cheker ( Checker ): 値をチェックする（すべてのポートで共通）
+            pattern (str): watch_dir の中で読み取るポートの名前のパターン（fnmatch 形式）
+            watch_dir (str): ポートが現れるディレクトリ
+            check_interval (number): ポートの抜き差しを確認する間隔（秒）
+
+        シリアル通信の他のパラメータは SerialReader と同じ
+        """
+        super().__init__()
+        self.ports = list(ports)
+        self.baudrate = baudrate
+        self.record_que = record_que
+        self.checker = checker
+        self.pattern = pattern
+        self.watch_dir = watch_dir
+        self.check_interval = check_interval
+
+        self.selector = selectors.DefaultSelector()
+        self.opened = {}                # {実体のパス: _HubPort}
+        self.validators = {}            # {ポートの名前: LineValidator}
+        self.failed = {}                # {パス: 開けなかった時刻}
+        self.watch_mtime = None
+        self.watched = []
+
+    def _candidates( self ):
+        """開くべきポートのパスのリスト"""
+        if self.pattern is not None:
+            try:
+                mtime = os.stat(self.watch_dir).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self.watch_mtime:
+                # ディレクトリが変わったときだけ読み直す
+                self.watch_mtime = mtime
+                self.watched = []
+                if mtime is not None:
+                    for name in sorted(os.listdir(self.watch_dir)):
+                        if fnmatch.fnmatch(name, self.pattern):
+                            self.watched.append(os.path.join(self.watch_dir, name))
+        return self.ports + self.watched
+
+    def _attach( self, path, now ):
+        """ポートを開いて selector に登録する"""
+        if now - self.failed.get(path, 0) < 60:
+            # 開けなかったポートは 60秒間試さない
+            return
+        try:
+            ser = serial.Serial(
+                port     = path,
+                baudrate = self.baudrate,
+                bytesize = serial.EIGHTBITS,
+                parity   = serial.PARITY_NONE,
+                stopbits = serial.STOPBITS_ONE,
+                timeout  = 0,
+                xonxoff  = False,
+                rtscts   = False,
+                dsrdtr   = False
+            )
+        except (serial.SerialException, OSError) as err:
+            logger.error('cannot open port=' + path + ' ' + str(err))
+            self.failed[path] = now
+            return
+        self.failed.pop(path, None)
+
+        name = path.split('/').pop(-1)
+        validator = self.validators.get(name)
+        if validator is None:
+            validator = LineValidator(name, self.checker)
+            self.validators[name] = validator
+        port = _HubPort(path, ser, validator)
+        self.opened[os.path.realpath(path)] = port
+        self.selector.register(ser.fileno(), selectors.EVENT_READ, port)
+        logger.info('[ATTACH] port=' + path + ', boudrate=' + str(self.baudrate))
+
+    def _detach( self, port ):
+        """ポートを selector から外して閉じる"""
+        for key, value in list(self.opened.items()):
+            if value is port:
+                del self.opened[key]
+        try:
+            self.selector.unregister(port.ser.fileno())
+        except (KeyError, ValueError, OSError):
+            pass
+        try:
+            port.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        logger.info('[DETACH] port=' + port.path)
+
+    def _check_ports( self, now ):
+        """現れたポートを開く"""
+        for path in self._candidates():
+            if not os.path.exists(path):
+                continue
+            if os.path.realpath(path) in self.opened:
+                continue
+            self._attach(path, now)
+
+    def _read( self, port ):
+        """読み取り可能になったポートからデータを読み、1行ずつ検査して送信する"""
+        try:
+            data = port.ser.read(port.ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as err:
+            logger.error('serial read error, port=' + port.name + ' ' + str(err))
+            self._detach(port)
+            return
+        if not data:
+            # 読み取り可能なのにデータがないのは、ポートが外された場合
+            self._detach(port)
+            return
+
+        lines, port.buff = split_lines(port.buff, data, port.name)
+        for line in lines:
+            item = port.validator.validate(line)
+            if item is None:
+                continue
 
-            # 一行書き出す
             if self.record_que is None:
                 logger.error('file queue does not exist.')
             else:
                 try:
-                    self.record_que.put([unit, sensor, value, dataID], block=False)
+                    self.record_que.put(item, block=False)
                 except queue.Full:
                     logger.error('record_queue is full')
-                    continue
 
-        self.ser.close()
-        logger.info('[STOP] port=' + self.port)
+    def run( self ):
+        """スレッド処理"""
+        logger.info('[START] ports=' + ','.join(self.ports) + ' pattern=' + str(self.pattern))
+        lasttime_check = 0
+        while not self.stopEvent.is_set():
+            now = time.time()
+            if now - lasttime_check >= self.check_interval:
+                lasttime_check = now
+                self._check_ports(now)
+
+            if not self.opened:
+                # 開いているポートがなければ、次の確認まで待つ
+                self.stopEvent.wait(self.check_interval)
+                continue
+
+            for key, mask in self.selector.select(timeout=self.check_interval):
+                self._read(key.data)
+
+        for port in list(self.opened.values()):
+            self._detach(port)
+        self.selector.close()
+        logger.info('[STOP]')
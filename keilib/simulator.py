@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""WiSUNドングル RL7023 とスマートメーターのシミュレーター、シリアル通信の記録と再生
+
+ドングルやスマートメーターがなくても、BrouteReader と WiSunRL7023 を動かして
+電文の解析速度、再接続にかかる時間、要求のスケジューリングを確かめることができる。
+
+* SmartMeter: 低圧スマートメーター（028801）の ECHONET Lite の応答を作る
+* SimulatedRL7023: 疑似端末（pty）で SK コマンドに応答する RL7023 のシミュレーター
+    - SKRESET, SKSREG, SKSETPWD, SKSETRBID, SKSCAN（EPANDESC）, SKLL64,
+      SKJOIN / SKREJOIN（EVENT 25）, SKSENDTO（ERXUDP で応答）, SKTERM
+    - 応答の遅延（latency, jitter）と、スマートメーターの応答の損失（loss）を設定できる
+    - outage() で一定時間スマートメーターが応答しない状態を作る
+* CaptureSerial: 実機とのシリアル通信を記録する（WiSunRL7023 の capture 引数で使う）
+* ReplaySerial, ReplayRL7023: 記録したシリアル通信を実時間より速く再生する
+
+使い方:
+    sim = SimulatedRL7023(latency=0.05, loss=0.1)
+    sim.start()
+    wisundev = WiSunRL7023(sim.port, 115200)
+
+pty を使うので Linux などの POSIX 環境でのみ動作する。
+"""
+
+import os
+import pty
+import tty
+import time
+import json
+import heapq
+import random
+import select
+import struct
+import datetime
+import threading
+
+from keilib.worker import Worker
+from keilib.broute import WiSunRL7023, ENERGY_UNIT, HISTORY_NO_DATA
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+def _ipv6_from_mac( addr ):
+    """64ビット MAC アドレスからリンクローカル IPv6 アドレスを求める（SKLL64 と同じ）"""
+    iid = '{:016X}'.format(int(addr, 16) ^ (0x02 << 56))
+    return 'FE80:0000:0000:0000:' + ':'.join(iid[i:i + 4] for i in range(0, 16, 4))
+
+class SmartMeter ( ):
+    """低圧スマートメーター（028801）のプロパティ値を作り、ECHONET Lite の要求に応答する
+
+    瞬時電力は base_power を中心にランダムに変化し、積算電力量は瞬時電力から積算する。
+    積算電力量計測値履歴（E2, E4）は現在の積算電力量から 30分ごとに遡って作る。
+    """
+
+    # ヘッダ部 EHD(2) TID(2) SEOJ(3) DEOJ(3) ESV(1) OPC(1)
+    HEADER = struct.Struct('>2s2s3s3sBB')
+
+    def __init__( self, base_power=500, energy=12345.6, coefficient=1, unit=0x01,
+                  announce=('EA', 'EB'), seed=None ):
+        """コンストラクタ
+
+        引数:
+            base_power (number): 瞬時電力の中心値（W）
+            energy (number): 積算電力量の初期値（kWh）
+            coefficient (int): 係数（D3）
+            unit (int): 積算電力量単位（E1）のコード 0x01 = 0.1kWh
+            announce (tuple of str): 状変アナウンスプロパティマップ（9D）のプロパティ
+            seed: 乱数の種（省略時は毎回異なる値）
+        """
+        self.base_power = base_power
+        self.power = base_power
+        self.energy = energy
+        self.reverse_energy = 0.0
+        self.coefficient = coefficient
+        self.unit = unit
+        self.announce = announce
+        self.random = random.Random(seed)
+        self.lasttime = time.time()
+        self.history_day = 0
+        self.tid = 0
+
+        # プロパティごとの値を作る関数 {EPC: 関数() -> bytes}
+        self.getters = {
+            'E7': self._get_power,
+            'E8': self._get_current,
+            'E0': self._get_energy,
+            'E3': self._get_reverse_energy,
+            'D3': lambda: struct.pack('>I', self.coefficient),
+            'D7': lambda: b'\x06',
+            'E1': lambda: bytes([self.unit]),
+            'EA': self._get_fixed_time_energy,
+            'EB': self._get_fixed_time_energy,
+            '9D': self._get_announce_map,
+            'E2': self._get_history,
+            'E4': self._get_history,
+            'E5': lambda: bytes([self.history_day]),
+        }
+
+    def _update( self ):
+        """瞬時電力を変化させ、前回からの経過時間分の電力量を積算する"""
+        now = time.time()
+        self.energy += self.power * (now - self.lasttime) / 3600000
+        self.lasttime = now
+        self.power = max(0, self.power + self.random.gauss(0, 50)
+                         + (self.base_power - self.power) * 0.1)
+
+    def _raw_energy( self, energy ):
+        """kWh を積算電力量の計測値（係数と単位で割った値）に変換する"""
+        return int(energy / (self.coefficient * ENERGY_UNIT.get(self.unit, 0.1))) % 100000000
+
+    def _get_power( self ):
+        self._update()
+        return struct.pack('>i', int(self.power))
+
+    def _get_current( self ):
+        # 100V 単相3線として R相、T相に半分ずつ（0.1A 単位）
+        amps = int(self.power / 100 / 2 * 10)
+        return struct.pack('>hh', amps, amps)
+
+    def _get_energy( self ):
+        self._update()
+        return struct.pack('>I', self._raw_energy(self.energy))
+
+    def _get_reverse_energy( self ):
+        return struct.pack('>I', self._raw_energy(self.reverse_energy))
+
+    def _get_fixed_time_energy( self ):
+        self._update()
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        now = now.replace(minute=now.minute // 30 * 30)
+        return struct.pack('>HBBBBBI', now.year, now.month, now.day,
+                           now.hour, now.minute, now.second, self._raw_energy(self.energy))
+
+    def _get_announce_map( self ):
+        return bytes([len(self.announce)] + [int(epc, 16) for epc in self.announce])
+
+    def _get_history( self ):
+        """積算履歴収集日（E5）の日の積算電力量計測値履歴（1時間あたり 0.5kWh として遡る）"""
+        now = datetime.datetime.now()
+        slots_today = (now.hour * 60 + now.minute) // 30
+        values = []
+        for i in range(48):
+            back = self.history_day * 48 + slots_today - i
+            if back < 0:
+                values.append(HISTORY_NO_DATA)
+            else:
+                values.append(self._raw_energy(max(0, self.energy - back * 0.25)))
+        return struct.pack('>H48I', self.history_day, *values)
+
+    def respond( self, data ):
+        """要求電文に対する応答電文を作る
+
+        引数:
+            data (bytes): 受け取った ECHONET Lite 電文
+
+        戻り値:
+            応答電文（bytes）、応答しない電文の場合は None
+        """
+        if len(data) < self.HEADER.size:
+            return None
+        ehd, tid, seoj, deoj, esv, opc = self.HEADER.unpack_from(data)
+        if ehd != b'\x10\x81' or deoj[:2] != b'\x02\x88':
+            return None
+
+        # プロパティの取り出し
+        props = []
+        base = self.HEADER.size
+        for i in range(opc):
+            if base + 2 > len(data):
+                return None
+            epc, pdc = data[base], data[base + 1]
+            props.append(('{:02X}'.format(epc), data[base + 2 : base + 2 + pdc]))
+            base += 2 + pdc
+
+        result = []
+        success = True
+        if esv == 0x62:
+            # Get -> Get_Res(72) / Get_SNA(52)
+            for epc, edt in props:
+                getter = self.getters.get(epc)
+                if getter is None:
+                    success = False
+                    result.append((epc, b''))
+                else:
+                    result.append((epc, getter()))
+            res_esv = 0x72 if success else 0x52
+        elif esv in (0x61, 0x60):
+            # SetC -> Set_Res(71) / SetC_SNA(51)
+            for epc, edt in props:
+                if epc == 'E5' and len(edt) == 1 and edt[0] <= 99:
+                    self.history_day = edt[0]
+                    result.append((epc, b''))
+                else:
+                    success = False
+                    result.append((epc, edt))
+            if esv == 0x60:
+                # SetI は応答なし
+                return None
+            res_esv = 0x71 if success else 0x51
+        elif esv == 0x7A:
+            # INFC_Res には応答しない
+            return None
+        else:
+            return None
+
+        return self._frame(tid, deoj, seoj, res_esv, result)
+
+    def notification( self, epc_list=None ):
+        """プロパティ値通知（ESV=73）の電文を作る（省略時は状変アナウンスのプロパティ）"""
+        if epc_list is None:
+            epc_list = self.announce
+        self.tid = (self.tid + 1) % 0x10000
+        props = [(epc, self.getters[epc]()) for epc in epc_list if epc in self.getters]
+        return self._frame(struct.pack('>H', self.tid), b'\x02\x88\x01', b'\x05\xFF\x01', 0x73, props)
+
+    def _frame( self, tid, seoj, deoj, esv, props ):
+        frame = self.HEADER.pack(b'\x10\x81', tid, seoj, deoj, esv, len(props))
+        for epc, edt in props:
+            frame += bytes([int(epc, 16), len(edt)]) + edt
+        return frame
+
+class SimulatedRL7023 ( Worker ):
+    """疑似端末で SK コマンドに応答する RL7023 Stick-D のシミュレーター
+
+    self.port に疑似端末のスレーブ側のパスが入るので、WiSunRL7023 の port に指定する。
+    スキャン、PANA 認証にかかる時間は実機の時間に time_scale を掛けたものになる。
+    self.stats に SKSENDTO の数、応答した数、損失させた数などを数える。
+    """
+    IPS = 0
+    DSS = 1
+
+    def __init__( self, meter=None, type=DSS, latency=0.05, jitter=0.0, loss=0.0,
+                  time_scale=1.0, channel='21', pan_id='8888', addr='001D129012345678',
+                  broute_id=None, broute_pwd=None, join_time=2.0, notify_interval=0,
+                  echo=True, seed=None ):
+        """コンストラクタ
+
+        引数:
+            meter (SmartMeter): 応答するスマートメーター（省略時は新しく作る）
+            type (int): SimulatedRL7023.DSS または SimulatedRL7023.IPS
+            latency (number): SKSENDTO からスマートメーターの応答（ERXUDP）までの時間（秒）
+            jitter (number): latency に加える揺らぎの最大値（秒）
+            loss (float): スマートメーターの応答を失う確率（0.0 - 1.0）
+            time_scale (float): スキャン、PANA 認証にかかる時間の倍率
+            channel, pan_id, addr (str): スマートメーターのチャンネル、PAN ID、MAC アドレス
+            broute_id, broute_pwd (str): 受け付ける BルートID とパスワード（None なら何でもよい）
+            join_time (number): PANA 認証にかかる時間（秒、time_scale を掛ける）
+            notify_interval (number): プロパティ値通知（ESV=73）を送る間隔（秒、0 なら送らない）
+            echo (bool): コマンドのエコーバックを返す
+            seed: 乱数の種
+        """
+        super().__init__()
+        self.meter = meter if meter is not None else SmartMeter(seed=seed)
+        self.type = type
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.time_scale = time_scale
+        self.channel = channel
+        self.pan_id = pan_id
+        self.addr = addr
+        self.meter_ipv6 = _ipv6_from_mac(addr)
+        self.my_mac = '001D129000000001'
+        self.my_ipv6 = _ipv6_from_mac(self.my_mac)
+        self.broute_id = broute_id
+        self.broute_pwd = broute_pwd
+        self.join_time = join_time
+        self.notify_interval = notify_interval
+        self.echo = echo
+        self.random = random.Random(seed)
+
+        self.stats = {'command': 0, 'sendto': 0, 'replied': 0, 'lost': 0, 'notified': 0,
+                      'scan': 0, 'join': 0}
+        self.outage_until = 0
+        self.lock = threading.Lock()
+        self._reset()
+
+        # 疑似端末（マスター側はこのスレッドが読み書きする）
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        # 送信予定の応答 [(時刻, 番号, bytes), ...]
+        self.pending = []
+        self.seq = 0
+        self.inbuf = b''
+
+    def _reset( self ):
+        """SKRESET: レジスタと接続状態を初期化する"""
+        self.registers = {0x01: self.my_mac, 0x02: '21', 0x03: 'FFFF', 0x15: '1',
+                          0x16: '00000384', 0x17: '1', 0xA2: '0', 0xFE: '1' if self.echo else '0'}
+        self.rbid = None
+        self.password = None
+        self.joined = False
+
+    def outage( self, duration, drop_session=True ):
+        """duration 秒の間、スマートメーターが応答しない状態にする
+
+        引数:
+            drop_session (bool): True なら PANA セッションも失い、再認証が必要になる
+        """
+        with self.lock:
+            self.outage_until = time.time() + duration
+            if drop_session:
+                self.joined = False
+
+    def _send( self, data, delay=0 ):
+        """応答を送信予定に加える"""
+        self.seq += 1
+        heapq.heappush(self.pending, (time.time() + delay, self.seq, data))
+
+    def _event( self, num, addr=None, param=None ):
+        """EVENT 行を作る"""
+        line = 'EVENT ' + num + ' ' + (addr or self.my_ipv6)
+        if self.type == self.DSS:
+            line += ' 0'
+        if param is not None:
+            line += ' ' + param
+        return (line + '\r\n').encode('ascii')
+
+    def _take_command( self ):
+        """受信バッファからコマンドを1つ取り出す
+
+        戻り値:
+            (コマンドの単語のリスト, SKSENDTO のデータ) 揃っていなければ None
+        """
+        buf = self.inbuf
+        if buf[:8] == b'SKSENDTO':
+            # SKSENDTO <HANDLE> <IPADDR> <PORT> <SEC> [<SIDE>] <DATALEN> <DATA>（CRLF なし）
+            nfields = 7 if self.type == self.DSS else 6
+            pos = 0
+            for i in range(nfields):
+                pos = buf.find(b' ', pos) + 1
+                if pos == 0:
+                    return None
+            words = buf[:pos].decode('ascii', errors='replace').split()
+            try:
+                length = int(words[-1], 16)
+            except ValueError:
+                self.inbuf = b''
+                return ['SKSENDTO'], None
+            if len(buf) < pos + length:
+                return None
+            data = buf[pos : pos + length]
+            self.inbuf = buf[pos + length:].lstrip(b'\r\n')
+            return words, data
+
+        idx = buf.find(b'\r\n')
+        if idx < 0:
+            return None
+        self.inbuf = buf[idx + 2:]
+        return buf[:idx].decode('ascii', errors='replace').split(), None
+
+    def _handle( self, words, data ):
+        """SK コマンドを1つ処理して応答を送信予定に加える"""
+        if not words:
+            return
+        self.stats['command'] += 1
+        cmd = words[0]
+        if self.echo:
+            self._send((' '.join(words) + '\r\n').encode('ascii'))
+
+        if cmd == 'SKRESET':
+            self._reset()
+            self._send(b'OK\r\n')
+
+        elif cmd == 'SKSREG' and len(words) >= 2:
+            try:
+                reg = int(words[1][1:], 16)
+            except ValueError:
+                self._send(b'FAIL ER06\r\n')
+                return
+            if len(words) >= 3:
+                self.registers[reg] = words[2]
+                self._send(b'OK\r\n')
+            else:
+                value = self.registers.get(reg, '0')
+                self._send(('ESREG ' + value + '\r\nOK\r\n').encode('ascii'))
+
+        elif cmd == 'SKSETPWD' and len(words) == 3:
+            self.password = words[2]
+            self._send(b'OK\r\n')
+
+        elif cmd == 'SKSETRBID' and len(words) == 2:
+            self.rbid = words[1]
+            self._send(b'OK\r\n')
+
+        elif cmd == 'SKSCAN' and len(words) >= 4:
+            self._scan(words)
+
+        elif cmd == 'SKLL64' and len(words) == 2:
+            try:
+                self._send((_ipv6_from_mac(words[1]) + '\r\n').encode('ascii'))
+            except ValueError:
+                self._send(b'FAIL ER06\r\n')
+
+        elif cmd == 'SKJOIN' and len(words) == 2:
+            self._join(words[1])
+
+        elif cmd == 'SKREJOIN':
+            with self.lock:
+                joined = self.joined
+            if joined:
+                self._send(b'OK\r\n')
+                self._send(self._event('25', self.meter_ipv6), self.join_time * self.time_scale / 2)
+            else:
+                self._send(b'FAIL ER10\r\n')
+
+        elif cmd == 'SKTERM':
+            with self.lock:
+                joined = self.joined
+                self.joined = False
+            if joined:
+                self._send(b'OK\r\n')
+                self._send(self._event('27', self.meter_ipv6), 0.01)
+            else:
+                self._send(b'FAIL ER10\r\n')
+
+        elif cmd == 'SKSENDTO':
+            self._sendto(words, data)
+
+        elif cmd == 'SKVER':
+            self._send(b'EVER 1.2.10\r\nOK\r\n')
+
+        else:
+            self._send(b'FAIL ER04\r\n')
+
+    def _scan( self, words ):
+        """SKSCAN: マスクのチャンネルを順にスキャンし、スマートメーターのチャンネルなら EPANDESC を返す"""
+        try:
+            mask = int(words[2], 16)
+            duration = int(words[3])
+        except ValueError:
+            self._send(b'FAIL ER06\r\n')
+            return
+        self.stats['scan'] += 1
+        self._send(b'OK\r\n')
+
+        # 1チャンネルあたり 0.01秒 * (2^duration + 1)（ch33 - ch60 の28チャンネル）
+        per_channel = 0.01 * (2 ** duration + 1) * self.time_scale
+        elapsed = 0
+        for bit in range(28):
+            if not mask >> bit & 1:
+                continue
+            elapsed += per_channel
+            if bit == int(self.channel, 16) - 33:
+                desc = ['EPANDESC', '  Channel:' + self.channel, '  Channel Page:09',
+                        '  Pan ID:' + self.pan_id, '  Addr:' + self.addr, '  LQI:E1']
+                if self.type == self.DSS:
+                    desc.append('  Side:0')
+                desc.append('  PairID:' + (self.broute_id or '0' * 32)[-8:])
+                self._send(self._event('20', self.meter_ipv6)
+                           + ('\r\n'.join(desc) + '\r\n').encode('ascii'), elapsed)
+        self._send(self._event('22'), elapsed)
+
+    def _join( self, ipv6 ):
+        """SKJOIN: 設定とアドレスが合っていれば EVENT 25、合っていなければ EVENT 24"""
+        self.stats['join'] += 1
+        self._send(b'OK\r\n')
+        ok = (ipv6 == self.meter_ipv6
+              and self.registers.get(0x02, '').upper() == self.channel
+              and self.registers.get(0x03, '').upper() == self.pan_id
+              and (self.broute_id is None or self.rbid == self.broute_id)
+              and (self.broute_pwd is None or self.password == self.broute_pwd))
+        with self.lock:
+            if time.time() < self.outage_until:
+                ok = False
+            self.joined = ok
+        self._send(self._event('25' if ok else '24', ipv6), self.join_time * self.time_scale)
+
+    def _sendto( self, words, data ):
+        """SKSENDTO: EVENT 21 と OK を返し、スマートメーターの応答を latency 秒後に ERXUDP で返す"""
+        if data is None:
+            self._send(b'FAIL ER06\r\n')
+            return
+        self.stats['sendto'] += 1
+        self._send(self._event('21', words[2], '00') + b'OK\r\n')
+
+        with self.lock:
+            available = self.joined and time.time() >= self.outage_until
+        response = self.meter.respond(data)
+        if response is None:
+            return
+        if not available or self.random.random() < self.loss:
+            self.stats['lost'] += 1
+            return
+        self.stats['replied'] += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        self._send(self._erxudp(response), delay)
+
+    def _erxudp( self, frame ):
+        """スマートメーターからの電文の ERXUDP 行を作る"""
+        line = 'ERXUDP ' + self.meter_ipv6 + ' ' + self.my_ipv6 + ' 0E1A 0E1A ' + self.addr + ' 1 '
+        if self.type == self.DSS:
+            line += '0 '
+        line += '{:04X} '.format(len(frame)) + frame.hex().upper() + '\r\n'
+        return line.encode('ascii')
+
+    def run( self ):
+        """疑似端末からコマンドを読み、応答を予定の時刻に書き込む"""
+        logger.info('[START] port=' + self.port)
+        lasttime_notify = time.time()
+        while not self.stopEvent.is_set():
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                try:
+                    os.write(self.master, heapq.heappop(self.pending)[2])
+                except OSError as err:
+                    logger.error('pty write error: ' + str(err))
+
+            if self.notify_interval and now - lasttime_notify >= self.notify_interval:
+                lasttime_notify = now
+                with self.lock:
+                    available = self.joined and now >= self.outage_until
+                if available:
+                    self.stats['notified'] += 1
+                    self._send(self._erxudp(self.meter.notification()))
+
+            timeout = 0.1
+            if self.pending:
+                timeout = min(timeout, max(0, self.pending[0][0] - now))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if not readable:
+                continue
+            try:
+                self.inbuf += os.read(self.master, 4096)
+            except OSError as err:
+                logger.error('pty read error: ' + str(err))
+                self.stopEvent.wait(0.1)
+                continue
+            while True:
+                command = self._take_command()
+                if command is None:
+                    break
+                self._handle(*command)
+
+        os.close(self.master)
+        os.close(self.slave)
+        logger.info('[STOP]')
+
+class CaptureSerial ( ):
+    """シリアルポートの送受信を JSON Lines 形式でファイルに記録する
+
+    1行が1回の送信（write）または受信（readline）で、
+    {"t": 開始からの秒数, "dir": "tx" または "rx", "data": 16進文字列}
+    """
+
+    def __init__( self, ser, fname ):
+        self.ser = ser
+        self.file = open(fname, 'a')
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def _record( self, direction, data ):
+        record = {'t': round(time.time() - self.start, 6), 'dir': direction, 'data': data.hex().upper()}
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+
+    def readline( self ):
+        line = self.ser.readline()
+        if line:
+            self._record('rx', line)
+        return line
+
+    def write( self, data ):
+        self._record('tx', data)
+        return self.ser.write(data)
+
+    def close( self ):
+        with self.lock:
+            self.file.close()
+        self.ser.close()
+
+    def __getattr__( self, name ):
+        return getattr(self.ser, name)
+
+def load_capture( fname ):
+    """CaptureSerial で記録したファイルを読み出す
+
+    戻り値:
+        [(開始からの秒数, 'tx' または 'rx', bytes), ...]
+    """
+    records = []
+    with open(fname, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            records.append((record['t'], record['dir'], bytes.fromhex(record['data'])))
+    return records
+
+class ReplaySerial ( ):
+    """記録した受信データを readline() で返すシリアルポートの代わり
+
+    speed: 記録した時間間隔を speed 分の1にする（0 なら待たずに返す）
+    sync: True のときは、記録の中で受信の前にあった送信（write）の回数に達するまで
+        その受信データを返さない（コマンドと応答の順序を保つ）
+    すべて返し終わると self.done がセットされ、以降は timeout 秒待って b'' を返す。
+    """
+
+    def __init__( self, records, speed=0, sync=True, timeout=0.5 ):
+        self.rx = []
+        writes = 0
+        for t, direction, data in records:
+            if direction == 'tx':
+                writes += 1
+            else:
+                self.rx.append((t, writes, data))
+        self.speed = speed
+        self.sync = sync
+        self.timeout = timeout
+        self.pos = 0
+        self.writes = 0
+        self.start = time.time()
+        self.cond = threading.Condition()
+        self.done = threading.Event()
+        self.closed = False
+
+    def readline( self ):
+        if self.pos >= len(self.rx) or self.closed:
+            self.done.set()
+            time.sleep(self.timeout)
+            return b''
+        t, writes, data = self.rx[self.pos]
+        if self.sync:
+            with self.cond:
+                if not self.cond.wait_for(lambda: self.writes >= writes or self.closed, self.timeout):
+                    return b''
+        if self.speed:
+            wait = self.start + t / self.speed - time.time()
+            if wait > 0:
+                time.sleep(min(wait, self.timeout))
+                if wait > self.timeout:
+                    return b''
+        self.pos += 1
+        return data
+
+    def write( self, data ):
+        with self.cond:
+            self.writes += 1
+            self.cond.notify_all()
+        return len(data)
+
+    def close( self ):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class ReplayRL7023 ( WiSunRL7023 ):
+    """記録したシリアル通信を再生する WiSunRL7023（シリアルポートを開かない）"""
+
+    def __init__( self, records, speed=0, sync=True, type=WiSunRL7023.DSS, scancache='scancache.json' ):
+        """コンストラクタ
+
+        引数:
+            records (list or str): load_capture() の戻り値、または記録したファイル
+            speed (number): 再生の速さ（0 なら待たない）
+            sync (bool): コマンドと応答の順序を保つ
+        """
+        super().__init__('replay', 0, type=type, scancache=scancache)
+        if isinstance(records, str):
+            records = load_capture(records)
+        self.records = records
+        self.speed = speed
+        self.sync = sync
+
+    def _open_serial( self ):
+        return ReplaySerial(self.records, speed=self.speed, sync=self.sync)
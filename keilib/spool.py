@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ディスクに保存される FIFO キュー
+
+queue.Queue の代わりに FileRecorder と HttpPostUploader の間に置くと、
+アップロードできなかったデータをプログラムの再起動をまたいで保持できる。
+
+* データは JSON の1行として、セグメントファイル（spool/[番号].seg）に追記する
+* 取り出し位置（セグメント番号とバイト位置）を commit ファイルに記録する
+* get() で取り出したデータは commit() するまで確定しない。
+  アップロードに失敗したら rewind() で取り出し位置を元に戻す
+* commit(count) で、取り出したデータのうち先頭の count 件だけを確定できる
+  （残りは取り出したまま、次の commit() を待つ）
+* 全て取り出し済みのセグメントファイルは削除する
+
+使用例:
+    upload_que = DiskSpool('spool')
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+
+class DiskSpool ( ):
+    """ディスクに保存される FIFO キュー（queue.Queue と同じ put/get が使える）"""
+
+    def __init__( self, directory='spool', segment_size=64 * 1024, max_bytes=None ):
+        """コンストラクタ
+
+        引数：
+            directory (str): セグメントファイルを保存するディレクトリ
+            segment_size (int): セグメントファイルをこのサイズで切り替える
+            max_bytes (int): 保存するデータの上限（超えたら古いセグメントから捨てる、None なら無制限）
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self.commit_seg, self.commit_pos = self._load_commit(segments)
+        self.read_seg, self.read_pos = self.commit_seg, self.commit_pos
+        # 確定していない取り出しごとの、取り出した後の位置 [(seg, pos), ...]
+        self.read_marks = []
+
+        # 書き込みは常に新しいセグメントから始める（前回途中まで書いた行を避けるため）
+        self.write_seg = (segments[-1] + 1) if segments else self.commit_seg
+        self.write_seg = max(self.write_seg, self.commit_seg)
+        self.wf = None
+        self.rf = None
+        self.rf_seg = None
+
+    def _path( self, seg ):
+        return os.path.join(self.directory, '{:08d}.seg'.format(seg))
+
+    def _segments( self ):
+        """存在するセグメント番号のリスト（昇順）"""
+        segs = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg') and name[:-4].isdigit():
+                segs.append(int(name[:-4]))
+        return sorted(segs)
+
+    def _load_commit( self, segments ):
+        """commit ファイルから確定済みの取り出し位置を読み出す"""
+        try:
+            with open(os.path.join(self.directory, 'commit'), 'r') as f:
+                seg, pos = f.read().split()
+            return int(seg), int(pos)
+        except (OSError, ValueError):
+            return (segments[0] if segments else 0), 0
+
+    def _save_commit( self ):
+        """確定済みの取り出し位置を commit ファイルに保存する"""
+        path = os.path.join(self.directory, 'commit')
+        tmpname = path + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write('{} {}\n'.format(self.commit_seg, self.commit_pos))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, path)
+
+    def put( self, item, block=True, timeout=None ):
+        """データを追加する（ディスクに書き込み、fsync する）
+
+        block, timeout は queue.Queue との互換のためのもので使用しない
+        """
+        line = json.dumps(item, ensure_ascii=False) + '\n'
+        with self.cond:
+            if self.wf is not None and self.wf.tell() >= self.segment_size:
+                self.wf.close()
+                self.wf = None
+                self.write_seg += 1
+            if self.wf is None:
+                self.wf = open(self._path(self.write_seg), 'a', encoding='utf-8')
+            self.wf.write(line)
+            self.wf.flush()
+            os.fsync(self.wf.fileno())
+            self._limit()
+            self.cond.notify_all()
+
+    def put_nowait( self, item ):
+        self.put(item, block=False)
+
+    def _limit( self ):
+        """保存しているデータが max_bytes を超えたら古いセグメントから捨てる"""
+        if self.max_bytes is None:
+            return
+        segs = [s for s in self._segments() if s >= self.commit_seg]
+        total = sum(os.path.getsize(self._path(s)) for s in segs)
+        while total > self.max_bytes and len(segs) > 1:
+            seg = segs.pop(0)
+            total -= os.path.getsize(self._path(seg))
+            logger.error('spool is over max_bytes, drop segment ' + str(seg))
+            self._close_reader()
+            os.remove(self._path(seg))
+            self.commit_seg, self.commit_pos = segs[0], 0
+            if self.read_seg < self.commit_seg:
+                self.read_seg, self.read_pos = self.commit_seg, 0
+            self._save_commit()
+
+    def _close_reader( self ):
+        if self.rf is not None:
+            self.rf.close()
+            self.rf = None
+            self.rf_seg = None
+
+    def _read_next( self ):
+        """取り出し位置から1件読む（なければ None）"""
+        while self.read_seg <= self.write_seg:
+            if self.rf_seg != self.read_seg:
+                self._close_reader()
+                try:
+                    self.rf = open(self._path(self.read_seg), 'rb')
+                    self.rf_seg = self.read_seg
+                except FileNotFoundError:
+                    if self.read_seg < self.write_seg:
+                        self.read_seg, self.read_pos = self.read_seg + 1, 0
+                        continue
+                    return None
+
+            self.rf.seek(self.read_pos)
+            line = self.rf.readline()
+            if line.endswith(b'\n'):
+                self.read_pos += len(line)
+                try:
+                    return json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logger.error('broken spool data is skipped')
+                    continue
+
+            # このセグメントの終わり（書き込み途中の行は読まない）
+            if self.read_seg < self.write_seg:
+                self.read_seg, self.read_pos = self.read_seg + 1, 0
+                continue
+            return None
+        return None
+
+    def get( self, block=True, timeout=None ):
+        """次のデータを取り出す（commit() するまでは確定しない）
+
+        データがなければ queue.Empty を送出する
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                item = self._read_next()
+                if item is not None:
+                    self.read_marks.append((self.read_seg, self.read_pos))
+                    return item
+                if not block:
+                    raise queue.Empty
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.cond.wait(remaining)
+
+    def get_nowait( self ):
+        return self.get(block=False)
+
+    def commit( self, count=None ):
+        """get() で取り出したデータまでを確定し、不要になったセグメントを削除する
+
+        引数：
+            count (int): 確定していない取り出しの先頭から count 件だけを確定する（None なら全部）
+        """
+        with self.cond:
+            if count is None or count >= len(self.read_marks):
+                position = (self.read_seg, self.read_pos)
+                self.read_marks = []
+            elif count > 0:
+                position = self.read_marks[count - 1]
+                del self.read_marks[:count]
+            else:
+                return
+            old_seg = self.commit_seg
+            # _limit() で捨てたセグメントより前には戻さない
+            self.commit_seg, self.commit_pos = max(position, (self.commit_seg, self.commit_pos))
+            self._save_commit()
+            for seg in range(old_seg, self.commit_seg):
+                if self.rf_seg == seg:
+                    self._close_reader()
+                try:
+                    os.remove(self._path(seg))
+                except FileNotFoundError:
+                    pass
+
+    def rewind( self ):
+        """取り出し位置を確定済みの位置に戻す（アップロード失敗時など）"""
+        with self.cond:
+            self.read_seg, self.read_pos = self.commit_seg, self.commit_pos
+            self.read_marks = []
+
+    def empty( self ):
+        """未確定のデータも含めて、取り出せるデータがなければ True"""
+        with self.cond:
+            seg, pos = self.read_seg, self.read_pos
+            item = self._read_next()
+            self.read_seg, self.read_pos = seg, pos
+            return item is None
@@ -8,7 +8,11 @@ ToDo:
 """
 import threading
 import requests
+import random
 import sys
+import time
+import json
+import gzip
 import queue
 from keilib.worker import Worker
 
@@ -17,44 +21,250 @@ logger = getLogger(__name__)
 
 class HttpPostUploader ( Worker ):
     """upload_queに入っているデータを取り出して、httpサーバーにPOSTする
+
+    * POST に失敗したデータは捨てずに、間隔を空けて再送する
+        - 再送間隔は retry_min 秒から失敗するごとに2倍にし、retry_max 秒まで
+        - 再送間隔にはゆらぎ（jitter）を加え、一斉に再送しないようにする
+    * 連続して POST する場合は min_interval 秒以上の間隔を空ける
+      （通信断から回復して、たまったデータを送るときの送信レート）
+    * upload_que に DiskSpool を指定すると、送信できていないデータは
+      ディスクに保存され、再起動しても失われない
+    * サーバーがデータそのものを拒否した（400, 413）データは再送しても受け付けられないので捨てる
+      それ以外の 4xx（認証の 401, 403、メンテナンス中のプロキシの 404 など）は、
+      設定やサーバーが直れば受け付けられるので、データを捨てずに再送する
+    * HTTP の接続は requests.Session で使い回す（keep-alive）
+    * batch=True のときは、複数のデータをまとめて1回の POST で送る
+        - データの合計が batch_bytes バイトに達するか、最も古いデータを
+          取り出してから batch_age 秒経ったら送信する
+        - 1回の POST は max_bytes バイト（サーバーの上限）以下にし、
+          残りは送信待ちのまま次の POST で送る
+        - サーバーが 413（大きすぎる）を返したら、まとめる数を半分にして送り直す
+        - 送信データは JSON {"key": ..., "files": [{"fname": ..., "data": ...}, ...]}
+        - サーバーはファイルごとに検査し、受け付けなかったファイルだけを応答で返す
+          {"result": "OK", "rejected": [{"index": ..., "fname": ..., "error": ...}, ...]}
+          （受け付けなかったファイルはログに記録して捨てる）
+        - compress=True なら gzip で圧縮する（Content-Encoding: gzip）
+        - サーバー側は php/upload.php を参照
     """
 
-    def __init__( self , upload_que, target_url, upload_key):
+    # データそのものが原因で拒否されたときの HTTP ステータスコード（再送しない）
+    REJECT_STATUS = (400, 413)
+
+    def __init__( self , upload_que, target_url, upload_key, retry_min=10, retry_max=600, min_interval=0,
+                  batch=False, batch_bytes=8192, batch_age=3600, compress=True, max_bytes=64000 ):
         """コンストラクタ
         引数：
-            upload_que (Queue): データ受け取るための queue
+            upload_que (Queue): データ受け取るための queue（DiskSpool も可）
             target_url (str): サーバーURL
             upload_key (str): アップロードキー(サーバー側で認証に使う)
+            retry_min (number): 再送間隔の初期値（秒）
+            retry_max (number): 再送間隔の最大値（秒）
+            min_interval (number): POST の最小間隔（秒）
+            batch (bool): 複数のデータをまとめて送る
+            batch_bytes (int): まとめて送るデータの合計サイズの目安（バイト）
+            batch_age (number): 最も古いデータを取り出してから送信するまでの最大の秒数
+            compress (bool): まとめて送るときに gzip で圧縮する
+            max_bytes (int): まとめて送るデータの合計サイズの上限（バイト、php/upload.php の $max_length）
         """
         super().__init__()
         self.upload_que = upload_que
         self.target_url = target_url
         self.upload_key = upload_key
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.min_interval = min_interval
+        self.batch = batch
+        self.batch_bytes = batch_bytes
+        self.batch_age = batch_age
+        self.compress = compress
+        self.max_bytes = max_bytes
+
+        # DiskSpool であれば、送信に成功したときに commit する
+        self.spool = hasattr(upload_que, 'commit')
+        # 送信待ちのデータ [[filename, data], ...] と、その最も古いデータを取り出した時刻
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_time = 0
+        # 413 を受けて、送信待ちを送り終えるまでまとめる数を減らすときの上限（0 なら制限なし）
+        self.max_files = 0
+        self.status = None
+        self.backoff = 0
+        self.lasttime_post = 0
+        self.session = None
+
+    def _check_response( self, response ):
+        """サーバーの応答を判定する
+
+        戻り値:
+            True: 成功
+            False: 失敗（再送する）
+            None: 失敗（サーバーに拒否されたので再送しない）
+        """
+        self.status = response.status_code
+        if response.status_code in self.REJECT_STATUS:
+            logger.error('upload rejected ' + str(response.status_code) + ': ' + response.text[:100])
+            return None
+        if response.status_code in (401, 403):
+            # アップロードキーの誤りなど。直るまでデータを残して再送する
+            logger.error('upload unauthorized ' + str(response.status_code) + ': ' + response.text[:100])
+            return False
+        if response.status_code >= 300 or response.text.startswith('Error'):
+            logger.warning('upload failed ' + str(response.status_code) + ': ' + response.text[:100])
+            return False
+        if self.batch and response.text.startswith('{'):
+            # まとめて送ったうち、サーバーが受け付けなかったファイル
+            try:
+                rejected = json.loads(response.text).get('rejected', [])
+            except ValueError:
+                rejected = []
+            for entry in rejected:
+                logger.error('upload rejected file {}: {}'.format(entry.get('fname'), entry.get('error')))
+        return True
+
+    def _post( self, items ):
+        """データを POST する
+
+        引数：
+            items (list): [filename, data] のリスト
+
+        戻り値:
+            _check_response() と同じ
+        """
+        if self.session is None:
+            self.session = requests.Session()
+
+        try:
+            if self.batch:
+                body = json.dumps({
+                    'key'  : self.upload_key,
+                    'files': [{'fname': filename, 'data': data} for filename, data in items]
+                }).encode('utf-8')
+                headers = {'Content-Type': 'application/json'}
+                if self.compress:
+                    size = len(body)
+                    body = gzip.compress(body)
+                    headers['Content-Encoding'] = 'gzip'
+                    logger.debug('upload {} files, {} -> {} bytes'.format(len(items), size, len(body)))
+                response = self.session.post(self.target_url, data=body, headers=headers, timeout=60)
+
+            else:
+                filename, data = items[0]
+                payload = {
+                    'type' : 'text',
+                    'key'  : self.upload_key,
+                    'fname': filename,
+                    'data' : data
+                }
+                logger.debug(payload)
+                # POST execution（POST実行）
+                response = self.session.post(self.target_url, payload, timeout=60)
+
+        except Exception as err:
+            logger.error('requests post error: ' + str(err))
+            # 接続に問題があるかもしれないので、次回は新しいセッションで接続する
+            self.session.close()
+            self.session = None
+            return False
+
+        return self._check_response(response)
+
+    def _retry_wait( self ):
+        """失敗したときの待ち時間（指数的に増やし、ゆらぎを加える）"""
+        if self.backoff == 0:
+            self.backoff = self.retry_min
+        else:
+            self.backoff = min(self.backoff * 2, self.retry_max)
+        delay = random.uniform(self.backoff / 2, self.backoff)
+        logger.info('retry upload after {:.0f} sec'.format(delay))
+        self.stopEvent.wait(delay)
+
+    def _collect( self ):
+        """upload_que からデータを取り出して送信待ちに加える
+
+        戻り値:
+            True: 送信する
+            False: まだ送信しない
+        """
+        limit = min(self.batch_bytes, self.max_bytes) if self.batch else 0
+        while not self.pending or self.pending_bytes < limit:
+            try:
+                if self.pending:
+                    item = self.upload_que.get_nowait()
+                else:
+                    item = self.upload_que.get(timeout=3)
+            except queue.Empty:
+                break
+            if not self.pending:
+                self.pending_time = time.monotonic()
+            self.pending.append(item)
+            self.pending_bytes += len(item[0]) + len(item[1])
+
+        if not self.pending:
+            return False
+        if not self.batch or self.pending_bytes >= self.batch_bytes:
+            return True
+        if time.monotonic() - self.pending_time >= self.batch_age:
+            return True
+        # 次のデータを待つ
+        self.stopEvent.wait(1)
+        return False
+
+    def _count( self ):
+        """送信待ちの先頭から、1回の POST で送るデータの数
+
+        合計が max_bytes を超えない数（ただし少なくとも1件）
+        """
+        if not self.batch:
+            return 1
+        size = 0
+        for count, (filename, data) in enumerate(self.pending):
+            size += len(filename) + len(data)
+            if count and (size > self.max_bytes or count == self.max_files):
+                return count
+        return len(self.pending)
 
     def run ( self ):
         logger.info('[START]')
         # self.upload_que.put(['test.txt', 'This is test data\n'])
         while not self.stopEvent.is_set():
             # get data from upload_que（queueからデータの取得）
-            try:
-                filename, data = self.upload_que.get(timeout=3)
-            except:
-                # logger.debug('upload que is empty')
+            if not self._collect():
                 continue
 
-            payload = {
-                'type' : 'text',
-                'key'  : self.upload_key,
-                'fname': filename,
-                'data' : data
-            }
-            logger.debug(payload)
+            # POST の最小間隔を空ける
+            wait = self.lasttime_post + self.min_interval - time.monotonic()
+            if wait > 0:
+                self.stopEvent.wait(wait)
+                continue
 
-            # POST execution（POST実行）
-            try:
-                response = requests.post(self.target_url, payload)
-            except:
-                logger.error('requests post error')
+            self.lasttime_post = time.monotonic()
+            items = self.pending[:self._count()]
+            result = self._post(items)
+
+            if result is False:
+                # 再送する。DiskSpool の場合は取り出し位置を戻して読み直す
+                if self.spool:
+                    self.upload_que.rewind()
+                    self.pending = []
+                    self.pending_bytes = 0
+                self._retry_wait()
+                continue
+
+            if result is None and self.status == 413 and len(items) > 1:
+                # まとめすぎ。半分ずつ送り直す
+                self.max_files = len(items) // 2
+                logger.warning('too large upload, send {} files at a time'.format(self.max_files))
                 continue
 
+            # 送信した（または拒否された）データを確定し、残りは次の POST で送る
+            if self.spool:
+                self.upload_que.commit(len(items))
+            del self.pending[:len(items)]
+            self.pending_bytes -= sum(len(filename) + len(data) for filename, data in items)
+            self.backoff = 0
+            if not self.pending:
+                self.max_files = 0
+
+        if self.session is not None:
+            self.session.close()
         logger.info('[STOP]')
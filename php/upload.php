@@ -1,9 +1,54 @@
 <?php
 // POSTされてきた内容をチェックし保存
 // 不正なアクセスはリジェクト
+// エラーの場合は HTTP ステータスコードも返す
+//   400, 413: 送られたデータが原因のエラー（再送しても受け付けられないので、データは捨てられる）
+//   403: アップロードキーの誤り（HttpPostUploader はデータを残して再送する）
+//   429: 一時的なエラー（時間をおいて再送すれば受け付けられる）
+//
+// 受け付ける形式は2通り
+//   1. 1ファイルずつのフォーム形式（key, fname, data）
+//   2. 複数ファイルをまとめた JSON 形式（HttpPostUploader の batch=True）
+//        {"key": "...", "files": [{"fname": "...", "data": "..."}, ...]}
+//      Content-Encoding: gzip の場合は gzip で圧縮されている
+//      ファイルごとにチェックし、受け付けたファイルは書き込む。受け付けなかったファイルは
+//        {"result": "OK", "rejected": [{"index": ..., "fname": ..., "error": ...}, ...]}
+//      で返す（400 はリクエスト全体が不正な場合だけ）
+
+// 送信データの取得
+$content_type = isset($_SERVER["CONTENT_TYPE"]) ? $_SERVER["CONTENT_TYPE"] : "";
+if (strpos($content_type, "application/json") === 0) {
+  $body = file_get_contents("php://input");
+  $encoding = isset($_SERVER["HTTP_CONTENT_ENCODING"]) ? $_SERVER["HTTP_CONTENT_ENCODING"] : "";
+  if ($encoding === "gzip") {
+    // 展開後のサイズにも上限を設ける（以下の例は 1MB）
+    $body = gzdecode($body, 1000000);
+    if ($body === false) {
+      http_response_code(400);
+      exit("Error: Invalid gzip data.");
+    }
+  }
+  $request = json_decode($body, true);
+  if (!is_array($request) || !isset($request["files"]) || !is_array($request["files"])) {
+    http_response_code(400);
+    exit("Error: Invalid json data.");
+  }
+  $key = isset($request["key"]) ? $request["key"] : "";
+  $files = $request["files"];
+  $is_batch = true;
+  // データサイズの上限（まとめて送られた場合の合計）
+  $max_length = 64000;
+} else {
+  $key = $_POST["key"];
+  $files = array(array("fname" => $_POST["fname"], "data" => $_POST["data"]));
+  $is_batch = false;
+  // データサイズの上限
+  $max_length = 1000;
+}
 
 // アップロードキーのチェック
-if ($_POST["key"] !== "xxxxxxxxxxxxxxxxxxxx") {
+if ($key !== "xxxxxxxxxxxxxxxxxxxx") {
+  http_response_code(403);
   exit("Error: Invalid key is specified.");
 }
 
@@ -16,42 +61,84 @@ try {
 }
 $ctime = time();
 if ($ctime - $ptime < 100) {
+  http_response_code(429);
   exit("Error: Upload interval is too short. Try later.");
 }
 
-// データサイズによる制限
-// 以下の例は 1000 Byte 未満
-$data  = $_POST["data"];
-$length = strlen($data);
-if ($length > 1000) {
+// データサイズによる制限（合計）。超えた場合は何も書き込まずに 413 を返す
+// 以下の例は 1ファイルの場合 1000 Byte 未満、まとめて送られた場合は合計 64000 Byte 未満
+// （HttpPostUploader はまとめる数を減らして送り直す）
+$total = 0;
+foreach ($files as $file) {
+  if (is_array($file) && isset($file["data"]) && is_string($file["data"])) {
+    $total += strlen($file["data"]);
+  }
+}
+if ($total > $max_length) {
+  http_response_code(413);
   exit("Error: Too big data.");
 }
 
-// ファイル名長さチェック
-// 以下の例は 20 Byte 未満
-$fname = $_POST["fname"];
-$length = strlen($fname);
-if ($length > 20) {
-  exit("Error: Too long file name.");
+// ファイルごとにチェックし、受け付けたファイルだけを書き込む
+function check_file($file) {
+  if (!is_array($file) || !isset($file["fname"]) || !isset($file["data"])
+      || !is_string($file["fname"]) || !is_string($file["data"])) {
+    return "Invalid file entry.";
+  }
+
+  // ファイル名長さチェック
+  // 以下の例は 20 Byte 未満
+  $fname = $file["fname"];
+  $length = strlen($fname);
+  if ($length > 20) {
+    return "Too long file name.";
+  }
+
+  // ファイル名チェック、上書きして良いファルだけ
+  // 以下の例は、パス区切り文字/(スラッシュ)を含めない。想定外のディレクトリに書き込まれないように。
+  if ( ! preg_match("/^[A-Za-z0-9_]+(\.[A-Za-z0-0_]+)*$/", $fname)) {
+    return "Invalid file name.";
+  }
+
+  // その他のチェックを行う
+  // 大切なファイルを破壊されないように
+  // 以下の例は update_ok.txt というファイルだけ通す
+  # if ( ! preg_match("/^update_ok\.txt$/", $fname)) {
+  #   return "The file name is not allowd.";
+  # }
+  return "";
 }
 
-// ファイル名チェック、上書きして良いファルだけ
-// 以下の例は、パス区切り文字/(スラッシュ)を含めない。想定外のディレクトリに書き込まれないように。
-if ( ! preg_match("/^[A-Za-z0-9_]+(\.[A-Za-z0-0_]+)*$/", $fname)) {
-  exit("Error: Invalid file name.");
+$accepted = array();
+$rejected = array();
+foreach ($files as $index => $file) {
+  $error = check_file($file);
+  if ($error === "") {
+    $accepted[] = $file;
+  } else {
+    $fname = (is_array($file) && isset($file["fname"]) && is_string($file["fname"])) ? $file["fname"] : "";
+    $rejected[] = array("index" => $index, "fname" => $fname, "error" => $error);
+  }
 }
 
-// その他のチェックを行う
-// 大切なファイルを破壊されないように
-// 以下の例は update_ok.txt というファイルだけ通す
-# if ( ! preg_match("/^update_ok\.txt$/", $fname)) {
-#   exit("Error: The file name is not allowd.");
-# }
+// 1ファイルずつのフォーム形式は、これまでどおりエラーを返す
+if (!$is_batch && count($rejected) > 0) {
+  http_response_code(400);
+  exit("Error: " . $rejected[0]["error"]);
+}
 
-// 指定されたファイルにデータを追記
-$fp = fopen("data/" . $fname, 'a');
-fwrite($fp, $data);
-fclose($fp);
+// 指定されたファイルにデータを追記（送られた順に）
+foreach ($accepted as $file) {
+  $fp = fopen("data/" . $file["fname"], 'a');
+  fwrite($fp, $file["data"]);
+  fclose($fp);
+}
 file_put_contents('ptime.txt', $ctime);
-print "OK.";
+if ($is_batch) {
+  // 受け付けなかったファイルはファイルごとに返す（まとめて送られた他のファイルは書き込む）
+  header("Content-Type: application/json");
+  print json_encode(array("result" => "OK", "rejected" => $rejected));
+} else {
+  print "OK.";
+}
 ?>
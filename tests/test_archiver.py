@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.archiver と keilib.reader のテスト
+
+    $ python3 -m unittest discover tests
+"""
+
+import io
+import os
+import datetime
+import contextlib
+import tempfile
+import unittest
+
+from keilib.archiver import FileArchiver, open_archived, load_registry
+from keilib import reader
+from keilib.aggregator import COUNT, LAST
+
+class TestBackfillAfterArchive ( unittest.TestCase ):
+    """アーカイブした日のデータファイルに、補完データが書かれた場合"""
+
+    DAY_LINES = ['2020/01/01 00:10:00,BR,E0,100.0,x\n',
+                 '2020/01/01 12:00:00,BR,E0,105.0,x\n']
+    BACKFILL_LINES = ['2020/01/01 06:00:00,BR,E0,102.5,H\n']
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+        self.archive_dir = os.path.join(self.directory, 'archive')
+        self.archiver = FileArchiver(directory=self.directory, archive_dir=self.archive_dir,
+                                     method='gzip', settle=0)
+        self.filename = os.path.join(self.directory, '20200101-t.txt')
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def _write( self, lines ):
+        with open(self.filename, 'a') as f:
+            f.write(''.join(lines))
+
+    def _samples( self ):
+        return list(reader.samples('t', 'BR', 'E0', datetime.datetime(2020, 1, 1),
+                                   datetime.datetime(2020, 1, 2), directory=self.directory))
+
+    def test_backfill_is_merged( self ):
+        self._write(self.DAY_LINES)
+        self.archiver.archive()
+        self.assertFalse(os.path.exists(self.filename))
+
+        # 補完データでその日のデータファイルがもう一度作られる
+        self._write(self.BACKFILL_LINES)
+        # アーカイブする前もデータファイルとアーカイブの両方を読む
+        self.assertEqual([value for ts, value in self._samples()], [100.0, 102.5, 105.0])
+
+        self.archiver.archive()
+        self.assertFalse(os.path.exists(self.filename))
+        with open_archived('20200101-t.txt', self.archive_dir) as f:
+            self.assertEqual(f.readlines(), self.DAY_LINES + self.BACKFILL_LINES)
+        entry = load_registry(self.archive_dir)['20200101-t.txt']
+        self.assertEqual(entry['size'], len(''.join(self.DAY_LINES + self.BACKFILL_LINES)))
+        self.assertEqual([value for ts, value in self._samples()], [100.0, 102.5, 105.0])
+
+class TestArchiveDir ( unittest.TestCase ):
+    """FileArchiver の archive_dir がデータファイルのディレクトリの外にある場合"""
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, 'data')
+        self.archive_dir = os.path.join(self.tmpdir.name, 'zip')
+        os.makedirs(self.directory)
+        with open(os.path.join(self.directory, '20200101-t.txt'), 'w') as f:
+            f.write(''.join(TestBackfillAfterArchive.DAY_LINES))
+        FileArchiver(directory=self.directory, archive_dir=self.archive_dir, method='gzip', settle=0).archive()
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def test_aggregates_reads_archive_dir( self ):
+        start, end = datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2)
+        rows = reader.aggregates('t', 'BR', 'E0', start, end, 86400, directory=self.directory,
+                                 archive_dir=self.archive_dir)
+        self.assertEqual([(dt, int(slot[COUNT]), slot[LAST]) for dt, slot in rows], [(start, 2, 105.0)])
+        # archive_dir を指定しないと見つからない
+        self.assertEqual(reader.aggregates('t', 'BR', 'E0', start, end, 86400, directory=self.directory), [])
+
+    def test_query_archive_option( self ):
+        argv = ['t', 'BR', 'E0', '2020/01/01 00:00', '2020/01/02 00:00', '--span', '86400',
+                '--dir', self.directory, '--archive', self.archive_dir]
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(reader.main(argv), 0)
+        self.assertEqual(out.getvalue().split(',')[:5], ['2020/01/01 00:00', 'BR', 'E0', '102.5', '2'])
+
+if __name__ == '__main__':
+    unittest.main()
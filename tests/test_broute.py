@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.broute のテスト
+
+    $ python3 -m unittest discover tests
+"""
+
+import os
+import json
+import queue
+import tempfile
+import unittest
+from unittest import mock
+
+from keilib.broute import BrouteReader
+
+class TestBackfill ( unittest.TestCase ):
+    """スマートメーターの履歴による補完"""
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmpdir.name, 'state.json')
+        # デバイスは開かない（送信は _sendto を置き換える）
+        self.reader = BrouteReader(None, '', '', record_que=queue.Queue(), state_file=self.state_file)
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def test_resend_failure_advances_backfill( self ):
+        reader = self.reader
+        reader.backfill = [2, 1, 0]
+        reader.backfill_step = 'get'
+        reader.transactions = {'0001': {'epc': ['E2'], 'edt': None, 'sent': 0, 'retry': 0}}
+        reader._sendto = lambda cmd: False
+
+        reader._check_transactions(reader.tx_timeout + 1)
+        self.assertEqual(reader.transactions, {})
+        self.assertEqual(reader.backfill, [1, 0])
+        self.assertIsNone(reader.backfill_step)
+
+    def test_state_is_saved_at_each_slot( self ):
+        reader = self.reader
+        saved = []
+        for now in [1800 * 100 + 10, 1800 * 100 + 1700, 1800 * 101 + 5, 1800 * 101 + 900]:
+            reader._recorded_energy(now)
+            with open(self.state_file) as f:
+                saved.append(json.load(f)['lasttime_energy'])
+        # 30分のコマが変わったときだけ保存する
+        self.assertEqual(saved, [1800 * 100 + 10, 1800 * 100 + 10, 1800 * 101 + 5, 1800 * 101 + 5])
+
+class _Device ( ):
+    """回復の各段階の結果を決めておくデバイス"""
+
+    def __init__( self ):
+        self.ok = {'rejoin': False, 'join': False, 'reset': False, 'scan': False}
+
+    def __getattr__( self, name ):
+        ok = self.ok
+        return lambda *args, **kwargs: ok.get(name, True)
+
+class TestRecovery ( unittest.TestCase ):
+    """接続の回復の段階ごとの記録"""
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.device = _Device()
+        self.reader = BrouteReader(self.device, '', '', record_que=queue.Queue(),
+                                   state_file=os.path.join(self.tmpdir.name, 'state.json'))
+        self.reader.state = self.reader._STATE_JOIN
+        patcher = mock.patch('keilib.broute.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def _scan_until_init( self ):
+        reader = self.reader
+        reader.state = reader._STATE_SETUP
+        while reader.state != reader._STATE_INIT:
+            reader._scan()
+
+    def test_scan_tier_failures_are_recorded( self ):
+        reader = self.reader
+        reader._recover('test')
+        stats = reader.recovery_stats
+        self.assertEqual(reader.state, reader._STATE_INIT)
+        self.assertEqual([stats[tier]['failed'] for tier in ('rejoin', 'join', 'restore')], [1, 1, 1])
+        self.assertEqual(stats['scan']['count'], 1)
+
+        # スキャンが何度も失敗して INIT に戻るたびに失敗を記録し、次の回を数える
+        self._scan_until_init()
+        self._scan_until_init()
+        self.assertEqual((stats['scan']['count'], stats['scan']['failed']), (3, 2))
+
+        # スキャンできたが PANA 認証ができない
+        self.device.ok['scan'] = True
+        reader.state = reader._STATE_SETUP
+        reader._scan()
+        while reader.state != reader._STATE_INIT:
+            reader._join()
+        self.assertEqual((stats['scan']['count'], stats['scan']['failed']), (4, 3))
+
+        # 4回目で回復
+        self.device.ok['join'] = True
+        reader.state = reader._STATE_SETUP
+        reader._scan()
+        reader._join()
+        self.assertEqual(reader.state, reader._STATE_JOIN)
+        self.assertEqual((stats['scan']['count'], stats['scan']['success'], stats['scan']['failed']), (4, 1, 3))
+        self.assertIsNone(reader.recovery_start)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.checker のテスト
+
+    $ python3 -m unittest discover tests
+"""
+
+import random
+import unittest
+from unittest import mock
+
+from keilib import checker as checker_module
+from keilib.checker import OutlierChecker
+
+def _stream( count, seed=1 ):
+    """2ユニット x 2センサーの値、ときどきスパイクと水準の変化"""
+    rand = random.Random(seed)
+    level = {}
+    for i in range(count):
+        unit, sensor = rand.choice(['A', 'B']), rand.choice(['T1', 'H'])
+        base = level.setdefault((unit, sensor), 20.0)
+        if rand.random() < 0.01:
+            base = level[(unit, sensor)] = base + rand.choice([-15, 15])
+        value = base + rand.gauss(0, 0.5)
+        if rand.random() < 0.05:
+            value += rand.choice([-30, 30, 200])
+        yield unit, sensor, value
+
+def _checker( mad=4, zscore=4 ):
+    checker = OutlierChecker()
+    checker.add('A', 'T1', -10, 60, 3)
+    checker.add('B', 'T1', -50, 100, mad=mad)
+    checker.add('A', 'H', zscore=zscore, alpha=0.2)
+    return checker
+
+def _clean_stream( count, seed=1 ):
+    """水準が変わらず、雑音が一様分布（±0.5）、ときどき ±30 のスパイク
+
+    統計のしきい値の近くの値がなく、統計がバッチの中で大きく動くこともないので、
+    numpy で評価しても check() と同じ結果になる
+    """
+    rand = random.Random(seed)
+    for i in range(count):
+        unit, sensor = rand.choice(['A', 'B']), rand.choice(['T1', 'H'])
+        value = 20.0 + rand.uniform(-0.5, 0.5)
+        if rand.random() < 0.02:
+            value += rand.choice([-30, 30])
+        yield unit, sensor, value
+
+def _check_in_batches( checker, data, size ):
+    results = []
+    for start in range(0, len(data), size):
+        units, sensors, values = zip(*data[start:start + size])
+        results += checker.check_batch(units, sensors, values)
+    return results
+
+class TestOutlierChecker ( unittest.TestCase ):
+
+    def test_range_and_variation( self ):
+        checker = OutlierChecker()
+        checker.add('A', 'T1', 0, 50, 3)
+        results = [checker.check('A', 'T1', value) for value in [20, 60, 21, 30, 31, 32, 33, 20]]
+        # 範囲外は外れ値、3回続いた変動は新しい基準
+        self.assertEqual(results, [True, False, True, False, False, True, True, False])
+        self.assertTrue(checker.check('B', 'T1', 999))
+
+    def test_check_batch_equals_check( self ):
+        """1件ずつ調べる方法（numpy なし、または統計の規則の値が少ないバッチ）"""
+        data = list(_stream(5000))
+        single, batch = _checker(), _checker()
+        expected = [single.check(*item) for item in data]
+        for size in (10, 100):
+            with self.subTest(size=size), mock.patch.object(checker_module, 'numpy', None):
+                batch = _checker()
+                self.assertEqual(_check_in_batches(batch, data, size), expected)
+        self.assertIn(False, expected)
+
+    @unittest.skipIf(checker_module.numpy is None, 'numpy is not installed')
+    def test_check_batch_numpy( self ):
+        """numpy で評価する方法"""
+        data = list(_clean_stream(5000))
+        single, batch = _checker(mad=8, zscore=8), _checker(mad=8, zscore=8)
+        expected = [single.check(*item) for item in data]
+        with mock.patch.object(batch, '_check_numpy', wraps=batch._check_numpy) as check_numpy:
+            results = _check_in_batches(batch, data, 200)
+        self.assertTrue(check_numpy.called)
+        self.assertEqual(results, expected)
+        # 登録したセンサーの、統計の判定を始めた後のスパイクはすべて外れ値
+        spikes = [result for (unit, sensor, value), result in zip(data[100:], results[100:])
+                  if (unit, sensor) in batch.index and abs(value - 20) > 10]
+        self.assertEqual(spikes, [False] * len(spikes))
+        self.assertTrue(spikes)
+        for name in ('prev', 'count', 'strikes', 'mean', 'var', 'winpos'):
+            self.assertEqual(list(getattr(batch, name)), list(getattr(single, name)), name)
+        self.assertEqual(repr(batch.win), repr(single.win))
+
+    @unittest.skipIf(checker_module.numpy is None, 'numpy is not installed')
+    def test_check_batch_numpy_uses_batch_start_stats( self ):
+        """numpy では z スコアをバッチの開始時点の統計と比べる"""
+        single, batch = OutlierChecker(), OutlierChecker()
+        for checker in (single, batch):
+            checker.add('A', 'T1', zscore=3, alpha=0.5)
+            checker.STATS_BATCH_MIN = 1
+            for k in range(20):
+                checker.check('A', 'T1', 10.0 if k % 2 else 12.0)
+        # 11 が続くと標準偏差が小さくなり、check() では 13 が外れ値になる。
+        # バッチの開始時点の標準偏差（約 0.94）と比べると外れ値ではない
+        values = [11.0] * 10 + [13.0]
+        self.assertEqual([single.check('A', 'T1', value) for value in values], [True] * 10 + [False])
+        self.assertEqual(batch.check_batch(['A'] * 11, ['T1'] * 11, values), [True] * 11)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.columnar のテスト
+
+    $ python3 -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+
+from keilib.columnar import ColumnarWriter, COLUMN_FILES, day_dirname, open_day
+
+class TestPartialFlush ( unittest.TestCase ):
+    """書き込み途中で停止して、列の長さがそろっていない場合"""
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def test_append_after_partial_flush( self ):
+        writer = ColumnarWriter('t', directory=self.directory)
+        writer.append(1000, 'A', 'T1', 1.0, day='20200101')
+        writer.append(1001, 'A', 'T1', 2.0, day='20200101')
+        writer.close()
+
+        # ts と value にだけ3行目が書かれたところで停止した
+        dirname = day_dirname('t', '20200101', self.directory)
+        with open(os.path.join(dirname, COLUMN_FILES['ts']), 'ab') as f:
+            f.write((2000).to_bytes(8, 'little'))
+        with open(os.path.join(dirname, COLUMN_FILES['value']), 'ab') as f:
+            f.write(b'\x00\x00\x00')
+
+        writer = ColumnarWriter('t', directory=self.directory)
+        writer.append(1003, 'A', 'T1', 4.0, day='20200101')
+        writer.close()
+
+        cols = open_day(dirname)
+        rows = list(zip(cols['ts'], cols['value']))
+        self.assertEqual([(int(t), float(v)) for t, v in rows], [(1000, 1.0), (1001, 2.0), (1003, 4.0)])
+        sizes = {name: os.path.getsize(os.path.join(dirname, fname)) for name, fname in COLUMN_FILES.items()}
+        self.assertEqual(sizes, {'ts': 24, 'value': 24, 'unit': 6, 'sensor': 6})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.recorder のテスト
+
+    $ python3 -m unittest discover tests
+"""
+
+import os
+import queue
+import sqlite3
+import tempfile
+import unittest
+
+from keilib.recorder import SqlRecorder
+
+class _FlakyConnection ( ):
+    """最初の failures 回の書き込みで sqlite3.Error を送出する接続"""
+
+    def __init__( self, conn, failures ):
+        self.conn = conn
+        self.failures = failures
+
+    def executemany( self, sql, rows ):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database or disk is full')
+        return self.conn.executemany(sql, rows)
+
+    def __enter__( self ):
+        return self.conn.__enter__()
+
+    def __exit__( self, *args ):
+        return self.conn.__exit__(*args)
+
+class TestSqlWriteError ( unittest.TestCase ):
+    """データベースに書き込めない場合"""
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.recorder = SqlRecorder(queue.Queue(), dbname=os.path.join(self.tmpdir.name, 'kei.db'),
+                                    max_rows=3)
+        self.conn = self.recorder._connect()
+
+    def tearDown( self ):
+        self.conn.close()
+        self.tmpdir.cleanup()
+
+    def _stored( self ):
+        return [row[0] for row in self.conn.execute('SELECT value FROM data ORDER BY value')]
+
+    def test_rows_are_kept_until_written( self ):
+        recorder = self.recorder
+        flaky = _FlakyConnection(self.conn, failures=1)
+        recorder.rows = [(1000, 'A', 'T1', 1.0, '1'), (1001, 'A', 'T1', 2.0, '2')]
+        with self.assertLogs('keilib.recorder', 'ERROR'):
+            recorder._try_flush(flaky)
+        self.assertEqual(len(recorder.rows), 2)
+        self.assertEqual(self._stored(), [])
+
+        recorder._try_flush(flaky)
+        self.assertEqual(recorder.rows, [])
+        self.assertEqual(self._stored(), [1.0, 2.0])
+
+    def test_kept_rows_are_capped( self ):
+        recorder = self.recorder
+        flaky = _FlakyConnection(self.conn, failures=2)
+        recorder.rows = [(1000 + k, 'A', 'T1', float(k), str(k)) for k in range(2)]
+        with self.assertLogs('keilib.recorder', 'ERROR'):
+            recorder._try_flush(flaky)
+        recorder.rows += [(1000 + k, 'A', 'T1', float(k), str(k)) for k in range(2, 5)]
+        with self.assertLogs('keilib.recorder', 'ERROR') as logs:
+            recorder._try_flush(flaky)
+        self.assertIn('drop 2 oldest rows', logs.output[-1])
+        recorder._try_flush(flaky)
+        self.assertEqual(self._stored(), [2.0, 3.0, 4.0])
+
+if __name__ == '__main__':
+    unittest.main()
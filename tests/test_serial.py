@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.serial のテスト
+
+    $ python3 -m unittest discover tests
+"""
+
+import unittest
+
+from keilib.serial import LineValidator, FrameDecoder, encode_frame
+
+class TestLineValidator ( unittest.TestCase ):
+    """重複データの検査"""
+
+    def test_repeated_value_with_auto_dataid( self ):
+        validator = LineValidator('test')
+        accepted = [validator.validate('A,T1,20.0') for i in range(300)]
+        self.assertEqual(sum(item is not None for item in accepted), 300)
+
+    def test_repeated_value_with_wrapping_dataid( self ):
+        # TWELite のように 8bit で一巡する dataID、値は一定
+        validator = LineValidator('test')
+        accepted = [validator.validate('A,T1,20.0,{:02X}'.format(i % 256)) for i in range(1800)]
+        self.assertEqual(sum(item is not None for item in accepted), 1800)
+
+    def test_retransmission_is_dropped( self ):
+        validator = LineValidator('test')
+        self.assertEqual(validator.validate('A,T1,20.0,01'), ['A', 'T1', 20.0, '01'])
+        self.assertIsNone(validator.validate('A,T1,20.0,01'))
+        self.assertIsNotNone(validator.validate('A,T1,20.5,02'))
+        # 少し遅れて届いた再送も捨てる
+        self.assertIsNone(validator.validate('A, T1, 20.0, 01'))
+
+class TestFrameDecoder ( unittest.TestCase ):
+    """バイナリフレームの seq による重複と飛びの検出"""
+
+    def _feed( self, decoder, seqs ):
+        data = b''.join(encode_frame(1, 1, 1.0, seq) for seq in seqs)
+        return [int(item[3]) for item in decoder.feed(data)]
+
+    def test_sender_restart( self ):
+        decoder = FrameDecoder('test')
+        self.assertEqual(self._feed(decoder, range(1000, 1100)), list(range(1000, 1100)))
+        # 再起動して seq が戻る（古い seq の範囲のフレームも捨てない）
+        self.assertEqual(self._feed(decoder, range(0, 200)), list(range(0, 200)))
+        self.assertEqual(self._feed(decoder, [180, 199]), [])
+        stats = decoder.stats['U01']
+        self.assertEqual((stats['received'], stats['lost'], stats['duplicated'], stats['restarted']),
+                         (300, 0, 2, 1))
+
+    def test_restart_soon_after_start( self ):
+        decoder = FrameDecoder('test')
+        self.assertEqual(self._feed(decoder, [0, 0, 1, 2, 3]), [0, 1, 2, 3])
+        # 0 から始まった seq が 0 に戻ったら、RECENT_SEQ より小さく戻った場合も再起動とみなす
+        self.assertEqual(self._feed(decoder, [0, 1, 2, 3, 4]), [0, 1, 2, 3, 4])
+        self.assertEqual(decoder.stats['U01']['restarted'], 1)
+
+    def test_late_zero_soon_after_start( self ):
+        decoder = FrameDecoder('test')
+        # 起動して間もなく遅れて届いた 0 の再送は、次のフレームが 1 でなければ重複
+        self.assertEqual(self._feed(decoder, [0, 1, 2, 0]), [0, 1, 2])
+        self.assertEqual(self._feed(decoder, [3, 2, 1, 4]), [3, 4])
+        stats = decoder.stats['U01']
+        self.assertEqual((stats['received'], stats['lost'], stats['duplicated'], stats['restarted']),
+                         (5, 0, 3, 0))
+        self.assertEqual(decoder.held, {})
+
+    def test_late_frame_and_wrap( self ):
+        decoder = FrameDecoder('test')
+        # 一巡した直後に遅れて届いた 0 の再送は重複（再起動ではない）
+        self.assertEqual(self._feed(decoder, [65534, 0, 65535, 1, 0]), [65534, 0, 65535, 1])
+        stats = decoder.stats['U01']
+        self.assertEqual((stats['lost'], stats['duplicated'], stats['restarted']), (1, 1, 0))
+
+if __name__ == '__main__':
+    unittest.main()
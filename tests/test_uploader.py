@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""keilib.uploader のテスト（requests が必要）
+
+    $ python3 -m unittest discover tests
+"""
+
+import json
+import tempfile
+import unittest
+
+try:
+    from keilib.uploader import HttpPostUploader
+except ImportError:
+    HttpPostUploader = None
+
+from keilib.spool import DiskSpool
+
+class _Response ( ):
+    def __init__( self, status_code, text='' ):
+        self.status_code = status_code
+        self.text = text
+
+class _Session ( ):
+    """POST された本文を記録し、決めておいた応答を順に返す。応答がなくなったら uploader を止める"""
+
+    def __init__( self, uploader, responses ):
+        self.uploader = uploader
+        self.responses = list(responses)
+        self.posted = []
+
+    def post( self, url, data=None, headers=None, timeout=None ):
+        self.posted.append(data)
+        response = self.responses.pop(0)
+        if not self.responses:
+            self.uploader.stopEvent.set()
+        return response
+
+    def close( self ):
+        pass
+
+@unittest.skipIf(HttpPostUploader is None, 'requests is not installed')
+class TestUploadResponse ( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = DiskSpool(self.tmpdir.name)
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def _uploader( self, responses, **kwargs ):
+        uploader = HttpPostUploader(self.spool, 'http://localhost/upload.php', 'key',
+                                    retry_min=0, retry_max=0, **kwargs)
+        uploader.session = _Session(uploader, responses)
+        return uploader
+
+    def test_check_response( self ):
+        uploader = self._uploader([])
+        results = {status: uploader._check_response(_Response(status, 'Error' if status >= 400 else 'OK.'))
+                   for status in (200, 400, 401, 403, 404, 413, 429, 500, 503)}
+        self.assertEqual(results, {200: True, 400: None, 401: False, 403: False, 404: False,
+                                   413: None, 429: False, 500: False, 503: False})
+
+    def test_wrong_key_keeps_data( self ):
+        # キーの誤り（403）やメンテナンス中（404）の間はデータを捨てずに再送する
+        self.spool.put(['a.txt', 'line 1\n'])
+        uploader = self._uploader([_Response(403, 'Error: Invalid key is specified.'),
+                                   _Response(404, 'Not Found'), _Response(200, 'OK.')])
+        uploader.run()
+        posted = uploader.session.posted
+        self.assertEqual(len(posted), 3)
+        self.assertEqual(posted[0], posted[2])
+        self.assertEqual(posted[2]['data'], 'line 1\n')
+        self.assertTrue(self.spool.empty())
+
+    def test_rejected_data_is_dropped( self ):
+        self.spool.put(['a.txt', 'line 1\n'])
+        self.spool.put(['b.txt', 'line 2\n'])
+        uploader = self._uploader([_Response(400, 'Error: Invalid file name.'), _Response(200, 'OK.')])
+        uploader.run()
+        self.assertEqual([data['data'] for data in uploader.session.posted], ['line 1\n', 'line 2\n'])
+
+    def _files( self, body ):
+        return [entry['fname'] for entry in json.loads(body.decode('utf-8'))['files']]
+
+    def test_batch_is_capped_at_max_bytes( self ):
+        for k in range(6):
+            self.spool.put(['f{}.txt'.format(k), 'x' * 90])
+        uploader = self._uploader([_Response(200, '{"result": "OK", "rejected": []}')] * 3,
+                                  batch=True, batch_bytes=1000, batch_age=0, compress=False, max_bytes=200)
+        uploader.run()
+        self.assertEqual([self._files(body) for body in uploader.session.posted],
+                         [['f0.txt', 'f1.txt'], ['f2.txt', 'f3.txt'], ['f4.txt', 'f5.txt']])
+        self.assertTrue(self.spool.empty())
+
+    def test_too_large_batch_is_split( self ):
+        for k in range(4):
+            self.spool.put(['f{}.txt'.format(k), 'x' * 90])
+        ok = _Response(200, '{"result": "OK", "rejected": []}')
+        uploader = self._uploader([_Response(413, 'Error: Too big data.'), ok, ok],
+                                  batch=True, batch_age=0, compress=False)
+        uploader.run()
+        self.assertEqual([self._files(body) for body in uploader.session.posted],
+                         [['f0.txt', 'f1.txt', 'f2.txt', 'f3.txt'], ['f0.txt', 'f1.txt'], ['f2.txt', 'f3.txt']])
+        self.assertTrue(self.spool.empty())
+        self.assertEqual(uploader.max_files, 0)
+
+    def test_rejected_file_in_batch( self ):
+        # サーバーはファイルごとに検査し、受け付けなかったファイルだけを返す
+        self.spool.put(['a.txt', 'line 1\n'])
+        self.spool.put(['../b.txt', 'line 2\n'])
+        response = _Response(200, json.dumps({'result': 'OK', 'rejected': [
+            {'index': 1, 'fname': '../b.txt', 'error': 'Invalid file name.'}]}))
+        uploader = self._uploader([response], batch=True, batch_age=0, compress=False)
+        with self.assertLogs('keilib.uploader', 'ERROR') as logs:
+            uploader.run()
+        self.assertIn('../b.txt', logs.output[0])
+        self.assertTrue(self.spool.empty())
+
+class TestDiskSpool ( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown( self ):
+        self.tmpdir.cleanup()
+
+    def test_partial_commit( self ):
+        spool = DiskSpool(self.tmpdir.name)
+        for k in range(4):
+            spool.put(['f.txt', str(k)])
+        self.assertEqual([spool.get_nowait()[1] for k in range(3)], ['0', '1', '2'])
+        # '0', '1' だけを確定し、'2' は取り出したまま
+        spool.commit(2)
+        self.assertEqual(spool.get_nowait()[1], '3')
+        spool.commit(1)
+        # 確定していない '3' は rewind() で読み直す
+        spool.rewind()
+        self.assertEqual(spool.get_nowait()[1], '3')
+
+        # 再起動しても確定した位置から読む
+        spool = DiskSpool(self.tmpdir.name)
+        self.assertEqual(spool.get_nowait()[1], '3')
+
+if __name__ == '__main__':
+    unittest.main()